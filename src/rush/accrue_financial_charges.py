@@ -1,5 +1,9 @@
+from collections import defaultdict
 from decimal import Decimal
-from typing import Optional
+from typing import (
+    List,
+    Optional,
+)
 
 from dateutil.relativedelta import relativedelta
 from pendulum import DateTime
@@ -11,6 +15,7 @@ from rush.card.base_card import (
     BaseLoan,
 )
 from rush.create_emi import update_event_with_dpd
+from rush.instrumentation import instrumented
 from rush.ledger_events import (
     _adjust_bill,
     _adjust_for_prepayment,
@@ -20,15 +25,22 @@ from rush.ledger_events import (
     adjust_for_revenue,
 )
 from rush.ledger_utils import (
+    LedgerBatch,
     create_ledger_entry_from_str,
+    flush_ledger_batch,
     get_account_balance_from_str,
+    get_account_balances,
+    prefetch_book_accounts_for_loans,
 )
 from rush.models import (
     BookAccount,
     Fee,
     LedgerLoanData,
     LedgerTriggerEvent,
+    Loan,
+    LoanMoratorium,
     LoanSchedule,
+    MoratoriumInterest,
     NewLedgerEntry,
 )
 from rush.utils import (
@@ -66,6 +78,7 @@ def can_remove_latest_accrued_interest(
     return False
 
 
+@instrumented("accrue_interest_on_all_bills")
 def accrue_interest_on_all_bills(session: Session, post_date: DateTime, user_loan: BaseLoan) -> None:
     interest_left_to_accrue = get_interest_left_to_accrue(session, user_loan)
     if interest_left_to_accrue <= 0:
@@ -106,6 +119,220 @@ def accrue_interest_on_all_bills(session: Session, post_date: DateTime, user_loa
     update_event_with_dpd(user_loan=user_loan, event=accrue_event)
 
 
+def accrue_interest_for_portfolio(
+    session: Session,
+    post_date: DateTime,
+    loan_ids: Optional[List[int]] = None,
+    chunk_size: int = 1000,
+) -> int:
+    """
+    accrue_interest_on_all_bills for many loans at once. Schedules, moratoria and balances of a
+    chunk of loans are read with a handful of set based queries and the chunk's ledger entries are
+    inserted together. By default picks every loan with an emi due in the month before post_date.
+    Returns the number of loans which got interest accrued.
+    """
+    if loan_ids is None:
+        loan_ids = [
+            loan_id
+            for loan_id, in session.query(LoanSchedule.loan_id)
+            .filter(
+                LoanSchedule.bill_id.is_(None),
+                LoanSchedule.due_date <= post_date,
+                LoanSchedule.due_date > post_date - relativedelta(months=1),
+            )
+            .distinct()
+            .order_by(LoanSchedule.loan_id)
+        ]
+
+    accrued_loans = 0
+    for chunk_start in range(0, len(loan_ids), chunk_size):
+        chunk_loan_ids = loan_ids[chunk_start : chunk_start + chunk_size]
+        accrued_loans += _accrue_interest_for_loans(session, post_date, chunk_loan_ids)
+    return accrued_loans
+
+
+def _accrue_interest_for_loans(session: Session, post_date: DateTime, loan_ids: List[int]) -> int:
+    from rush.card.term_loan import TermLoan
+
+    user_loans = session.query(Loan).filter(Loan.id.in_(loan_ids)).order_by(Loan.id).all()
+    for user_loan in user_loans:
+        user_loan.prepare(session=session)
+    prefetch_book_accounts_for_loans(session, user_loans)
+
+    bills_by_loan = defaultdict(list)
+    all_bills = (
+        session.query(LedgerLoanData)
+        .filter(LedgerLoanData.loan_id.in_(loan_ids))
+        .order_by(LedgerLoanData.loan_id, LedgerLoanData.bill_start_date)
+        .all()
+    )
+    user_loans_by_id = {user_loan.id: user_loan for user_loan in user_loans}
+    for bill in all_bills:
+        bills_by_loan[bill.loan_id].append(user_loans_by_id[bill.loan_id].convert_to_bill_class(bill))
+
+    bill_balances = get_account_balances(
+        session,
+        [
+            book_string
+            for bill in all_bills
+            for book_string in (f"{bill.id}/bill/interest_accrued/r", f"{bill.id}/bill/max/a")
+        ],
+    )
+
+    # Same as get_interest_left_to_accrue.
+    total_interest_due = dict(
+        session.query(LoanSchedule.loan_id, func.sum(LoanSchedule.interest_due))
+        .filter(LoanSchedule.loan_id.in_(loan_ids), LoanSchedule.bill_id.is_(None))
+        .group_by(LoanSchedule.loan_id)
+        .all()
+    )
+    early_closing_fee = dict(
+        session.query(Fee.identifier_id, func.sum(Fee.gross_amount_paid))
+        .filter(
+            Fee.identifier == "loan",
+            Fee.identifier_id.in_(loan_ids),
+            Fee.name == "early_close_fee",
+        )
+        .group_by(Fee.identifier_id)
+        .all()
+    )
+
+    # Same as BaseLoan.get_emi_to_accrue_interest and TermLoan.get_emi_to_accrue_interest.
+    emis_to_accrue = {}
+    loan_ids_by_rule = defaultdict(list)
+    for user_loan in user_loans:
+        loan_ids_by_rule[type(user_loan).get_emi_to_accrue_interest].append(user_loan.id)
+    for rule, rule_loan_ids in loan_ids_by_rule.items():
+        emi_query = session.query(LoanSchedule).filter(
+            LoanSchedule.loan_id.in_(rule_loan_ids), LoanSchedule.bill_id.is_(None)
+        )
+        if rule is BaseLoan.get_emi_to_accrue_interest:
+            emi_query = (
+                emi_query.filter(
+                    LoanSchedule.due_date < post_date,
+                    LoanSchedule.due_date > post_date - relativedelta(months=1),
+                )
+                .distinct(LoanSchedule.loan_id)
+                .order_by(LoanSchedule.loan_id, LoanSchedule.due_date.desc())
+            )
+        elif rule is TermLoan.get_emi_to_accrue_interest:
+            emi_query = emi_query.filter(LoanSchedule.due_date == post_date)
+        else:
+            for loan_id in rule_loan_ids:
+                emis_to_accrue[loan_id] = user_loans_by_id[loan_id].get_emi_to_accrue_interest(
+                    post_date=post_date
+                )
+            continue
+        emis_to_accrue.update((emi.loan_id, emi) for emi in emi_query.all())
+
+    unpaid_bills_by_loan = {}
+    for user_loan in user_loans:
+        generated_bills = [bill for bill in bills_by_loan[user_loan.id] if bill.table.is_generated]
+        if user_loan.bill_class.is_bill_closed is BaseBill.is_bill_closed:
+            unpaid_bills = [
+                bill for bill in generated_bills if bill_balances[f"{bill.id}/bill/max/a"] != 0
+            ]
+        else:
+            unpaid_bills = [bill for bill in generated_bills if not bill.is_bill_closed()]
+        unpaid_bills_by_loan[user_loan.id] = unpaid_bills
+    unpaid_bill_ids = [bill.id for bills in unpaid_bills_by_loan.values() for bill in bills]
+    emi_due_dates = {emi.due_date for emi in emis_to_accrue.values() if emi}
+
+    bill_schedules = {}
+    if unpaid_bill_ids and emi_due_dates:
+        bill_schedules = {
+            (bill_schedule.bill_id, bill_schedule.due_date): bill_schedule
+            for bill_schedule in session.query(LoanSchedule).filter(
+                LoanSchedule.bill_id.in_(unpaid_bill_ids), LoanSchedule.due_date.in_(emi_due_dates)
+            )
+        }
+
+    # Same lookups as LoanSchedule.interest_to_accrue.
+    loan_moratoriums = {}
+    for loan_moratorium in (
+        session.query(LoanMoratorium)
+        .filter(LoanMoratorium.loan_id.in_(loan_ids))
+        .order_by(LoanMoratorium.loan_id, LoanMoratorium.start_date.desc())
+    ):
+        loan_moratoriums.setdefault(loan_moratorium.loan_id, loan_moratorium)
+    moratorium_interest_by_emi = {}
+    total_bill_moratorium_interest = {}
+    if loan_moratoriums and bill_schedules:
+        moratorium_interest_by_emi = dict(
+            session.query(MoratoriumInterest.loan_schedule_id, MoratoriumInterest.interest).filter(
+                MoratoriumInterest.loan_schedule_id.in_(
+                    [bill_schedule.id for bill_schedule in bill_schedules.values()]
+                )
+            )
+        )
+        total_bill_moratorium_interest = {
+            (loan_id, bill_id): interest
+            for loan_id, bill_id, interest in session.query(
+                LoanMoratorium.loan_id, LoanSchedule.bill_id, func.sum(MoratoriumInterest.interest)
+            )
+            .join(LoanMoratorium, MoratoriumInterest.moratorium_id == LoanMoratorium.id)
+            .join(LoanSchedule, LoanSchedule.id == MoratoriumInterest.loan_schedule_id)
+            .filter(
+                LoanMoratorium.loan_id.in_(list(loan_moratoriums)),
+                LoanSchedule.bill_id.in_(unpaid_bill_ids),
+            )
+            .group_by(LoanMoratorium.loan_id, LoanSchedule.bill_id)
+        }
+
+    accrue_events = {}
+    interest_left_to_accrue_by_loan = {}
+    for user_loan in user_loans:
+        interest_accrued = sum(
+            bill_balances[f"{bill.id}/bill/interest_accrued/r"] for bill in bills_by_loan[user_loan.id]
+        )
+        interest_left_to_accrue = (
+            (total_interest_due.get(user_loan.id) or 0)
+            - interest_accrued
+            - (early_closing_fee.get(user_loan.id) or 0)
+        )
+        loan_schedule = emis_to_accrue.get(user_loan.id)
+        if interest_left_to_accrue <= 0 or not loan_schedule:
+            continue
+        interest_left_to_accrue_by_loan[user_loan.id] = interest_left_to_accrue
+        accrue_events[user_loan.id] = LedgerTriggerEvent(
+            name="accrue_interest",
+            loan_id=user_loan.loan_id,
+            post_date=post_date,
+            amount=0,
+            extra_details={"emi_id": loan_schedule.id},
+        )
+    session.add_all(accrue_events.values())
+    session.flush()
+
+    with LedgerBatch(session):
+        for loan_id, accrue_event in accrue_events.items():
+            interest_left_to_accrue = interest_left_to_accrue_by_loan[loan_id]
+            loan_schedule = emis_to_accrue[loan_id]
+            # accrual actually happens for each bill using bill's schedule.
+            for bill in unpaid_bills_by_loan[loan_id]:
+                if interest_left_to_accrue <= 0:
+                    break
+                bill_schedule = bill_schedules.get((bill.id, loan_schedule.due_date))
+                if bill_schedule:
+                    interest_to_accrue = min(
+                        interest_left_to_accrue,
+                        bill_schedule.get_interest_to_accrue(
+                            loan_moratoriums.get(bill_schedule.loan_id),
+                            moratorium_interest_by_emi.get(bill_schedule.id),
+                            total_bill_moratorium_interest.get((bill_schedule.loan_id, bill.id)),
+                        ),
+                    )
+                    accrue_event.amount += interest_to_accrue
+                    accrue_interest_event(session, bill, accrue_event, interest_to_accrue)
+                    add_max_amount_event(session, bill, accrue_event, interest_to_accrue)
+                    interest_left_to_accrue -= interest_to_accrue
+
+    # Dpd calculation
+    for loan_id, accrue_event in accrue_events.items():
+        update_event_with_dpd(user_loan=user_loans_by_id[loan_id], event=accrue_event)
+    return len(accrue_events)
+
+
 def is_late_fee_valid(session: Session, user_loan: BaseLoan) -> bool:
     """
     Late fee gets charged if user fails to pay the minimum due before the due date.
@@ -253,6 +480,7 @@ def reverse_interest_charges(
     )
     session.add(event)
     session.flush()
+    flush_ledger_batch(session)
 
     # I first find what all bills the previous event touched.
     bills_and_ledger_entry = (
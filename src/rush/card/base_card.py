@@ -1,10 +1,10 @@
 from datetime import date
 from decimal import Decimal
 from typing import (
-    Callable,
     Dict,
     List,
     Optional,
+    Set,
     Type,
     TypeVar,
 )
@@ -14,11 +14,21 @@ from pendulum import (
     Date,
     DateTime,
 )
-from sqlalchemy import func
+from sqlalchemy import (
+    event,
+    func,
+)
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import (
+    Session,
+    object_session,
+)
 
-from rush.ledger_utils import get_account_balance_from_str
+from rush.ledger_utils import (
+    flush_ledger_batch,
+    get_account_balance_from_str,
+    get_account_balances,
+)
 from rush.loan_schedule.calculations import (
     get_down_payment,
     get_interest_for_integer_emi,
@@ -29,6 +39,7 @@ from rush.models import (
     LedgerLoanData,
     LedgerTriggerEvent,
     Loan,
+    LoanBalanceSummary,
     LoanMoratorium,
     LoanSchedule,
 )
@@ -200,16 +211,35 @@ class BaseBill:
 B = TypeVar("B", bound=BaseBill)
 
 
-def _convert_to_bill_class_decorator(function: Callable[["BaseLoan"], LedgerLoanData]) -> Callable:
-    def f(self):
-        bills = function(self)
-        if not bills:
-            return None
-        if type(bills) is list:
-            return [self.convert_to_bill_class(bill) for bill in bills]
-        return self.convert_to_bill_class(bills)
+def _clear_bill_registry(session: Optional[Session]) -> None:
+    if session is not None:
+        session.info.pop("bill_registry", None)
+
+
+# Cached bills are dropped whenever any bill changes, is added or deleted, and with the transaction.
+def _clear_bill_registry_on_set(target: LedgerLoanData, *args) -> None:
+    _clear_bill_registry(object_session(target))
+
+
+for _column in LedgerLoanData.__mapper__.column_attrs:
+    event.listen(getattr(LedgerLoanData, _column.key), "set", _clear_bill_registry_on_set)
+
+
+@event.listens_for(LedgerLoanData, "after_delete")
+def _clear_bill_registry_on_delete(mapper, connection, target: LedgerLoanData) -> None:
+    _clear_bill_registry(object_session(target))
 
-    return f
+
+@event.listens_for(Session, "after_attach")
+def _clear_bill_registry_on_attach(session: Session, instance: object) -> None:
+    if isinstance(instance, LedgerLoanData):
+        _clear_bill_registry(session)
+
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_soft_rollback")
+def _clear_bill_registry_on_transaction_end(session: Session, *args) -> None:
+    _clear_bill_registry(session)
 
 
 class BaseLoan(Loan):
@@ -327,21 +357,40 @@ class BaseLoan(Loan):
         only_unpaid_bills: bool = False,
         only_closed_bills: bool = False,
     ) -> List[BaseBill]:
-        all_bills_query = (
-            self.session.query(LedgerLoanData)
-            .filter(LedgerLoanData.loan_id == self.loan_id)
-            .order_by(LedgerLoanData.bill_start_date)
-        )
+        all_bills = self._get_bills()
         if are_generated:
-            all_bills_query = all_bills_query.filter(LedgerLoanData.is_generated.is_(True))
-        query_result = all_bills_query.all()
-        all_bills = [self.convert_to_bill_class(bill) for bill in query_result]
+            all_bills = [bill for bill in all_bills if bill.table.is_generated]
         if only_unpaid_bills:
-            all_bills = [bill for bill in all_bills if not bill.is_bill_closed()]
+            closed_bill_ids = self.get_closed_bill_ids(all_bills)
+            all_bills = [bill for bill in all_bills if bill.table.id not in closed_bill_ids]
         elif only_closed_bills:
-            all_bills = [bill for bill in all_bills if bill.is_bill_closed()]
+            closed_bill_ids = self.get_closed_bill_ids(all_bills)
+            all_bills = [bill for bill in all_bills if bill.table.id in closed_bill_ids]
         return all_bills
 
+    def get_bill_balances(
+        self,
+        bills: List[BaseBill],
+        book_name: str,
+        to_date: Optional[DateTime] = None,
+        event_id: Optional[int] = None,
+    ) -> Dict[int, Decimal]:
+        """Balance of the same asset book of every bill, keyed by bill id. Fetched in one query."""
+        balances = get_account_balances(
+            self.session,
+            [f"{bill.table.id}/bill/{book_name}/a" for bill in bills],
+            to_date=to_date,
+            event_id=event_id,
+        )
+        return {bill.table.id: balances[f"{bill.table.id}/bill/{book_name}/a"] for bill in bills}
+
+    def get_closed_bill_ids(self, bills: List[BaseBill]) -> Set[int]:
+        # Products can decide closure differently. Only bulk fetch when it's the max balance check.
+        if self.bill_class.is_bill_closed is not BaseBill.is_bill_closed:
+            return {bill.table.id for bill in bills if bill.is_bill_closed()}
+        max_balances = self.get_bill_balances(bills, "max")
+        return {bill_id for bill_id, max_balance in max_balances.items() if max_balance == 0}
+
     def get_all_bills_post_date(self, post_date: DateTime) -> List[BaseBill]:
         all_bills = (
             self.session.query(LedgerLoanData)
@@ -357,47 +406,60 @@ class BaseLoan(Loan):
         return all_bills
 
     def get_last_unpaid_bill(self) -> BaseBill:
-        all_bills = (
-            self.session.query(LedgerLoanData)
-            .filter(LedgerLoanData.loan_id == self.loan_id)
-            .order_by(LedgerLoanData.bill_start_date)
-            .all()
-        )
-        all_bills = [self.convert_to_bill_class(bill) for bill in all_bills]
-        unpaid_bills = [bill for bill in all_bills if not bill.is_bill_closed()]
+        all_bills = self._get_bills()
+        closed_bill_ids = self.get_closed_bill_ids(all_bills)
+        unpaid_bills = [bill for bill in all_bills if bill.table.id not in closed_bill_ids]
         if unpaid_bills:
             return unpaid_bills[0]
         return None
 
-    @_convert_to_bill_class_decorator
-    def get_latest_generated_bill(self) -> LedgerLoanData:
-        latest_bill = (
-            self.session.query(LedgerLoanData)
-            .filter(LedgerLoanData.loan_id == self.loan_id, LedgerLoanData.is_generated.is_(True))
-            .order_by(LedgerLoanData.bill_start_date.desc())
-            .first()
-        )
-        return latest_bill
-
-    @_convert_to_bill_class_decorator
-    def get_latest_bill_to_generate(self) -> LedgerLoanData:
-        loan_data = (
-            self.session.query(LedgerLoanData)
-            .filter(LedgerLoanData.loan_id == self.loan_id, LedgerLoanData.is_generated.is_(False))
-            .order_by(LedgerLoanData.bill_start_date)
-            .first()
+    def _get_bills(self) -> List[BaseBill]:
+        """
+        All bills of the loan ordered by start date. The converted bills are kept in the session
+        until any bill changes so repeated lookups within an operation don't hit the database.
+        """
+        registry = self.session.info.setdefault("bill_registry", {})
+        bills = registry.get(self.loan_id)
+        if bills is None:
+            loan_data = (
+                self.session.query(LedgerLoanData)
+                .filter(LedgerLoanData.loan_id == self.loan_id)
+                .order_by(LedgerLoanData.bill_start_date)
+                .all()
+            )
+            bills = registry[self.loan_id] = [self.convert_to_bill_class(bill) for bill in loan_data]
+        return list(bills)
+
+    def get_latest_generated_bill(self) -> Optional[BaseBill]:
+        generated_bills = [bill for bill in self._get_bills() if bill.table.is_generated]
+        return generated_bills[-1] if generated_bills else None
+
+    def get_latest_bill_to_generate(self) -> Optional[BaseBill]:
+        return next((bill for bill in self._get_bills() if not bill.table.is_generated), None)
+
+    def get_latest_bill(self) -> Optional[BaseBill]:
+        bills = self._get_bills()
+        return bills[-1] if bills else None
+
+    def get_balance_summary(self) -> LoanBalanceSummary:
+        """Current balances of the loan, maintained by triggers on book_account and fee."""
+        flush_ledger_batch(self.session)
+        summary = (
+            self.session.query(LoanBalanceSummary)
+            .filter(LoanBalanceSummary.loan_id == self.loan_id)
+            .populate_existing()
+            .one_or_none()
         )
-        return loan_data
-
-    @_convert_to_bill_class_decorator
-    def get_latest_bill(self) -> LedgerLoanData:
-        loan_data = (
-            self.session.query(LedgerLoanData)
-            .filter(LedgerLoanData.loan_id == self.id)
-            .order_by(LedgerLoanData.bill_start_date.desc())
-            .first()
+        # No row until the loan's first balance change.
+        return summary or LoanBalanceSummary(
+            loan_id=self.loan_id,
+            min_balance=Decimal(0),
+            max_balance=Decimal(0),
+            principal_balance=Decimal(0),
+            interest_balance=Decimal(0),
+            fee_balance=Decimal(0),
+            prepayment_balance=Decimal(0),
         )
-        return loan_data
 
     def get_remaining_min(
         self,
@@ -408,9 +470,11 @@ class BaseLoan(Loan):
         if LoanMoratorium.is_in_moratorium(self.session, self.id, date_to_check_against):
             return Decimal(0)
 
+        # Only unpaid generated bills count and products decide closure differently, so unlike the
+        # max this isn't read from the balance summary.
         unpaid_bills = self.get_unpaid_generated_bills()
         remaining_min_of_all_bills = sum(
-            bill.get_remaining_min(date_to_check_against) for bill in unpaid_bills
+            self.get_bill_balances(unpaid_bills, "min", to_date=date_to_check_against).values()
         )
 
         if include_child_loans:
@@ -429,10 +493,15 @@ class BaseLoan(Loan):
         event_id: int = None,
         include_child_loans: Optional[bool] = True,
     ) -> Decimal:
-        bills = self.get_all_bills()
-        remaining_max_of_all_bills = sum(
-            bill.get_remaining_max(date_to_check_against, event_id) for bill in bills
-        )
+        if date_to_check_against is None and event_id is None:
+            remaining_max_of_all_bills = self.get_balance_summary().max_balance
+        else:
+            bills = self.get_all_bills()
+            remaining_max_of_all_bills = sum(
+                self.get_bill_balances(
+                    bills, "max", to_date=date_to_check_against, event_id=event_id
+                ).values()
+            )
 
         if include_child_loans:
             child_loans = self.get_child_loans()
@@ -445,7 +514,23 @@ class BaseLoan(Loan):
 
     def get_total_outstanding(self, date_to_check_against: DateTime = None) -> Decimal:
         all_bills = self.get_all_bills()
-        total_outstanding = sum(bill.get_outstanding_amount(date_to_check_against) for bill in all_bills)
+        book_strings = []
+        for bill in all_bills:
+            book_strings.append(f"{bill.table.id}/bill/unbilled/a")
+            book_strings.append(f"{bill.table.id}/bill/max/a")
+        balances = get_account_balances(self.session, book_strings, to_date=date_to_check_against)
+
+        total_outstanding = 0
+        for bill in all_bills:
+            # Same as BaseBill.get_outstanding_amount.
+            if (
+                not bill.table.is_generated
+                or date_to_check_against
+                and date_to_check_against.date() < bill.table.bill_close_date
+            ):
+                total_outstanding += balances[f"{bill.table.id}/bill/unbilled/a"]
+            else:
+                total_outstanding += balances[f"{bill.table.id}/bill/max/a"]
         return total_outstanding
 
     def get_loan_schedule(
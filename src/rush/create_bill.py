@@ -16,6 +16,7 @@ from rush.card.base_card import (
     BaseLoan,
 )
 from rush.create_emi import update_journal_entry
+from rush.instrumentation import instrumented
 from rush.ledger_events import (
     add_max_amount_event,
     bill_generate_event,
@@ -77,6 +78,7 @@ def get_or_create_bill_for_card_swipe(
     return {"result": "success", "bill": new_bill}
 
 
+@instrumented("bill_generate")
 def bill_generate(
     user_loan: BaseLoan,
     creation_time: DateTime = get_current_ist_time(),
@@ -19,11 +19,16 @@ from rush.create_emi import (
     update_event_with_dpd,
     update_journal_entry,
 )
+from rush.instrumentation import instrumented
 from rush.ledger_events import (
     card_transaction_event,
     disburse_money_to_card,
 )
-from rush.ledger_utils import reverse_event
+from rush.ledger_utils import (
+    LedgerBatch,
+    prefetch_book_accounts,
+    reverse_event,
+)
 from rush.models import (
     CardTransaction,
     LedgerLoanData,
@@ -31,6 +36,7 @@ from rush.models import (
 )
 
 
+@instrumented("create_card_swipe")
 def create_card_swipe(
     session: Session,
     user_loan: BaseLoan,
@@ -56,6 +62,7 @@ def create_card_swipe(
     if card_bill["result"] == "error":
         return card_bill
     card_bill = card_bill["bill"]
+    prefetch_book_accounts(session, user_loan)
     swipe = CardTransaction(  # This can be moved to user card too.
         loan_id=card_bill.id,
         txn_time=txn_time,
@@ -81,10 +88,11 @@ def create_card_swipe(
     session.add(lt)
     session.flush()  # need id. TODO Gotta use table relationships
 
-    if not isinstance(user_loan, ResetCardV2):
-        disburse_money_to_card(session=session, user_loan=user_loan, event=lt)
+    with LedgerBatch(session):
+        if not isinstance(user_loan, ResetCardV2):
+            disburse_money_to_card(session=session, user_loan=user_loan, event=lt)
 
-    card_transaction_event(session=session, user_loan=user_loan, event=lt, mcc=mcc)
+        card_transaction_event(session=session, user_loan=user_loan, event=lt, mcc=mcc)
 
     # Dpd calculation
     update_event_with_dpd(user_loan=user_loan, event=lt)
@@ -1,6 +1,10 @@
 from datetime import datetime
 from decimal import Decimal
-from typing import Optional
+from typing import (
+    List,
+    Optional,
+    Tuple,
+)
 
 from dateutil.relativedelta import relativedelta
 from pendulum import DateTime
@@ -8,25 +12,151 @@ from sqlalchemy.orm import (
     Session,
     aliased,
 )
-from sqlalchemy.sql import func
 from sqlalchemy.sql.sqltypes import (
     TIMESTAMP,
     String,
 )
 
-from rush.card.base_card import BaseLoan
+from rush.card.base_card import (
+    BaseBill,
+    BaseLoan,
+)
+from rush.instrumentation import set_current_event
+from rush.ledger_utils import flush_ledger_batch
 from rush.models import (
     BookAccount,
     EventDpd,
     JournalEntry,
+    JournalEntryOutbox,
     LedgerLoanData,
     LedgerTriggerEvent,
+    Loan,
     LoanMoratorium,
+    LoanSchedule,
     NewLedgerEntry,
     PaymentRequestsData,
     PaymentSplit,
-    UserData,
 )
+from rush.user_names import (
+    resolve_name,
+    resolve_names,
+)
+from rush.utils import get_current_ist_time
+
+
+def _get_dpd_side(
+    event_name: str, debit_account: BookAccount, credit_account: BookAccount
+) -> Optional[Tuple[bool, BookAccount]]:
+    """
+    Which side of a ledger entry moves a bill's dpd, if any. Returns (is_debit, bill account).
+    """
+    if (
+        event_name in ["accrue_interest", "charge_late_fee", "atm_fee_added"]
+        and debit_account.identifier_type == "bill"
+        and debit_account.book_name == "max"
+    ):
+        return False, debit_account
+    if (
+        event_name in ["card_transaction"]
+        and debit_account.identifier_type == "bill"
+        and debit_account.book_name == "unbilled"
+    ):
+        return False, debit_account
+    if (
+        event_name
+        in ["reverse_interest_charges", "fee_removed", "payment_received", "transaction_refund"]
+        and credit_account.identifier_type == "bill"
+        and credit_account.book_name == "max"
+    ):
+        return True, credit_account
+    return None
+
+
+def _update_dpd_for_event(user_loan: BaseLoan, event: LedgerTriggerEvent) -> List[LoanSchedule]:
+    """
+    Incremental dpd update for the entries of a single event. Moratorium, schedule and bills
+    are loaded once per call instead of once per ledger entry and the EventDpd rows are inserted
+    in bulk. Returns the unpaid emis with their updated dpd.
+    """
+    session = user_loan.session
+    debit_book_account = aliased(BookAccount)
+    credit_book_account = aliased(BookAccount)
+    entries = (
+        session.query(NewLedgerEntry, debit_book_account, credit_book_account)
+        .filter(
+            NewLedgerEntry.event_id == event.id,
+            NewLedgerEntry.debit_account == debit_book_account.id,
+            NewLedgerEntry.credit_account == credit_book_account.id,
+        )
+        .all()
+    )
+    unpaid_emis = user_loan.get_loan_schedule(only_unpaid_emis=True)
+
+    dpd_entries = []
+    for ledger_entry, debit_account, credit_account in entries:
+        dpd_side = _get_dpd_side(event.name, debit_account, credit_account)
+        if dpd_side:
+            dpd_entries.append((ledger_entry, *dpd_side))
+    if not dpd_entries:
+        return unpaid_emis
+    # Rows are grouped per bill so a bill's latest row is the last one.
+    dpd_entries.sort(key=lambda row: (row[2].identifier, row[0].id))
+
+    if isinstance(event.post_date, datetime):
+        event_post_date = event.post_date.date()
+    else:
+        event_post_date = event.post_date
+    # In case of moratorium reset all post dates to start of moratorium
+    moratoriums = (
+        session.query(LoanMoratorium)
+        .filter(LoanMoratorium.loan_id == user_loan.loan_id)
+        .order_by(LoanMoratorium.id)
+        .all()
+    )
+    if any(m.start_date <= event_post_date <= m.end_date for m in moratoriums):
+        event_post_date = moratoriums[0].start_date
+
+    # Every entry of the event has the same post date so the schedule only needs one pass.
+    for emi in unpaid_emis:
+        schedule_dpd = (event_post_date - emi.due_date).days
+        # We should only consider the daily dpd event for increment
+        if schedule_dpd >= emi.dpd:
+            emi.dpd = schedule_dpd
+
+    bill_ids = {account.identifier for _, _, account in dpd_entries}
+    bills = {
+        bill.id: user_loan.convert_to_bill_class(bill)
+        for bill in session.query(LedgerLoanData).filter(
+            LedgerLoanData.loan_id == user_loan.loan_id, LedgerLoanData.id.in_(bill_ids)
+        )
+    }
+    bill_dpds = {}
+    for bill_id in bill_ids:
+        bill = bills.get(bill_id)
+        # Bill dpd is only calculated if min is not 0
+        if unpaid_emis and bill and bill.get_remaining_min() > 0:
+            bill_dpds[bill_id] = (event_post_date - unpaid_emis[0].due_date).days
+        else:
+            bill_dpds[bill_id] = -999
+
+    session.bulk_insert_mappings(
+        EventDpd,
+        [
+            dict(
+                bill_id=account.identifier,
+                loan_id=user_loan.loan_id,
+                event_id=event.id,
+                credit=Decimal(0) if is_debit else ledger_entry.amount,
+                debit=ledger_entry.amount if is_debit else Decimal(0),
+                balance=ledger_entry.credit_account_balance
+                if is_debit
+                else ledger_entry.debit_account_balance,
+                dpd=bill_dpds[account.identifier],
+            )
+            for ledger_entry, is_debit, account in dpd_entries
+        ],
+    )
+    return unpaid_emis
 
 
 def update_event_with_dpd(
@@ -107,76 +237,48 @@ def update_event_with_dpd(
         session.add(new_event)
 
     session = user_loan.session
+    flush_ledger_batch(session)
 
-    debit_book_account = aliased(BookAccount)
-    credit_book_account = aliased(BookAccount)
-    events_list = session.query(
-        LedgerTriggerEvent, NewLedgerEntry, debit_book_account, credit_book_account
-    ).filter(
-        NewLedgerEntry.event_id == LedgerTriggerEvent.id,
-        NewLedgerEntry.debit_account == debit_book_account.id,
-        NewLedgerEntry.credit_account == credit_book_account.id,
-    )
-    if from_date and to_date:
-        events_list = events_list.filter(
-            LedgerTriggerEvent.post_date > from_date,
-            LedgerTriggerEvent.post_date <= to_date,
-        )
-    elif to_date:
-        events_list = events_list.filter(
-            LedgerTriggerEvent.post_date <= to_date,
+    if event and not from_date and not to_date:
+        unpaid_emis = _update_dpd_for_event(user_loan, event)
+    else:
+        debit_book_account = aliased(BookAccount)
+        credit_book_account = aliased(BookAccount)
+        events_list = session.query(
+            LedgerTriggerEvent, NewLedgerEntry, debit_book_account, credit_book_account
+        ).filter(
+            NewLedgerEntry.event_id == LedgerTriggerEvent.id,
+            NewLedgerEntry.debit_account == debit_book_account.id,
+            NewLedgerEntry.credit_account == credit_book_account.id,
         )
+        if from_date and to_date:
+            events_list = events_list.filter(
+                LedgerTriggerEvent.post_date > from_date,
+                LedgerTriggerEvent.post_date <= to_date,
+            )
+        elif to_date:
+            events_list = events_list.filter(
+                LedgerTriggerEvent.post_date <= to_date,
+            )
 
-    if event:
-        events_list = events_list.filter(LedgerTriggerEvent.id == event.id)
-    events_list = events_list.order_by(LedgerTriggerEvent.post_date.asc()).all()
+        if event:
+            events_list = events_list.filter(LedgerTriggerEvent.id == event.id)
+        events_list = events_list.order_by(LedgerTriggerEvent.post_date.asc()).all()
 
-    for (
-        ledger_trigger_event,
-        ledger_entry,
-        debit_account,
-        credit_account,
-    ) in events_list:
-        if (
-            ledger_trigger_event.name
-            in [
-                "accrue_interest",
-                "charge_late_fee",
-                "atm_fee_added",
-            ]
-            and debit_account.identifier_type == "bill"
-            and debit_account.book_name == "max"
-        ):
-            actual_event_update(session, False, ledger_trigger_event, ledger_entry, debit_account)
+        for (
+            ledger_trigger_event,
+            ledger_entry,
+            debit_account,
+            credit_account,
+        ) in events_list:
+            dpd_side = _get_dpd_side(ledger_trigger_event.name, debit_account, credit_account)
+            if dpd_side:
+                is_debit, account = dpd_side
+                actual_event_update(session, is_debit, ledger_trigger_event, ledger_entry, account)
 
-        elif (
-            ledger_trigger_event.name
-            in [
-                "card_transaction",
-            ]
-            and debit_account.identifier_type == "bill"
-            and debit_account.book_name == "unbilled"
-        ):
-            actual_event_update(session, False, ledger_trigger_event, ledger_entry, debit_account)
-
-        elif (
-            ledger_trigger_event.name
-            in [
-                "reverse_interest_charges",
-                "fee_removed",
-                "payment_received",
-                "transaction_refund",
-            ]
-            and credit_account.identifier_type == "bill"
-            and credit_account.book_name == "max"
-        ):
-            actual_event_update(session, True, ledger_trigger_event, ledger_entry, credit_account)
-
-        else:
-            continue
+        unpaid_emis = user_loan.get_loan_schedule(only_unpaid_emis=True)
 
     # Calculate card level dpd
-    unpaid_emis = user_loan.get_loan_schedule(only_unpaid_emis=True)
     if len(unpaid_emis) > 0:
         first_unpaid_emi = unpaid_emis[0]
         # Exception case in which if future emis are paid we consider the due date to be
@@ -273,6 +375,209 @@ def daily_dpd_update(session, user_loan, post_date):
     session.flush()
 
 
+# Bill level dpd rows for every unpaid bill of the loans which have an unpaid emi.
+insert_bulk_event_dpd_query = """
+with first_unpaid_emi as (
+  select
+    distinct on (loan_id) loan_id,
+    due_date
+  from
+    loan_schedule
+  where
+    loan_id = any(:loan_ids)
+    and bill_id is null
+    and principal_due + interest_due - payment_received != 0
+  order by
+    loan_id,
+    emi_number
+),
+events as (
+  select
+    *
+  from
+    unnest(cast(:loan_ids as integer[]), cast(:event_ids as integer[])) as e(loan_id, event_id)
+)
+insert into event_dpd (
+  bill_id, loan_id, event_id, credit, debit, balance, dpd, row_status, created_at, updated_at, performed_by
+)
+select
+  ld.id,
+  ld.loan_id,
+  e.event_id,
+  0,
+  0,
+  coalesce(ba.balance, 0),
+  :event_date - fue.due_date,
+  'active',
+  :now,
+  :now,
+  1
+from
+  loan_data ld
+  join events e on e.loan_id = ld.loan_id
+  join first_unpaid_emi fue on fue.loan_id = ld.loan_id
+  left join book_account ba on ba.identifier = ld.id
+  and ba.identifier_type = 'bill'
+  and ba.book_name = 'max'
+  and ba.account_type = 'a'
+where
+  (
+    ld.loan_id = any(:max_balance_loan_ids)
+    and coalesce(ba.balance, 0) != 0
+  )
+  or ld.id = any(:unpaid_bill_ids)
+order by
+  ld.loan_id,
+  ld.bill_start_date
+"""
+
+# Loan level dpd from the first unpaid emi. If only future emis are unpaid, dpd is counted from
+# the 15th of the month after the last payment instead. Same as daily_dpd_update.
+update_bulk_loan_dpd_query = """
+with first_unpaid_emi as (
+  select
+    distinct on (loan_id) loan_id,
+    due_date,
+    dpd
+  from
+    loan_schedule
+  where
+    loan_id = any(:loan_ids)
+    and bill_id is null
+    and principal_due + interest_due - payment_received != 0
+  order by
+    loan_id,
+    emi_number
+),
+last_payment as (
+  select
+    distinct on (loan_id) loan_id,
+    post_date
+  from
+    ledger_trigger_event
+  where
+    loan_id = any(:loan_ids)
+    and name = 'payment_received'
+  order by
+    loan_id,
+    id desc
+),
+min_due_date as (
+  select
+    fue.loan_id,
+    fue.due_date,
+    fue.dpd,
+    (
+      date_trunc('month', coalesce(lp.post_date :: date, :event_date) + interval '1 month') + interval '14 days'
+    ):: date as min_due_date
+  from
+    first_unpaid_emi fue
+    left join last_payment lp on lp.loan_id = fue.loan_id
+),
+loan_dpd as (
+  select
+    loan_id,
+    case when due_date > min_due_date then :event_date - min_due_date else dpd end as dpd
+  from
+    min_due_date
+)
+update
+  v3_loans
+set
+  dpd = loan_dpd.dpd,
+  ever_dpd = case when coalesce(v3_loans.ever_dpd, 0) = 0
+  or loan_dpd.dpd > v3_loans.ever_dpd then loan_dpd.dpd else v3_loans.ever_dpd end
+from
+  loan_dpd
+where
+  v3_loans.id = loan_dpd.loan_id
+"""
+
+
+def daily_dpd_update_bulk(
+    session: Session, post_date: DateTime, loan_ids: List[int], chunk_size: int = 1000
+) -> None:
+    """
+    daily_dpd_update for many loans with a few set based statements per chunk. Schedules and
+    loans of the chunk which are already loaded in the session get expired.
+    """
+    for chunk_start in range(0, len(loan_ids), chunk_size):
+        _daily_dpd_update_for_loans(session, post_date, loan_ids[chunk_start : chunk_start + chunk_size])
+
+
+def _daily_dpd_update_for_loans(session: Session, post_date: DateTime, loan_ids: List[int]) -> None:
+    from rush.card.term_loan import TermLoanBill
+
+    session.flush()
+    now = get_current_ist_time()
+    event_date = post_date.date() if isinstance(post_date, datetime) else post_date
+
+    # Bill closure can be product specific.
+    max_balance_loan_ids = []
+    unpaid_bill_ids = []
+    for user_loan in session.query(Loan).filter(Loan.id.in_(loan_ids)):
+        user_loan.prepare(session=session)
+        if user_loan.bill_class.is_bill_closed is BaseBill.is_bill_closed:
+            max_balance_loan_ids.append(user_loan.id)
+        elif user_loan.bill_class.is_bill_closed is TermLoanBill.is_bill_closed:
+            if user_loan.loan_status != "COMPLETED":
+                unpaid_bill_ids.extend(
+                    bill_id
+                    for bill_id, in session.query(LedgerLoanData.id).filter(
+                        LedgerLoanData.loan_id == user_loan.id
+                    )
+                )
+        else:
+            unpaid_bill_ids.extend(bill.id for bill in user_loan.get_unpaid_bills())
+
+    # Core inserts don't reach the ORM hook of the instrumentation.
+    set_current_event("daily_dpd_update")
+    events = session.execute(
+        LedgerTriggerEvent.__table__.insert()
+        .values(
+            [
+                {
+                    "name": "daily_dpd_update",
+                    "loan_id": loan_id,
+                    "post_date": post_date,
+                    "extra_details": {},
+                }
+                for loan_id in loan_ids
+            ]
+        )
+        .returning(LedgerTriggerEvent.id, LedgerTriggerEvent.loan_id)
+    ).fetchall()
+    event_ids_by_loan = {loan_id: event_id for event_id, loan_id in events}
+
+    # Emi dpd only ever goes up with the daily update.
+    session.query(LoanSchedule).filter(
+        LoanSchedule.loan_id.in_(loan_ids),
+        LoanSchedule.bill_id.is_(None),
+        LoanSchedule.remaining_amount != 0,
+        event_date - LoanSchedule.due_date >= LoanSchedule.dpd,
+    ).update({LoanSchedule.dpd: event_date - LoanSchedule.due_date}, synchronize_session=False)
+
+    session.execute(
+        insert_bulk_event_dpd_query,
+        params={
+            "loan_ids": loan_ids,
+            "event_ids": [event_ids_by_loan[loan_id] for loan_id in loan_ids],
+            "event_date": event_date,
+            "now": now,
+            "max_balance_loan_ids": max_balance_loan_ids,
+            "unpaid_bill_ids": unpaid_bill_ids,
+        },
+    )
+    session.execute(update_bulk_loan_dpd_query, params={"loan_ids": loan_ids, "event_date": event_date})
+
+    chunk_loan_ids = set(loan_ids)
+    for instance in list(session.identity_map.values()):
+        if isinstance(instance, Loan) and instance.id in chunk_loan_ids:
+            session.expire(instance, ["dpd", "ever_dpd"])
+        elif isinstance(instance, LoanSchedule) and instance.loan_id in chunk_loan_ids:
+            session.expire(instance, ["dpd"])
+
+
 def create_journal_entry(
     session,
     voucher_type,
@@ -290,7 +595,7 @@ def create_journal_entry(
     loan_id,
     user_id,
 ):
-    entry = JournalEntry(
+    values = dict(
         voucher_type=voucher_type,
         date_ledger=date_ledger,
         ledger=ledger,
@@ -306,8 +611,13 @@ def create_journal_entry(
         loan_id=loan_id,
         user_id=user_id,
     )
+    # process_journal_entry_outbox collects the rows and inserts them together.
+    journal_entry_batch = session.info.get("journal_entry_batch")
+    if journal_entry_batch is not None:
+        journal_entry_batch.append(values)
+        return None
+    entry = JournalEntry(**values)
     session.add(entry)
-    session.flush()
     return entry
 
 
@@ -380,9 +690,10 @@ def update_journal_entry(
     user_id: Optional[int] = None,
     session: Optional[Session] = None,
 ) -> None:
-
-    from rush.card.utils import is_term_loan_subclass
-
+    """
+    Writes the journal entries of the event. If session.info["defer_journal_entries"] is set, the
+    event is only queued in journal_entry_outbox and process_journal_entry_outbox writes them later.
+    """
     if not session:
         session = user_loan.session
     if not user_id:
@@ -393,27 +704,68 @@ def update_journal_entry(
 
     if not event.amount:  # Don't need 0 amount bills entries.
         return
-    query = """
-        SELECT
-            UPPER(
-                CASE
-                    WHEN (v3_user_documents.text_details_json ->> 'address_type'::text) IS NOT NULL AND length(v3_user_documents.text_details_json ->> 'name'::text) > 3
-                    THEN v3_user_documents.text_details_json ->> 'name'::text
-                    ELSE NULL::text
-                END
-            ) AS aadhar_name
-        FROM v3_user_documents
-        WHERE v3_user_documents.user_id = :user_id AND v3_user_documents.row_status::text = 'active'::text AND v3_user_documents.document_type::text = 'Aadhar'::text
-        AND v3_user_documents.sequence = 1 AND v3_user_documents.verification_status::text = 'APPROVED'::text
+
+    if session.info.get("defer_journal_entries"):
+        session.add(JournalEntryOutbox(event_id=event.id, loan_id=loan_id, user_id=user_id))
+        return
+    _write_journal_entries(session, user_loan, event, user_id, loan_id)
+
+
+def process_journal_entry_outbox(session: Session, batch_size: int = 1000) -> int:
+    """
+    Writes the journal entries of up to batch_size queued events, oldest first, in a single insert.
+    Rows locked by another worker are skipped. Returns the number of events processed.
     """
-    user_name = session.execute(query, {"user_id": user_id}).scalar()
-
-    if not user_name:
-        user_name = (
-            session.query(func.upper(UserData.first_name))
-            .filter(UserData.row_status == "active", UserData.user_id == user_id)
-            .scalar()
-        ) or "John Doe"
+    outbox_rows = (
+        session.query(JournalEntryOutbox)
+        .filter(JournalEntryOutbox.processed_at.is_(None))
+        .order_by(JournalEntryOutbox.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    if not outbox_rows:
+        return 0
+
+    event_ids = [row.event_id for row in outbox_rows]
+    events = {
+        event.id: event
+        for event in session.query(LedgerTriggerEvent).filter(LedgerTriggerEvent.id.in_(event_ids))
+    }
+    loan_ids = {row.loan_id for row in outbox_rows if row.loan_id}
+    user_loans = {}
+    for user_loan in session.query(Loan).filter(Loan.id.in_(loan_ids)):
+        user_loan.prepare(session=session)
+        user_loans[user_loan.id] = user_loan
+
+    resolve_names(session, [row.user_id for row in outbox_rows])
+
+    journal_entries = session.info["journal_entry_batch"] = []
+    processed_at = get_current_ist_time()
+    try:
+        for row in outbox_rows:
+            _write_journal_entries(
+                session, user_loans.get(row.loan_id), events[row.event_id], row.user_id, row.loan_id
+            )
+            row.processed_at = processed_at
+    finally:
+        session.info.pop("journal_entry_batch")
+
+    session.bulk_insert_mappings(JournalEntry, journal_entries)
+    session.flush()
+    return len(outbox_rows)
+
+
+def _write_journal_entries(
+    session: Session,
+    user_loan: Optional[BaseLoan],
+    event: LedgerTriggerEvent,
+    user_id: int,
+    loan_id: Optional[int],
+) -> None:
+    from rush.card.utils import is_term_loan_subclass
+
+    user_name = resolve_name(session, user_id)
 
     is_term_loan = is_term_loan_subclass(user_loan=user_loan)
     if event.name == "card_transaction" or event.name == "disbursal":
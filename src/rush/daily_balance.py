@@ -0,0 +1,77 @@
+from pendulum import Date
+from sqlalchemy.orm import Session
+
+# Books which had an entry posted on the day get a snapshot of their balance at the end of it.
+# Snapshots of earlier days stay valid for books with no activity, the insert trigger keeps
+# them up to date when entries get backdated.
+snapshot_daily_balances_query = """
+with touched_books as (
+  select
+    le.debit_account as book_account_id
+  from
+    ledger_entry le
+    join ledger_trigger_event lte on lte.id = le.event_id
+  where
+    lte.post_date >= :balance_date
+    and lte.post_date < :balance_date + interval '1 day'
+  union
+  select
+    le.credit_account
+  from
+    ledger_entry le
+    join ledger_trigger_event lte on lte.id = le.event_id
+  where
+    lte.post_date >= :balance_date
+    and lte.post_date < :balance_date + interval '1 day'
+),
+book_entries as (
+  select
+    le.debit_account as book_account_id,
+    le.id as entry_id,
+    le.debit_account_balance as balance
+  from
+    ledger_entry le
+    join ledger_trigger_event lte on lte.id = le.event_id
+  where
+    le.debit_account in (select book_account_id from touched_books)
+    and lte.post_date < :balance_date + interval '1 day'
+  union all
+  select
+    le.credit_account,
+    le.id,
+    le.credit_account_balance
+  from
+    ledger_entry le
+    join ledger_trigger_event lte on lte.id = le.event_id
+  where
+    le.credit_account in (select book_account_id from touched_books)
+    and lte.post_date < :balance_date + interval '1 day'
+)
+insert into book_account_daily_balance (book_account_id, balance_date, balance, last_entry_id)
+select
+  distinct on (be.book_account_id) be.book_account_id,
+  :balance_date,
+  be.balance,
+  be.entry_id
+from
+  book_entries be
+  join book_account ba on ba.id = be.book_account_id
+where
+  ba.identifier_type != 'lender'
+order by
+  be.book_account_id,
+  be.entry_id desc
+on conflict (book_account_id, balance_date) do update
+set
+  balance = excluded.balance,
+  last_entry_id = excluded.last_entry_id
+"""
+
+
+def snapshot_daily_balances(session: Session, balance_date: Date) -> int:
+    """
+    Daily rollup job. Stores the end of day balance of every book that moved on balance_date.
+    Returns the number of snapshots written.
+    """
+    result = session.execute(snapshot_daily_balances_query, params={"balance_date": balance_date})
+    return result.rowcount
@@ -0,0 +1,157 @@
+import json
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    Optional,
+    TypeVar,
+)
+
+from sqlalchemy import event
+from sqlalchemy.engine import (
+    Connection,
+    Engine,
+)
+from sqlalchemy.orm import Mapper
+
+from rush.models import LedgerTriggerEvent
+
+logger = logging.getLogger(__name__)
+
+NO_EVENT = "no_event"
+
+T = TypeVar("T")
+
+
+class QueryStats:
+    __slots__ = ("query_count", "row_count", "duration")
+
+    def __init__(self) -> None:
+        self.query_count = 0
+        self.row_count = 0
+        self.duration = 0.0
+
+    def add(self, row_count: int, duration: float) -> None:
+        self.query_count += 1
+        self.row_count += row_count
+        self.duration += duration
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "query_count": self.query_count,
+            "row_count": self.row_count,
+            "duration_ms": round(self.duration * 1000, 3),
+        }
+
+
+class OperationStats:
+    """
+    Database load of one top level operation. Queries are attributed to the operation as a whole
+    and to the name of the LedgerTriggerEvent that was inserted last, if any. Events inserted
+    through the ORM are picked up on their own. Code that inserts events with Core statements has
+    to call set_current_event itself, or its queries stay with the event before it.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.total = QueryStats()
+        self.by_event: Dict[str, QueryStats] = {}
+        self.current_event = NO_EVENT
+        self.wall_time = 0.0
+
+    def add_query(self, row_count: int, duration: float) -> None:
+        self.total.add(row_count, duration)
+        event_stats = self.by_event.get(self.current_event)
+        if event_stats is None:
+            event_stats = self.by_event[self.current_event] = QueryStats()
+        event_stats.add(row_count, duration)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "operation": self.name,
+            "wall_time_ms": round(self.wall_time * 1000, 3),
+            **self.total.as_dict(),
+            "events": {name: stats.as_dict() for name, stats in self.by_event.items()},
+        }
+
+
+_current_operation: "ContextVar[Optional[OperationStats]]" = ContextVar("rush_operation", default=None)
+
+
+def get_current_operation() -> Optional[OperationStats]:
+    return _current_operation.get()
+
+
+@contextmanager
+def track_operation(name: str) -> Iterator[OperationStats]:
+    """
+    Collects query count, rows and time for everything run inside the block. A nested call
+    yields the outer operation so the load stays with the top level one. When the
+    rush.instrumentation logger is enabled for INFO a json line is logged per operation.
+    """
+    operation = _current_operation.get()
+    if operation is not None:
+        yield operation
+        return
+
+    operation = OperationStats(name)
+    token = _current_operation.set(operation)
+    start = time.perf_counter()
+    try:
+        yield operation
+    finally:
+        operation.wall_time = time.perf_counter() - start
+        _current_operation.reset(token)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(operation.as_dict()))
+
+
+def instrumented(name: str) -> Callable[[Callable[..., T]], Callable[..., T]]:
+    """Decorator version of track_operation."""
+
+    def decorator(func: Callable[..., T]) -> Callable[..., T]:
+        @wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> T:
+            with track_operation(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def set_current_event(event_name: str) -> None:
+    """Attributes the queries that follow to event_name, within the current operation."""
+    operation = _current_operation.get()
+    if operation is not None:
+        operation.current_event = event_name
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(
+    conn: Connection, cursor: Any, statement: str, parameters: Any, context: Any, executemany: bool
+) -> None:
+    if _current_operation.get() is not None:
+        conn.info["rush_query_start"] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(
+    conn: Connection, cursor: Any, statement: str, parameters: Any, context: Any, executemany: bool
+) -> None:
+    query_start = conn.info.pop("rush_query_start", None)
+    operation = _current_operation.get()
+    if operation is None or query_start is None:
+        return
+    operation.add_query(max(cursor.rowcount, 0), time.perf_counter() - query_start)
+
+
+@event.listens_for(LedgerTriggerEvent, "before_insert")
+def _set_current_event(mapper: Mapper, connection: Connection, target: LedgerTriggerEvent) -> None:
+    set_current_event(target.name)
@@ -0,0 +1,90 @@
+import csv
+import json
+from itertools import islice
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    TextIO,
+)
+
+from dateutil.relativedelta import relativedelta
+from pendulum import Date
+from sqlalchemy.orm import Session
+
+from rush.models import (
+    JournalEntry,
+    LedgerTriggerEvent,
+)
+
+JOURNAL_EXPORT_COLUMNS = (
+    JournalEntry.id,
+    JournalEntry.voucher_type,
+    JournalEntry.date_ledger,
+    JournalEntry.ledger,
+    JournalEntry.alias,
+    JournalEntry.group_name,
+    JournalEntry.debit,
+    JournalEntry.credit,
+    JournalEntry.narration,
+    JournalEntry.instrument_date,
+    JournalEntry.sort_order,
+    JournalEntry.ptype,
+    JournalEntry.loan_id,
+    JournalEntry.user_id,
+    JournalEntry.event_id,
+    LedgerTriggerEvent.name.label("event_name"),
+    LedgerTriggerEvent.post_date.label("event_post_date"),
+)
+JOURNAL_EXPORT_FIELDS = [column.key for column in JOURNAL_EXPORT_COLUMNS]
+
+
+def iter_journal_entries(
+    session: Session, from_date: Date, to_date: Date, batch_size: int = 5000
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Active journal entries with date_ledger between from_date and to_date, both inclusive, along
+    with their event. Rows are read through a server side cursor and yielded in batches of
+    batch_size so memory stays the same whatever the size of the range.
+    """
+    query = (
+        session.query(*JOURNAL_EXPORT_COLUMNS)
+        .join(LedgerTriggerEvent, LedgerTriggerEvent.id == JournalEntry.event_id)
+        .filter(
+            JournalEntry.row_status == "active",
+            JournalEntry.date_ledger >= from_date,
+            JournalEntry.date_ledger < to_date + relativedelta(days=1),
+        )
+        .order_by(JournalEntry.date_ledger, JournalEntry.id)
+        .execution_options(stream_results=True)
+        .yield_per(batch_size)
+    )
+    rows = iter(query)
+    while True:
+        batch = [row._asdict() for row in islice(rows, batch_size)]
+        if not batch:
+            return
+        yield batch
+
+
+def export_journal_entries_csv(
+    session: Session, from_date: Date, to_date: Date, file: TextIO, batch_size: int = 5000
+) -> int:
+    writer = csv.DictWriter(file, fieldnames=JOURNAL_EXPORT_FIELDS)
+    writer.writeheader()
+    row_count = 0
+    for batch in iter_journal_entries(session, from_date, to_date, batch_size):
+        writer.writerows(batch)
+        row_count += len(batch)
+    return row_count
+
+
+def export_journal_entries_jsonl(
+    session: Session, from_date: Date, to_date: Date, file: TextIO, batch_size: int = 5000
+) -> int:
+    row_count = 0
+    for batch in iter_journal_entries(session, from_date, to_date, batch_size):
+        file.writelines(json.dumps(row, default=str) + "\n" for row in batch)
+        row_count += len(batch)
+    return row_count
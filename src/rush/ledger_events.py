@@ -1,7 +1,8 @@
 from decimal import Decimal
+from itertools import islice
 from typing import Optional
 
-from sqlalchemy import Date
+from pendulum import Date
 from sqlalchemy.orm import Session
 
 from rush.card.base_card import (
@@ -9,9 +10,13 @@ from rush.card.base_card import (
     BaseLoan,
 )
 from rush.ledger_utils import (
+    LedgerBatch,
+    create_ledger_entry,
     create_ledger_entry_from_str,
     get_account_balance_from_str,
+    get_book_account_ids_by_strings,
 )
+from rush.lender_interest import iter_lender_interest_on_portfolio
 from rush.models import (
     CardTransaction,
     Fee,
@@ -19,7 +24,6 @@ from rush.models import (
     LedgerTriggerEvent,
     Loan,
 )
-from rush.recon.dmi_interest_on_portfolio import interest_on_dmi_portfolio
 from rush.utils import get_gst_split_from_amount
 
 
@@ -219,21 +223,36 @@ def accrue_interest_event(
     )
 
 
+LENDER_INTEREST_CHUNK_SIZE = 5000
+
+
 def lender_interest_incur_event(
     session: Session, from_date: Date, to_date: Date, event: LedgerTriggerEvent
 ) -> None:
-    interest_on_each_card = session.execute(
-        interest_on_dmi_portfolio, params={"from_date": from_date, "to_date": to_date}
-    )
-    for loan_id, interest_to_incur in interest_on_each_card:
-        create_ledger_entry_from_str(
+    interest_on_each_card = iter_lender_interest_on_portfolio(session, from_date, to_date)
+    # Books are resolved and entries inserted a chunk of loans at a time.
+    while True:
+        chunk = list(islice(interest_on_each_card, LENDER_INTEREST_CHUNK_SIZE))
+        if not chunk:
+            break
+        book_ids = get_book_account_ids_by_strings(
             session,
-            event_id=event.id,
-            debit_book_str=f"{loan_id}/loan/lender_interest/e",
-            credit_book_str=f"{loan_id}/loan/lender_payable/l",
-            amount=interest_to_incur,
+            [
+                f"{loan_id}/loan/{book}"
+                for loan_id, _ in chunk
+                for book in ("lender_interest/e", "lender_payable/l")
+            ],
         )
-        event.amount += interest_to_incur
+        with LedgerBatch(session):
+            for loan_id, interest_to_incur in chunk:
+                create_ledger_entry(
+                    session,
+                    event_id=event.id,
+                    debit_book_id=book_ids[f"{loan_id}/loan/lender_interest/e"],
+                    credit_book_id=book_ids[f"{loan_id}/loan/lender_payable/l"],
+                    amount=interest_to_incur,
+                )
+        event.amount += sum(interest_to_incur for _, interest_to_incur in chunk)
 
 
 def customer_refund_event(
@@ -1,25 +1,156 @@
 from decimal import Decimal
+from types import TracebackType
 from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
     Optional,
+    Set,
     Tuple,
+    Type,
 )
 
 import sqlalchemy
 from pendulum import DateTime
 from sqlalchemy import (
+    and_,
+    case,
     cast,
+    event,
     func,
+    or_,
+    tuple_,
 )
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.session import SessionTransaction
 
 from rush.models import (
     BookAccount,
     LedgerLoanData,
     LedgerTriggerEvent,
+    Loan,
     NewLedgerEntry,
     get_or_create,
 )
 
+BookAccountKey = Tuple[int, str, str, str]
+
+
+class BookAccountCache:
+    """
+    Book account ids resolved within a session. Keyed by
+    (identifier, identifier_type, book_name, account_type).
+    """
+
+    def __init__(self) -> None:
+        self.book_ids: Dict[BookAccountKey, int] = {}
+        self.prefetched_loan_ids: Set[int] = set()
+
+    def add(self, book_account: BookAccount) -> None:
+        key = (
+            book_account.identifier,
+            book_account.identifier_type,
+            book_account.book_name,
+            book_account.account_type,
+        )
+        self.book_ids[key] = book_account.id
+
+
+def get_book_account_cache(session: Session) -> BookAccountCache:
+    cache = session.info.get("book_account_cache")
+    if cache is None:
+        cache = session.info["book_account_cache"] = BookAccountCache()
+    return cache
+
+
+@event.listens_for(Session, "after_transaction_create")
+def _flush_ledger_batch_before_savepoint(session: Session, transaction: SessionTransaction) -> None:
+    # Like the session's own flush at begin_nested. Entries queued so far go to the enclosing
+    # transaction, so rolling the savepoint back only drops the ones queued inside it.
+    if transaction.nested:
+        flush_ledger_batch(session)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _clear_ledger_state_on_rollback(session: Session, previous_transaction: SessionTransaction) -> None:
+    # Rolled back rows may still be in the cache. Drop everything, it gets warmed again.
+    session.info.pop("book_account_cache", None)
+    batch = session.info.get("ledger_batch")
+    if batch is not None:
+        # Anything pending was queued after the rolled back transaction or savepoint began.
+        batch.entries.clear()
+
+
+class LedgerBatch:
+    """
+    Collects the ledger entries written within the block and inserts them with a single
+    multi-row INSERT. balance_insert_trigger still runs for every row in insertion order, so
+    the running balances come out the same as with one flush per entry.
+
+    Pending entries are written before commit and by the ledger reads in this package, which
+    call flush_ledger_batch first. Any other read of ledger_entry or balances inside the block
+    has to call it too.
+    """
+
+    def __init__(self, session: Session) -> None:
+        self.session = session
+        self.entries: List[Dict[str, Any]] = []
+        self._is_outermost = False
+
+    def __enter__(self) -> "LedgerBatch":
+        outer_batch = self.session.info.get("ledger_batch")
+        if outer_batch is not None:
+            # Nested blocks share the outer batch.
+            return outer_batch
+        self._is_outermost = True
+        self.session.info["ledger_batch"] = self
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        if not self._is_outermost:
+            return
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self.session.info.pop("ledger_batch", None)
+            self.entries.clear()
+
+    def add(self, event_id: int, debit_book_id: int, credit_book_id: int, amount: Decimal) -> None:
+        self.entries.append(
+            {
+                "event_id": event_id,
+                "debit_account": debit_book_id,
+                "credit_account": credit_book_id,
+                "amount": amount,
+            }
+        )
+
+    def flush(self) -> None:
+        if not self.entries:
+            return
+        entries, self.entries = self.entries, []
+        self.session.execute(NewLedgerEntry.__table__.insert().values(entries))
+
+
+def flush_ledger_batch(session: Session) -> None:
+    """Writes the entries of an open LedgerBatch so that reads see them."""
+    batch = session.info.get("ledger_batch")
+    if batch is not None:
+        batch.flush()
+
+
+@event.listens_for(Session, "before_commit")
+def _flush_ledger_batch_before_commit(session: Session) -> None:
+    flush_ledger_batch(session)
+
 
 def create_ledger_entry(
     session: Session,
@@ -27,7 +158,12 @@ def create_ledger_entry(
     debit_book_id: int,
     credit_book_id: int,
     amount: Decimal,
-) -> NewLedgerEntry:
+) -> Optional[NewLedgerEntry]:
+    batch = session.info.get("ledger_batch")
+    if batch is not None:
+        batch.add(event_id, debit_book_id, credit_book_id, amount)
+        return None
+
     entry = NewLedgerEntry(
         event_id=event_id,
         debit_account=debit_book_id,
@@ -45,10 +181,10 @@ def create_ledger_entry_from_str(
     debit_book_str: str,
     credit_book_str: str,
     amount: Decimal,
-) -> NewLedgerEntry:
-    debit_account = get_book_account_by_string(session, book_string=debit_book_str)
-    credit_account = get_book_account_by_string(session, book_string=credit_book_str)
-    return create_ledger_entry(session, event_id, debit_account.id, credit_account.id, amount)
+) -> Optional[NewLedgerEntry]:
+    debit_book_id = get_book_account_id_by_string(session, book_string=debit_book_str)
+    credit_book_id = get_book_account_id_by_string(session, book_string=credit_book_str)
+    return create_ledger_entry(session, event_id, debit_book_id, credit_book_id, amount)
 
 
 def get_account_balance_from_str(
@@ -58,6 +194,7 @@ def get_account_balance_from_str(
     from_date: Optional[DateTime] = None,
     event_id: Optional[int] = None,
 ) -> Tuple[int, Decimal]:
+    flush_ledger_batch(session)
     book_variables = breakdown_account_variables_from_str(book_string)
     func_call = None
     is_lender_account = book_variables["identifier_type"] == "lender"
@@ -116,6 +253,72 @@ def get_account_balance_from_str(
     return 0, Decimal(account_balance)
 
 
+def get_account_balances(
+    session: Session,
+    book_strings: Iterable[str],
+    to_date: Optional[DateTime] = None,
+    event_id: Optional[int] = None,
+) -> Dict[str, Decimal]:
+    """
+    Balances of any number of books in a single query, keyed by book string. Same semantics as
+    get_account_balance_from_str. Books which don't exist yet have a balance of 0.
+    """
+    balances = {book_string: Decimal(0) for book_string in book_strings}
+    if not balances:
+        return balances
+    flush_ledger_batch(session)
+
+    book_keys = {}
+    for book_string in balances:
+        book_variables = breakdown_account_variables_from_str(book_string)
+        key = (
+            book_variables["identifier"],
+            book_variables["identifier_type"],
+            book_variables["name"],
+            book_variables["account_type"],
+        )
+        book_keys[key] = book_string
+
+    if event_id or to_date:
+        lender_balance = func.get_lender_account_balance(
+            BookAccount.identifier,
+            BookAccount.book_name,
+            BookAccount.account_type,
+            cast(to_date, sqlalchemy.TIMESTAMP),
+        )
+        book_balance = func.get_account_balance_by_book_id(
+            BookAccount.id, cast(to_date, sqlalchemy.TIMESTAMP), cast(event_id, sqlalchemy.Integer)
+        )
+    else:
+        lender_balance = func.get_lender_account_balance(
+            BookAccount.identifier, BookAccount.book_name, BookAccount.account_type
+        )
+        book_balance = BookAccount.balance
+
+    book_accounts = (
+        session.query(
+            BookAccount.identifier,
+            BookAccount.identifier_type,
+            BookAccount.book_name,
+            BookAccount.account_type,
+            case([(BookAccount.identifier_type == "lender", lender_balance)], else_=book_balance),
+        )
+        .filter(
+            tuple_(
+                BookAccount.identifier,
+                BookAccount.identifier_type,
+                BookAccount.book_name,
+                BookAccount.account_type,
+            ).in_(list(book_keys))
+        )
+        .all()
+    )
+    for identifier, identifier_type, book_name, account_type, balance in book_accounts:
+        book_string = book_keys[(identifier, identifier_type, book_name, account_type)]
+        balances[book_string] = Decimal(balance or 0)
+    return balances
+
+
 def breakdown_account_variables_from_str(book_string: str) -> dict:
     identifier, identifier_type, name, account_type = book_string.split("/")
     assert account_type in ("a", "l", "r", "e", "ca")
@@ -147,9 +350,136 @@ def get_book_account_by_string(session: Session, book_string: str) -> BookAccoun
         book_name=book_variables["name"],
         account_type=book_variables["account_type"],
     )
+    get_book_account_cache(session).add(book_account)
     return book_account
 
 
+def get_book_account_id_by_string(session: Session, book_string: str) -> int:
+    book_variables = breakdown_account_variables_from_str(book_string)
+    key = (
+        book_variables["identifier"],
+        book_variables["identifier_type"],
+        book_variables["name"],
+        book_variables["account_type"],
+    )
+    book_id = get_book_account_cache(session).book_ids.get(key)
+    if book_id is None:
+        book_id = get_book_account_by_string(session, book_string=book_string).id
+    return book_id
+
+
+def get_book_account_ids_by_strings(session: Session, book_strings: Iterable[str]) -> Dict[str, int]:
+    """
+    Ids of many book accounts, creating the ones that don't exist. Books missing from the session's
+    cache are read in one query and the rest are inserted in one statement, on conflict skipping the
+    ones created concurrently. Existing books aren't written to.
+    """
+    cache = get_book_account_cache(session)
+    keys: Dict[str, BookAccountKey] = {}
+    for book_string in book_strings:
+        book_variables = breakdown_account_variables_from_str(book_string)
+        keys[book_string] = (
+            book_variables["identifier"],
+            book_variables["identifier_type"],
+            book_variables["name"],
+            book_variables["account_type"],
+        )
+
+    key_columns = (
+        BookAccount.identifier,
+        BookAccount.identifier_type,
+        BookAccount.book_name,
+        BookAccount.account_type,
+    )
+    key_column_names = ["identifier", "identifier_type", "book_name", "account_type"]
+
+    def load_book_accounts(missing_keys: Set[BookAccountKey]) -> Set[BookAccountKey]:
+        book_accounts = session.query(BookAccount.id, *key_columns).filter(
+            tuple_(*key_columns).in_(missing_keys)
+        )
+        for book_account in book_accounts:
+            cache.add(book_account)
+        return missing_keys - cache.book_ids.keys()
+
+    missing_keys = {key for key in keys.values() if key not in cache.book_ids}
+    if missing_keys:
+        missing_keys = load_book_accounts(missing_keys)
+    if missing_keys:
+        book_account_table = BookAccount.__table__
+        new_book_accounts = (
+            insert(book_account_table)
+            .values(
+                [
+                    {
+                        "identifier": identifier,
+                        "identifier_type": identifier_type,
+                        "book_name": book_name,
+                        "account_type": account_type,
+                    }
+                    for identifier, identifier_type, book_name, account_type in sorted(missing_keys)
+                ]
+            )
+            .on_conflict_do_nothing(index_elements=key_column_names)
+            .returning(
+                book_account_table.c.id, *(book_account_table.c[name] for name in key_column_names)
+            )
+        )
+        for book_account in session.execute(new_book_accounts):
+            cache.add(book_account)
+        missing_keys -= cache.book_ids.keys()
+    if missing_keys:  # Created by another transaction after the read.
+        load_book_accounts(missing_keys)
+    return {book_string: cache.book_ids[key] for book_string, key in keys.items()}
+
+
+def prefetch_book_accounts(session: Session, user_loan: Loan) -> None:
+    """
+    Warm the session's book account cache with every book of the loan, its bills, its lender and
+    its user in a single query.
+    """
+    prefetch_book_accounts_for_loans(session, [user_loan])
+
+
+def prefetch_book_accounts_for_loans(session: Session, user_loans: List[Loan]) -> None:
+    cache = get_book_account_cache(session)
+    user_loans = [user_loan for user_loan in user_loans if user_loan.id not in cache.prefetched_loan_ids]
+    if not user_loans:
+        return
+
+    loan_ids = {user_loan.id for user_loan in user_loans}
+    bill_ids = session.query(LedgerLoanData.id).filter(LedgerLoanData.loan_id.in_(loan_ids)).subquery()
+    book_accounts = (
+        session.query(
+            BookAccount.id,
+            BookAccount.identifier,
+            BookAccount.identifier_type,
+            BookAccount.book_name,
+            BookAccount.account_type,
+        )
+        .filter(
+            or_(
+                and_(
+                    BookAccount.identifier_type.in_(("loan", "card")),
+                    BookAccount.identifier.in_(loan_ids),
+                ),
+                and_(BookAccount.identifier_type == "bill", BookAccount.identifier.in_(bill_ids)),
+                and_(
+                    BookAccount.identifier_type == "lender",
+                    BookAccount.identifier.in_({user_loan.lender_id for user_loan in user_loans}),
+                ),
+                and_(
+                    BookAccount.identifier_type == "user",
+                    BookAccount.identifier.in_({user_loan.user_id for user_loan in user_loans}),
+                ),
+            )
+        )
+        .all()
+    )
+    for book_account in book_accounts:
+        cache.add(book_account)
+    cache.prefetched_loan_ids.update(loan_ids)
+
+
 def is_bill_closed(session: Session, bill: LedgerLoanData, to_date: Optional[DateTime] = None) -> bool:
     # Check if max balance is zero. If not, return false.
     _, max_balance = get_account_balance_from_str(
@@ -161,6 +491,7 @@ def is_bill_closed(session: Session, bill: LedgerLoanData, to_date: Optional[Dat
 
 
 def reverse_event(session: Session, event_to_reverse: LedgerTriggerEvent, event: LedgerTriggerEvent):
+    flush_ledger_batch(session)
     ledger_entries = (
         session.query(NewLedgerEntry).filter(NewLedgerEntry.event_id == event_to_reverse.id).all()
     )
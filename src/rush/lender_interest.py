@@ -1,5 +1,23 @@
-from decimal import Decimal
+from datetime import (
+    date,
+    datetime,
+    time,
+    timedelta,
+)
+from decimal import (
+    ROUND_HALF_UP,
+    Decimal,
+)
+from itertools import groupby
+from operator import itemgetter
+from typing import (
+    Iterator,
+    List,
+    Tuple,
+)
 
+from pendulum import Date
+from sqlalchemy import text
 from sqlalchemy.orm import Session
 
 from rush.models import LedgerLoanData
@@ -8,6 +26,131 @@ from rush.utils import (
     mul,
 )
 
+CHANGE_DATE_ROW, LEDGER_ENTRY_ROW = 0, 1
+
+# One ordered stream per loan: the dates its lender payable changed on in the period, then its
+# lender payable entries with the running balance of the book. Entries before the period are only
+# needed for the opening balance, so of those just the latest one is read.
+lender_payable_stream_query = text(
+    """
+with change_dates as (
+  select distinct
+    lte.loan_id,
+    lte.post_date :: date as change_date,
+    l.lender_rate_of_interest_annual
+  from
+    ledger_trigger_event lte
+    join v3_loans l on l.id = lte.loan_id
+  where
+    lte.name in ('card_transaction', 'payment_settled', 'merchant_refund')
+    and lte.post_date :: date >= :from_date
+    and lte.post_date :: date <= :to_date
+),
+lender_payable_books as (
+  select
+    ba.id,
+    ba.identifier as loan_id
+  from
+    book_account ba
+  where
+    ba.identifier_type = 'loan'
+    and ba.book_name = 'lender_payable'
+    and ba.account_type = 'l'
+    and ba.identifier in (select loan_id from change_dates)
+),
+-- Latest entry before the period by id, same as get_account_balance_by_book_id.
+opening_entries as (
+  select distinct on (book_id)
+    loan_id,
+    post_date,
+    entry_id,
+    balance
+  from (
+    select
+      b.id as book_id,
+      b.loan_id,
+      lte.post_date,
+      le.id as entry_id,
+      le.debit_account_balance as balance
+    from
+      ledger_entry le
+      join lender_payable_books b on b.id = le.debit_account
+      join ledger_trigger_event lte on lte.id = le.event_id
+    where
+      lte.post_date < :from_date
+    union all
+    select
+      b.id,
+      b.loan_id,
+      lte.post_date,
+      le.id,
+      le.credit_account_balance
+    from
+      ledger_entry le
+      join lender_payable_books b on b.id = le.credit_account
+      join ledger_trigger_event lte on lte.id = le.event_id
+    where
+      lte.post_date < :from_date
+  ) entries
+  order by
+    book_id,
+    entry_id desc
+)
+select * from (
+  select
+    loan_id,
+    0 as row_type,
+    change_date :: timestamp as post_date,
+    null :: integer as entry_id,
+    lender_rate_of_interest_annual as value
+  from
+    change_dates
+  union all
+  select
+    loan_id,
+    1,
+    post_date,
+    entry_id,
+    balance
+  from
+    opening_entries
+  union all
+  select
+    b.loan_id,
+    1,
+    lte.post_date,
+    le.id,
+    le.debit_account_balance
+  from
+    ledger_entry le
+    join lender_payable_books b on b.id = le.debit_account
+    join ledger_trigger_event lte on lte.id = le.event_id
+  where
+    lte.post_date >= :from_date
+    and lte.post_date < :to_date + interval '1 day'
+  union all
+  select
+    b.loan_id,
+    1,
+    lte.post_date,
+    le.id,
+    le.credit_account_balance
+  from
+    ledger_entry le
+    join lender_payable_books b on b.id = le.credit_account
+    join ledger_trigger_event lte on lte.id = le.event_id
+  where
+    lte.post_date >= :from_date
+    and lte.post_date < :to_date + interval '1 day'
+) rows
+order by
+  loan_id,
+  row_type,
+  post_date,
+  entry_id
+"""
+)
+
 
 def lender_interest(session: Session, amount: Decimal, loan_id: int) -> Decimal:
     lender_interest_rate = (
@@ -15,7 +158,74 @@ def lender_interest(session: Session, amount: Decimal, loan_id: int) -> Decimal:
         .filter(LedgerLoanData.loan_id == loan_id)
         .limit(1)
         .scalar()
-        or 0
     )
-    amount = div(mul(lender_interest_rate, amount), 36500)
+    amount = div(mul(lender_interest_rate or Decimal(0), amount), 36500)
     return amount
+
+
+def _round(amount: Decimal) -> Decimal:
+    return amount.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+
+
+def _get_loan_lender_interest(
+    rate_of_interest_annual: Decimal,
+    change_dates: List[date],
+    entries: List[Tuple[datetime, int, Decimal]],
+    from_date: date,
+    to_date: date,
+) -> Decimal:
+    """
+    Interest on the lender payable of one loan. The period is split at every change date, starting
+    a day before from_date to charge the first day too. Each part earns daily compounded interest
+    on the balance at the end of its first day plus the interest of the part before it.
+    entries are (post_date, entry id, running balance) ordered by post_date.
+    """
+    per_day_interest = 1 + rate_of_interest_annual / 100 / 365
+    dates = [from_date - timedelta(days=1)] + change_dates
+    balance, latest_entry_id, next_entry = Decimal(0), 0, 0
+    total_interest = previous_interest = Decimal(0)
+    for index, change_date in enumerate(dates):
+        # Balance of the latest entry posted by the end of the day, same as get_account_balance.
+        end_of_day = datetime.combine(change_date, time(23, 59, 59))
+        while next_entry < len(entries) and entries[next_entry][0] <= end_of_day:
+            _, entry_id, entry_balance = entries[next_entry]
+            if entry_id > latest_entry_id:
+                latest_entry_id, balance = entry_id, entry_balance
+            next_entry += 1
+
+        next_date = dates[index + 1] if index + 1 < len(dates) else to_date
+        balance_with_interest = balance + previous_interest
+        interest = _round(
+            balance_with_interest * per_day_interest ** (next_date - change_date).days
+            - balance_with_interest
+        )
+        total_interest += interest
+        previous_interest = interest
+    return _round(total_interest)
+
+
+def iter_lender_interest_on_portfolio(
+    session: Session, from_date: Date, to_date: Date
+) -> Iterator[Tuple[int, Decimal]]:
+    """
+    Lender interest to incur per loan for the period. Reads one ordered stream of lender payable
+    changes through a server side cursor and yields (loan_id, interest) as each loan is done, so
+    memory is bound by the largest loan and not by the portfolio.
+    """
+    rows = session.execute(
+        lender_payable_stream_query.execution_options(stream_results=True),
+        {"from_date": from_date, "to_date": to_date},
+    )
+    for loan_id, loan_rows in groupby(rows, key=itemgetter(0)):
+        rate_of_interest_annual = Decimal(0)
+        change_dates = []
+        entries = []
+        for _, row_type, post_date, entry_id, value in loan_rows:
+            if row_type == CHANGE_DATE_ROW:
+                rate_of_interest_annual = value or Decimal(0)
+                change_dates.append(post_date.date())
+            else:
+                entries.append((post_date, entry_id, value))
+        yield loan_id, _get_loan_lender_interest(
+            rate_of_interest_annual, change_dates, entries, from_date, to_date
+        )
@@ -1,15 +1,30 @@
+import os
+import threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from decimal import Decimal
-from typing import List
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
 from dateutil.relativedelta import relativedelta
 from pendulum import datetime
 from sqlalchemy import (
     and_,
     func,
+    select,
+)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import (
+    Session,
+    sessionmaker,
 )
-from sqlalchemy.orm import Session
 
 from rush.card import get_user_loan
 from rush.card.base_card import (
@@ -30,43 +45,54 @@ from rush.models import (
 
 
 def group_bills(user_loan: BaseLoan):
+    """
+    Sums up the bill emis of every due date into the loan level emi of that date, creating the ones
+    that don't exist yet. Done in a single upsert on idx_uniq_on_loan_id_due_date_loan_schedule.
+    """
     session = user_loan.session
+    session.flush()  # Bill emis may still be pending and a core statement doesn't autoflush.
     cumulative_values_query = (
-        session.query(
-            LoanSchedule.due_date,
-            func.sum(LoanSchedule.principal_due).label("principal_due"),
-            func.sum(LoanSchedule.interest_due).label("interest_due"),
-            func.sum(LoanSchedule.total_closing_balance).label("total_closing_balance"),
+        select(
+            [
+                LoanSchedule.loan_id,
+                func.row_number().over(order_by=LoanSchedule.due_date).label("emi_number"),
+                LoanSchedule.due_date,
+                func.sum(LoanSchedule.principal_due).label("principal_due"),
+                func.sum(LoanSchedule.interest_due).label("interest_due"),
+                func.sum(LoanSchedule.total_closing_balance).label("total_closing_balance"),
+            ]
         )
-        .filter(
-            LoanSchedule.loan_id == user_loan.loan_id,
-            LoanSchedule.bill_id.isnot(None),
-        )
-        .group_by(LoanSchedule.due_date)
-    ).subquery()
-    q_results = (
-        session.query(cumulative_values_query, LoanSchedule.id)
-        .join(
-            LoanSchedule,
+        .where(
             and_(
                 LoanSchedule.loan_id == user_loan.loan_id,
-                LoanSchedule.due_date == cumulative_values_query.c.due_date,
-                LoanSchedule.bill_id.is_(None),
-            ),
-            isouter=True,
+                LoanSchedule.bill_id.isnot(None),
+            )
         )
-        .order_by(cumulative_values_query.c.due_date)
-        .all()
+        .group_by(LoanSchedule.loan_id, LoanSchedule.due_date)
     )
-    for emi_number, cumulative_values in enumerate(q_results, 1):
-        cumulative_values_dict = cumulative_values._asdict()
-        emi_id = cumulative_values.id
-        if emi_id:  # If emi id is present then we update the record.
-            session.query(LoanSchedule).filter_by(id=emi_id).update(cumulative_values_dict)
-        else:
-            _ = LoanSchedule.ledger_new(
-                session, loan_id=user_loan.loan_id, emi_number=emi_number, **cumulative_values_dict
-            )
+    upsert = insert(LoanSchedule.__table__).from_select(
+        ["loan_id", "emi_number", "due_date", "principal_due", "interest_due", "total_closing_balance"],
+        cumulative_values_query,
+    )
+    # The emi number of an existing emi is kept, same as its payment details.
+    upsert = upsert.on_conflict_do_update(
+        index_elements=[LoanSchedule.loan_id, LoanSchedule.due_date],
+        index_where=LoanSchedule.bill_id.is_(None),
+        set_={
+            "principal_due": upsert.excluded.principal_due,
+            "interest_due": upsert.excluded.interest_due,
+            "total_closing_balance": upsert.excluded.total_closing_balance,
+        },
+    )
+    session.execute(upsert)
+
+    for instance in list(session.identity_map.values()):
+        if (
+            isinstance(instance, LoanSchedule)
+            and instance.loan_id == user_loan.loan_id
+            and instance.bill_id is None
+        ):
+            session.expire(instance, ["principal_due", "interest_due", "total_closing_balance"])
 
 
 def create_bill_schedule(session: Session, user_loan: BaseLoan, bill: BaseBill):
@@ -119,45 +145,72 @@ def create_bill_schedule(session: Session, user_loan: BaseLoan, bill: BaseBill):
     readjust_future_payment(user_loan, bill.table.bill_close_date)
 
 
-def slide_payment_to_emis(
-    user_loan: BaseLoan, payment_event: LedgerTriggerEvent, amount_to_slide: Decimal
-):
+def _slide_payment_to_emis(
+    emis: List[LoanSchedule], payment_date: datetime, amount_to_slide: Decimal
+) -> Dict[int, Decimal]:
     """
-    Settles a payment into loan's emi schedule.
-    Also creates a payment split at emi level.
+    Settles the amount into the emis, in the given order, skipping the settled ones. Only the emi
+    objects are changed. Returns the amount settled per emi id.
     """
-    unpaid_emis = user_loan.get_loan_schedule(only_unpaid_emis=True)
-    for emi in unpaid_emis:
+    amounts_slid = {}
+    for emi in emis:
         if amount_to_slide <= 0:
             break
+        if emi.remaining_amount == 0:
+            continue
         amount_slid = min(emi.remaining_amount, amount_to_slide)
         emi.payment_received += amount_slid
         if emi.can_mark_emi_paid():
             emi.payment_status = "Paid"
-        emi.last_payment_date = payment_event.post_date
+        emi.last_payment_date = payment_date
         emi.dpd = (emi.last_payment_date.date() - emi.due_date).days
+        amounts_slid[emi.id] = amount_slid
+        amount_to_slide -= amount_slid
+    return amounts_slid
 
-        mapping: PaymentMapping = (
-            user_loan.session.query(PaymentMapping)
-            .filter(
-                PaymentMapping.emi_id == emi.id,
-                PaymentMapping.payment_request_id == payment_event.extra_details["payment_request_id"],
-                PaymentMapping.row_status == "active",
-            )
-            .scalar()
-        )
 
-        if mapping:
-            mapping.amount_settled += amount_slid
-        else:
-            _ = PaymentMapping.ledger_new(
-                user_loan.session,
-                payment_request_id=payment_event.extra_details["payment_request_id"],
-                emi_id=emi.id,
-                amount_settled=amount_slid,
-            )
+def _upsert_payment_mappings(session: Session, amounts: Dict[Tuple[str, int], Decimal]) -> None:
+    """
+    Adds the amounts, keyed by (payment_request_id, emi_id), to the active payment mappings in a
+    single upsert on idx_uniq_on_row_status_emi_payment_mapping.
+    """
+    if not amounts:
+        return
+    session.flush()  # A core statement doesn't autoflush pending mappings.
+    mapping_table = PaymentMapping.__table__
+    upsert = insert(mapping_table).values(
+        [
+            {"payment_request_id": payment_request_id, "emi_id": emi_id, "amount_settled": amount}
+            for (payment_request_id, emi_id), amount in amounts.items()
+        ]
+    )
+    upsert = upsert.on_conflict_do_update(
+        index_elements=[mapping_table.c.payment_request_id, mapping_table.c.emi_id],
+        index_where=mapping_table.c.row_status == "active",
+        set_={"amount_settled": mapping_table.c.amount_settled + upsert.excluded.amount_settled},
+    )
+    session.execute(upsert)
 
-        amount_to_slide -= amount_slid
+    emi_ids = {emi_id for _, emi_id in amounts}
+    for instance in list(session.identity_map.values()):
+        if isinstance(instance, PaymentMapping) and instance.emi_id in emi_ids:
+            session.expire(instance, ["amount_settled"])
+
+
+def slide_payment_to_emis(
+    user_loan: BaseLoan, payment_event: LedgerTriggerEvent, amount_to_slide: Decimal
+):
+    """
+    Settles a payment into loan's emi schedule.
+    Also creates a payment split at emi level.
+    """
+    unpaid_emis = user_loan.get_loan_schedule(only_unpaid_emis=True)
+    amounts_slid = _slide_payment_to_emis(unpaid_emis, payment_event.post_date, amount_to_slide)
+    payment_request_id = payment_event.extra_details["payment_request_id"]
+    _upsert_payment_mappings(
+        user_loan.session,
+        {(payment_request_id, emi_id): amount_slid for emi_id, amount_slid in amounts_slid.items()},
+    )
 
 
 def close_loan(user_loan: BaseLoan, last_payment_date: datetime):
@@ -342,7 +395,53 @@ def readjust_future_payment(user_loan: BaseLoan, date_to_check_after: date):
             )
 
 
+def _get_payments_to_replay(
+    session: Session, loan_ids: List[int]
+) -> Dict[int, List[Tuple[LedgerTriggerEvent, Decimal]]]:
+    """Payment events of the loans with the amount they settled in the schedule, in event order."""
+    amount_to_slide_per_event = (
+        session.query(LedgerTriggerEvent, func.sum(PaymentSplit.amount_settled))
+        .filter(
+            PaymentSplit.payment_request_id
+            == LedgerTriggerEvent.extra_details["payment_request_id"].astext,
+            PaymentSplit.component.in_(("principal", "interest", "unbilled")),
+            LedgerTriggerEvent.name == "payment_received",
+            LedgerTriggerEvent.loan_id.in_(loan_ids),
+        )
+        .group_by(LedgerTriggerEvent.id)
+        .order_by(LedgerTriggerEvent.id)
+        .all()
+    )
+    payments = defaultdict(list)
+    for payment_event, amount_to_slide in amount_to_slide_per_event:
+        payments[payment_event.loan_id].append((payment_event, amount_to_slide))
+    return payments
+
+
+def _get_extended_loan_ids(session: Session, loan_ids: List[int]) -> Set[int]:
+    # We don't have context of the past tenure of an extended loan.
+    return {
+        loan_id
+        for loan_id, in session.query(LedgerTriggerEvent.loan_id)
+        .filter(LedgerTriggerEvent.loan_id.in_(loan_ids), LedgerTriggerEvent.name == "bill_extended")
+        .distinct()
+    }
+
+
 def reset_loan_schedule(user_loan: Loan, session: Session) -> None:
+    user_loan = get_user_loan(session=session, loan_id=user_loan.loan_id)
+
+    # returning if the loan is extended, because we don't have context of past tenure.
+    if _get_extended_loan_ids(session, [user_loan.loan_id]):
+        return
+
+    payments = _get_payments_to_replay(session, [user_loan.loan_id])
+    _reset_loan_schedule(user_loan, session, payments[user_loan.loan_id])
+
+
+def _reset_loan_schedule(
+    user_loan: BaseLoan, session: Session, payments: List[Tuple[LedgerTriggerEvent, Decimal]]
+) -> None:
     def reset_bill_emis(user_loan: Loan, session: Session) -> None:
         bills = user_loan.get_all_bills()
         for bill in bills:
@@ -385,44 +484,123 @@ def reset_loan_schedule(user_loan: Loan, session: Session) -> None:
             .update({PaymentMapping.row_status: "inactive"}, synchronize_session=False)
         )
 
-    user_loan = get_user_loan(session=session, loan_id=user_loan.loan_id)
-
-    # returning if the loan is extended, because we don't have context of past tenure.
-    is_loan_extended = (
-        session.query(LedgerTriggerEvent.loan_id)
-        .filter(
-            LedgerTriggerEvent.loan_id == user_loan.loan_id, LedgerTriggerEvent.name == "bill_extended"
-        )
-        .first()
-    )
-    if is_loan_extended:
-        return
-
     reset_bill_emis(user_loan=user_loan, session=session)
     reset_payment_info(user_loan=user_loan, session=session)
     group_bills(user_loan)
     make_emi_payment_mappings_inactive(user_loan, session=session)
 
-    amount_to_slide_per_event = (
-        session.query(LedgerTriggerEvent.id, func.sum(PaymentSplit.amount_settled))
-        .filter(
-            PaymentSplit.payment_request_id
-            == LedgerTriggerEvent.extra_details["payment_request_id"].astext,
-            PaymentSplit.component.in_(("principal", "interest", "unbilled")),
-            LedgerTriggerEvent.name == "payment_received",
-            LedgerTriggerEvent.loan_id == user_loan.loan_id,
-        )
-        .group_by(LedgerTriggerEvent.id)
-        .all()
-    )
+    # The replayed mappings are collected and written together.
+    emis = user_loan.get_loan_schedule()
+    new_mappings: Dict[Tuple[str, int], Decimal] = {}
 
-    event_ids = [id for id, _ in amount_to_slide_per_event]
-    payment_events = session.query(LedgerTriggerEvent).filter(LedgerTriggerEvent.id.in_(event_ids)).all()
-    event_id_to_object_mapping = {event.id: event for event in payment_events}
+    def write_new_mappings() -> None:
+        _upsert_payment_mappings(session, new_mappings)
+        new_mappings.clear()
 
-    for event_id, amount_to_slide in amount_to_slide_per_event:
-        payment_event = event_id_to_object_mapping[event_id]
-        slide_payment_to_emis(user_loan, payment_event, amount_to_slide)
+    for payment_event, amount_to_slide in payments:
+        payment_request_id = payment_event.extra_details["payment_request_id"]
+        amounts_slid = _slide_payment_to_emis(emis, payment_event.post_date, amount_to_slide)
+        for emi_id, amount_slid in amounts_slid.items():
+            key = (payment_request_id, emi_id)
+            new_mappings[key] = new_mappings.get(key, 0) + amount_slid
         if user_loan.can_close_loan(as_of_event_id=payment_event.id):
+            write_new_mappings()  # close_loan moves them to the closing emi.
             close_loan(user_loan, payment_event.post_date)
             break
+    write_new_mappings()
+
+
+def rebuild_schedules(
+    session: Session,
+    loan_ids: List[int],
+    workers: int = 1,
+    chunk_size: int = 500,
+    checkpoint_path: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Runs reset_loan_schedule over many loans, a chunk at a time. The loans, their payments to replay
+    and whether they are extended are loaded once per chunk. Each loan runs inside its own savepoint
+    so a bad one doesn't stop the rest. Returns one result dict per loan rebuilt in this run.
+
+    With workers > 1 chunks are spread over threads, each with its own session which commits after
+    every chunk. With a checkpoint_path every finished chunk is committed and its successful loans
+    appended to the file. Loans already in the file are skipped, so a stopped run can be resumed.
+    """
+    done_loan_ids: Set[int] = set()
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as checkpoint_file:
+            done_loan_ids = {int(line) for line in checkpoint_file if line.strip()}
+    pending_loan_ids = [loan_id for loan_id in loan_ids if loan_id not in done_loan_ids]
+    chunks = [
+        pending_loan_ids[start : start + chunk_size]
+        for start in range(0, len(pending_loan_ids), chunk_size)
+    ]
+    checkpoint_lock = threading.Lock()
+
+    def rebuild_chunk(chunk_session: Session, chunk: List[int]) -> List[Dict[str, Any]]:
+        user_loans = {}
+        for user_loan in chunk_session.query(Loan).filter(Loan.id.in_(chunk)):
+            user_loan.prepare(session=chunk_session)
+            user_loans[user_loan.id] = user_loan
+        extended_loan_ids = _get_extended_loan_ids(chunk_session, chunk)
+        payments = _get_payments_to_replay(chunk_session, chunk)
+
+        results = []
+        for loan_id in chunk:
+            result: Dict[str, Any] = {"loan_id": loan_id}
+            results.append(result)
+            if loan_id not in user_loans:
+                result.update(result="error", message="Loan not found.")
+                continue
+            if loan_id in extended_loan_ids:
+                result.update(result="success", message="Loan is extended. Schedule left as it is.")
+                continue
+            savepoint = chunk_session.begin_nested()
+            try:
+                _reset_loan_schedule(user_loans[loan_id], chunk_session, payments[loan_id])
+                savepoint.commit()
+            except Exception as e:
+                savepoint.rollback()
+                result.update(result="error", message=str(e))
+            else:
+                result.update(result="success")
+        return results
+
+    def save_checkpoint(results: List[Dict[str, Any]]) -> None:
+        with checkpoint_lock, open(checkpoint_path, "a") as checkpoint_file:
+            checkpoint_file.writelines(
+                f"{result['loan_id']}\n" for result in results if result["result"] == "success"
+            )
+
+    if workers <= 1:
+        results = []
+        for chunk in chunks:
+            chunk_results = rebuild_chunk(session, chunk)
+            if checkpoint_path:
+                session.commit()
+                save_checkpoint(chunk_results)
+            results.extend(chunk_results)
+        return results
+
+    session_factory = sessionmaker(bind=session.get_bind())
+
+    def rebuild_in_own_session(chunk: List[int]) -> List[Dict[str, Any]]:
+        chunk_session = session_factory()
+        try:
+            chunk_results = rebuild_chunk(chunk_session, chunk)
+            chunk_session.commit()
+        except Exception as e:
+            chunk_session.rollback()
+            return [{"loan_id": loan_id, "result": "error", "message": str(e)} for loan_id in chunk]
+        finally:
+            chunk_session.close()
+        if checkpoint_path:
+            save_checkpoint(chunk_results)
+        return chunk_results
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return [
+            result
+            for chunk_results in executor.map(rebuild_in_own_session, chunks)
+            for result in chunk_results
+        ]
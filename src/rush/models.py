@@ -2,6 +2,7 @@ from decimal import Decimal
 from typing import (
     Any,
     Dict,
+    Optional,
 )
 
 from pendulum import Date as PythonDate
@@ -203,6 +204,25 @@ class BookAccount(AuditMixin):
     account_type = Column(String(50))
     balance = Column(DECIMAL, default=0)
 
+    __table_args__ = (
+        Index(
+            "unique_index_on_book_string_book_account",
+            identifier,
+            identifier_type,
+            book_name,
+            account_type,
+            unique=True,
+        ),
+    )
+
+
+class BookAccountDailyBalance(Base):
+    __tablename__ = "book_account_daily_balance"
+    book_account_id = Column(Integer, ForeignKey(BookAccount.id), primary_key=True)
+    balance_date = Column(Date, primary_key=True)
+    balance = Column(DECIMAL, nullable=False)
+    last_entry_id = Column(Integer, nullable=False)
+
 
 class LedgerTriggerEvent(AuditMixin):
     __tablename__ = "ledger_trigger_event"
@@ -212,6 +232,8 @@ class LedgerTriggerEvent(AuditMixin):
     amount: Decimal = Column(Numeric)
     extra_details = Column(JSON, default={})
 
+    __table_args__ = (Index("ix_ledger_trigger_event_loan_id_name_post_date", loan_id, name, post_date),)
+
     def __init__(self, **kwargs):
         lender_event_names = ("lender_disbursal", "m2p_transfer", "incur_lender_interest")
 
@@ -233,6 +255,13 @@ class NewLedgerEntry(Base):
     amount = Column(DECIMAL, nullable=False)
     created_at = Column(TIMESTAMP, default=get_current_ist_time(), nullable=False)
 
+    # Debit and credit indexes also INCLUDE (event_id, amount, <side>_account_balance). See migration.
+    __table_args__ = (
+        Index("ix_ledger_entry_debit_account", debit_account, id),
+        Index("ix_ledger_entry_credit_account", credit_account, id),
+        Index("ix_ledger_entry_event_id", event_id),
+    )
+
 
 class LedgerLoanData(AuditMixin):
     __tablename__ = "loan_data"
@@ -249,6 +278,35 @@ class LedgerLoanData(AuditMixin):
     interest_to_charge: Decimal = Column(Numeric, nullable=True)
 
 
+class LoanBalanceSummary(Base):
+    """Current balances of a loan, kept up to date by triggers on book_account and fee."""
+
+    __tablename__ = "loan_balance_summary"
+    loan_id = Column(Integer, ForeignKey(Loan.id), primary_key=True)
+    min_balance: Decimal = Column(Numeric, nullable=False, default=0)
+    max_balance: Decimal = Column(Numeric, nullable=False, default=0)
+    principal_balance: Decimal = Column(Numeric, nullable=False, default=0)
+    interest_balance: Decimal = Column(Numeric, nullable=False, default=0)
+    fee_balance: Decimal = Column(Numeric, nullable=False, default=0)
+    prepayment_balance: Decimal = Column(Numeric, nullable=False, default=0)
+    updated_at = Column(TIMESTAMP, nullable=False)
+
+
+class RevenueRollup(Base):
+    """
+    Change of the revenue and receivable books per day and lender. A ledger_entry trigger appends a
+    row per insert statement, compact_revenue_rollup merges the rows of past days.
+    """
+
+    __tablename__ = "revenue_rollup"
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False)
+    book_name = Column(String(50), nullable=False)
+    lender_id = Column(Integer, nullable=False)
+    amount: Decimal = Column(Numeric, nullable=False, default=0)
+    entry_count = Column(Integer, nullable=False, default=0)
+
+
 class CardTransaction(AuditMixin):
     __tablename__ = "card_transaction"
     loan_id = Column(Integer, ForeignKey(LedgerLoanData.id), nullable=False)
@@ -285,6 +343,16 @@ class LoanSchedule(AuditMixin):
     payment_received: Decimal = Column(Numeric, nullable=False, default=0)
     payment_status = Column(String(length=6), nullable=False, default="UnPaid")
 
+    __table_args__ = (
+        Index(
+            "idx_uniq_on_loan_id_due_date_loan_schedule",
+            loan_id,
+            due_date,
+            unique=True,
+            postgresql_where=bill_id.is_(None),
+        ),
+    )
+
     @hybrid_property
     def total_due_amount(self):
         return self.principal_due + self.interest_due
@@ -312,15 +380,31 @@ class LoanSchedule(AuditMixin):
             )
             .scalar()
         )
+        total_bill_moratorium_interest = None
+        if not moratorium_interest_for_this_emi:
+            total_bill_moratorium_interest = MoratoriumInterest.get_bill_total_moratorium_interest(
+                session=session, loan_id=self.loan_id, bill_id=self.bill_id
+            )
+        return self.get_interest_to_accrue(
+            loan_moratorium, moratorium_interest_for_this_emi, total_bill_moratorium_interest
+        )
+
+    def get_interest_to_accrue(
+        self,
+        loan_moratorium: Optional["LoanMoratorium"],
+        moratorium_interest_for_this_emi: Optional[Decimal],
+        total_bill_moratorium_interest: Optional[Decimal],
+    ) -> Decimal:
+        """interest_to_accrue with the loan's latest moratorium and its interest already fetched."""
+        if not loan_moratorium or self.due_date > loan_moratorium.due_date_after_moratorium:
+            return self.interest_due
+
         if moratorium_interest_for_this_emi:  # if emi is present in moratorium table then return that.
             return moratorium_interest_for_this_emi
 
         # Now emi can either be from the bill right after moratorium or bills before/during moratorium period.
         # For former we return the schedule's interest due. For later we reduce the total moratorium interest of the
         # bill from the schedule's interest due.
-        total_bill_moratorium_interest = MoratoriumInterest.get_bill_total_moratorium_interest(
-            session=session, loan_id=self.loan_id, bill_id=self.bill_id
-        )
         if not total_bill_moratorium_interest:  # if nothing comes then emi is from non moratorium bill.
             return self.interest_due
 
@@ -554,6 +638,23 @@ class JournalEntry(AuditMixin):
     loan_id = Column(Integer, ForeignKey(Loan.id), nullable=True)
     user_id = Column(Integer, ForeignKey(User.id), nullable=False)
 
+    __table_args__ = (Index("ix_journal_entries_date_ledger", date_ledger),)
+
+
+class JournalEntryOutbox(AuditMixin):
+    """Events whose journal entries are yet to be written by process_journal_entry_outbox."""
+
+    __tablename__ = "journal_entry_outbox"
+
+    event_id = Column(Integer, ForeignKey(LedgerTriggerEvent.id), nullable=False)
+    loan_id = Column(Integer, ForeignKey(Loan.id), nullable=True)
+    user_id = Column(Integer, ForeignKey(User.id), nullable=False)
+    processed_at = Column(TIMESTAMP, nullable=True)
+
+    __table_args__ = (
+        Index("ix_journal_entry_outbox_pending", "id", postgresql_where=processed_at.is_(None)),
+    )
+
 
 class PaymentRequestsData(AuditMixin):
     __tablename__ = "v3_payment_requests_data"
@@ -1,8 +1,19 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
+from typing import (
+    Any,
+    Dict,
+    List,
+    Tuple,
+)
 
 from pendulum import DateTime
 from sqlalchemy import func
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import (
+    Session,
+    sessionmaker,
+)
 from sqlalchemy.sql.expression import (
     and_,
     or_,
@@ -19,6 +30,7 @@ from rush.create_emi import (
     update_event_with_dpd,
     update_journal_entry,
 )
+from rush.instrumentation import instrumented
 from rush.ledger_events import (
     _adjust_bill,
     _adjust_for_prepayment,
@@ -27,8 +39,13 @@ from rush.ledger_events import (
     limit_assignment_event,
 )
 from rush.ledger_utils import (
+    LedgerBatch,
     create_ledger_entry_from_str,
+    flush_ledger_batch,
     get_account_balance_from_str,
+    get_account_balances,
+    get_book_account_ids_by_strings,
+    prefetch_book_accounts,
     reverse_event,
 )
 from rush.loan_schedule.loan_schedule import (
@@ -56,6 +73,7 @@ from rush.writeoff_and_recovery import (
 )
 
 
+@instrumented("payment_received")
 def payment_received(
     session: Session,
     user_loan: BaseLoan,
@@ -84,6 +102,10 @@ def payment_received(
 
     remaining_payment_amount = payment_for_loan
 
+    all_loans = [user_loan] + user_loan.get_child_loans()
+    for loan in all_loans:
+        prefetch_book_accounts(session, loan)
+
     def call_payment_received_event(amount_to_adjust: Decimal) -> Decimal:
         if amount_to_adjust <= 0:
             return amount_to_adjust
@@ -97,16 +119,16 @@ def payment_received(
         )
         return remaining_amount
 
-    all_loans = [user_loan] + user_loan.get_child_loans()
-    if len(all_loans) > 1:  # if more than 2 loans then pay minimum of all loans first.
+    with LedgerBatch(session):
+        if len(all_loans) > 1:  # if more than 2 loans then pay minimum of all loans first.
+            for loan in all_loans:
+                min_to_pay = loan.get_remaining_min(include_child_loans=False)
+                amount_to_actually_adjust = min(min_to_pay, remaining_payment_amount)
+                call_payment_received_event(amount_to_actually_adjust)
+                remaining_payment_amount -= amount_to_actually_adjust
+        # Settle whatever is remaining after it.
         for loan in all_loans:
-            min_to_pay = loan.get_remaining_min(include_child_loans=False)
-            amount_to_actually_adjust = min(min_to_pay, remaining_payment_amount)
-            call_payment_received_event(amount_to_actually_adjust)
-            remaining_payment_amount -= amount_to_actually_adjust
-    # Settle whatever is remaining after it.
-    for loan in all_loans:
-        remaining_payment_amount = call_payment_received_event(remaining_payment_amount)
+            remaining_payment_amount = call_payment_received_event(remaining_payment_amount)
     for loan in all_loans:
         run_anomaly(
             session=session,
@@ -125,6 +147,117 @@ def payment_received(
     create_payment_split(session, event)
 
 
+def ingest_payments(
+    session: Session, payment_requests: List[Tuple[int, str]], workers: int = 1
+) -> List[Dict[str, Any]]:
+    """
+    Applies a settlement file of (loan_id, payment_request_id) rows. Payments are grouped by
+    loan and applied in post date order within a loan, each inside its own savepoint so a bad
+    row doesn't stop the rest. Returns one result dict per input row, in input order.
+
+    With workers > 1 loans are spread over threads, each with its own session which commits
+    after every loan. The payment requests have to be committed for the workers to see them.
+    """
+    results: List[Dict[str, Any]] = [
+        {"loan_id": loan_id, "payment_request_id": payment_request_id}
+        for loan_id, payment_request_id in payment_requests
+    ]
+    rows_by_loan: Dict[int, List[int]] = defaultdict(list)
+    for row_number, (loan_id, _) in enumerate(payment_requests):
+        rows_by_loan[loan_id].append(row_number)
+
+    def ingest_for_loan(loan_session: Session, loan_id: int, row_numbers: List[int]) -> None:
+        payment_request_ids = [payment_requests[row_number][1] for row_number in row_numbers]
+        payment_requests_data = {
+            payment_request_data.payment_request_id: payment_request_data
+            for payment_request_data in loan_session.query(PaymentRequestsData).filter(
+                PaymentRequestsData.payment_request_id.in_(payment_request_ids),
+                PaymentRequestsData.row_status == "active",
+            )
+        }
+        user_loan = loan_session.query(Loan).filter(Loan.id == loan_id).one_or_none()
+        if user_loan:
+            user_loan.prepare(loan_session)
+
+        rows_to_apply = []
+        for row_number in row_numbers:
+            payment_request_data = payment_requests_data.get(payment_requests[row_number][1])
+            if not user_loan:
+                results[row_number].update(result="error", message="Loan not found.")
+            elif not payment_request_data:
+                results[row_number].update(result="error", message="Payment request not found.")
+            elif payment_request_data.user_id != user_loan.user_id:
+                results[row_number].update(
+                    result="error", message="Payment request belongs to another user."
+                )
+            elif not payment_request_data.intermediary_payment_date:
+                results[row_number].update(result="error", message="Payment request isn't paid.")
+            else:
+                rows_to_apply.append((payment_request_data.intermediary_payment_date, row_number))
+
+        for _, row_number in sorted(rows_to_apply):
+            savepoint = loan_session.begin_nested()
+            try:
+                payment_received(
+                    session=loan_session,
+                    user_loan=user_loan,
+                    payment_request_data=payment_requests_data[payment_requests[row_number][1]],
+                )
+                savepoint.commit()
+            except Exception as e:
+                savepoint.rollback()
+                results[row_number].update(result="error", message=str(e))
+            else:
+                results[row_number].update(result="success")
+
+    if workers <= 1:
+        for loan_id, row_numbers in rows_by_loan.items():
+            ingest_for_loan(session, loan_id, row_numbers)
+        return results
+
+    session_factory = sessionmaker(bind=session.get_bind())
+    # Lender and user books are shared between loans. Created by the workers, their inserts would
+    # make the other workers wait on the first one's commit.
+    book_session = session_factory()
+    try:
+        _create_shared_books(book_session, list(rows_by_loan))
+        book_session.commit()
+    finally:
+        book_session.close()
+
+    def ingest_in_own_session(loan_id: int) -> None:
+        loan_session = session_factory()
+        try:
+            ingest_for_loan(loan_session, loan_id, rows_by_loan[loan_id])
+            loan_session.commit()
+        except Exception as e:
+            loan_session.rollback()
+            for row_number in rows_by_loan[loan_id]:
+                results[row_number].update(result="error", message=str(e))
+        finally:
+            loan_session.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(ingest_in_own_session, rows_by_loan))
+    return results
+
+
+def _create_shared_books(session: Session, loan_ids: List[int]) -> None:
+    loans = session.query(Loan.lender_id, Loan.user_id).filter(Loan.id.in_(loan_ids)).distinct()
+    book_strings = set()
+    for lender_id, user_id in loans:
+        book_strings.update(
+            (
+                f"{lender_id}/lender/pg_account/a",
+                f"{lender_id}/lender/gateway_expenses/e",
+                f"{user_id}/user/cgst_payable/l",
+                f"{user_id}/user/sgst_payable/l",
+                f"{user_id}/user/igst_payable/l",
+            )
+        )
+    get_book_account_ids_by_strings(session, book_strings)
+
+
 def refund_payment(
     session: Session, user_loan: BaseLoan, payment_request_data: PaymentRequestsData
 ) -> None:
@@ -219,8 +352,6 @@ def find_split_to_slide_in_loan(session: Session, user_loan: BaseLoan, total_amo
     unpaid_bills = user_loan.get_unpaid_bills()
     unpaid_bill_ids = [unpaid_bill.table.id for unpaid_bill in unpaid_bills]
 
-    split_info = []
-
     # This includes bill-level and loan-level fees
     # if reversed not added then it add to prepayment as remaining_amount>0 during writeoff on outstanding amount
     all_fees = (
@@ -236,8 +367,43 @@ def find_split_to_slide_in_loan(session: Session, user_loan: BaseLoan, total_amo
         .order_by(Fee.id)
         .all()
     )
+    balances = get_account_balances(
+        session,
+        [
+            f"{bill_id}/bill/{book_name}/a"
+            for bill_id in unpaid_bill_ids
+            for book_name in ("interest_receivable", "principal_receivable")
+        ],
+    )
+    return split_amount_to_slide(
+        total_amount_to_slide,
+        unpaid_bills=unpaid_bills,
+        fees=all_fees,
+        interest_due={
+            bill_id: balances[f"{bill_id}/bill/interest_receivable/a"] for bill_id in unpaid_bill_ids
+        },
+        principal_due={
+            bill_id: balances[f"{bill_id}/bill/principal_receivable/a"] for bill_id in unpaid_bill_ids
+        },
+    )
+
 
-    if all_fees:
+def split_amount_to_slide(
+    total_amount_to_slide: Decimal,
+    unpaid_bills: List[BaseBill],
+    fees: List[Fee],
+    interest_due: Dict[int, Decimal],
+    principal_due: Dict[int, Decimal],
+) -> List[Dict[str, Any]]:
+    """
+    Splits an amount into fees, then interest, then principal. Within each, the amount is
+    spread across bills pro rata to their dues. Works only on the given snapshot, nothing is
+    read from the database.
+    """
+    bills_by_id = {bill.table.id: bill for bill in unpaid_bills}
+    split_info: List[Dict[str, Any]] = []
+
+    if fees:
         # higher priority is first
         fees_priority = [
             # Loan level
@@ -255,7 +421,7 @@ def find_split_to_slide_in_loan(session: Session, user_loan: BaseLoan, total_amo
         for fee_type in fees_priority:
             all_fees_by_type.setdefault(fee_type, [])
 
-        for fee in all_fees:
+        for fee in fees:
             if fee.name in all_fees_by_type:
                 all_fees_by_type[fee.name].append(fee)
             else:
@@ -282,7 +448,7 @@ def find_split_to_slide_in_loan(session: Session, user_loan: BaseLoan, total_amo
                     continue
 
                 # Bill-level fees are slid here and added to split info
-                bill = next(bill for bill in unpaid_bills if bill.table.id == fee.identifier_id)
+                bill = bills_by_id[fee.identifier_id]
                 amount_to_slide_based_on_ratio = mul(
                     fee.remaining_fee_amount / total_fee_amount,
                     total_amount_to_be_adjusted_in_fee,
@@ -302,13 +468,13 @@ def find_split_to_slide_in_loan(session: Session, user_loan: BaseLoan, total_amo
             total_amount_to_slide -= total_amount_to_be_adjusted_in_fee
 
     # slide interest.
-    total_interest_amount = sum(bill.get_interest_due() for bill in unpaid_bills)
+    total_interest_amount = sum(interest_due.values())
     if total_amount_to_slide > 0 and total_interest_amount > 0:
         total_amount_to_be_adjusted_in_interest = min(total_interest_amount, total_amount_to_slide)
         interest_amount = 0
         for bill in unpaid_bills:
             amount_to_slide_based_on_ratio = mul(
-                bill.get_interest_due() / total_interest_amount,
+                interest_due[bill.table.id] / total_interest_amount,
                 total_amount_to_be_adjusted_in_interest,
             )
             interest_amount += amount_to_slide_based_on_ratio
@@ -325,13 +491,13 @@ def find_split_to_slide_in_loan(session: Session, user_loan: BaseLoan, total_amo
         total_amount_to_slide -= total_amount_to_be_adjusted_in_interest
 
     # slide principal.
-    total_principal_amount = sum(bill.get_principal_due() for bill in unpaid_bills)
+    total_principal_amount = sum(principal_due.values())
     if total_amount_to_slide > 0 and total_principal_amount > 0:
         total_amount_to_be_adjusted_in_principal = min(total_principal_amount, total_amount_to_slide)
         principal_amount = 0
         for bill in unpaid_bills:
             amount_to_slide_based_on_ratio = mul(
-                bill.get_principal_due() / total_principal_amount,
+                principal_due[bill.table.id] / total_principal_amount,
                 total_amount_to_be_adjusted_in_principal,
             )
             principal_amount += amount_to_slide_based_on_ratio
@@ -414,6 +580,7 @@ def adjust_payment(
 
     split_data = find_split_to_slide_in_loan(session, user_loan, amount_to_adjust)
 
+    amount_to_slide_in_emis = Decimal(0)
     for data in split_data:
         if "bill" in data:
             adjust_for_min_max_accounts(data["bill"], data["amount_to_adjust"], event.id)
@@ -436,9 +603,13 @@ def adjust_payment(
             )
             # The amount to adjust is computed for this bill. It should all settle.
             assert remaining_amount == 0
-            slide_payment_to_emis(user_loan, event, data["amount_to_adjust"])
+            amount_to_slide_in_emis += data["amount_to_adjust"]
         amount_to_adjust -= data["amount_to_adjust"]
 
+    # The emis are settled in order, so sliding the bill amounts together ends up the same.
+    if amount_to_slide_in_emis:
+        slide_payment_to_emis(user_loan, event, amount_to_slide_in_emis)
+
     # After doing the sliding we check if the loan can be closed.
     if user_loan.can_close_loan(as_of_event_id=event.id):
         close_loan(user_loan, event.post_date)
@@ -539,6 +710,7 @@ def adjust_for_min_max_accounts(bill: BaseBill, payment_to_adjust_from: Decimal,
 
 
 def get_payment_split_from_event(session: Session, event: LedgerTriggerEvent):
+    flush_ledger_batch(session)
     split_data = (
         session.query(BookAccount.book_name, func.sum(NewLedgerEntry.amount))
         .filter(
@@ -1,70 +1,72 @@
 from decimal import Decimal
+from typing import Optional
 
 from pendulum import Date
+from sqlalchemy import (
+    case,
+    func,
+)
+from sqlalchemy.orm import Session
 
+from rush.models import RevenueRollup
 
-def get_revenue_earned_in_a_period(session, from_date: Date, to_date: Date) -> Decimal:
-    q = """
-    with revenue_books as (
-      select 
-        id 
-      from 
-        book_account 
-      where 
-        account_type = 'r' 
-        and book_name in (
-          'interest_accrued', 'late_fee', 
-          'card_processing_fee', 'reload_fee'
-        )
-    ), 
-    accrued_revenue as (
-      select 
-        *, 
-        get_account_balance_between_periods_by_book_id(
-          id, :from_date, :to_date
-        ) as accrued_amount 
-      from 
-        revenue_books
-    ), 
-    total_accrued_interest as (
-      select 
-        sum(accrued_amount) as total_accrued_interest 
-      from 
-        accrued_revenue
-    ), 
-    receivable_books as (
-      select 
-        id 
-      from 
-        book_account 
-      where 
-        account_type = 'a' 
-        and book_name in (
-          'interest_receivable', 'late_fine_receivable', 
-          'card_processing_fee_receivable', 
-          'reload_fee_receivable'
-        )
-    ), 
-    remaining_revenue as (
-      select 
-        *, 
-        get_account_balance_between_periods_by_book_id(
-          id, :from_date, :to_date
-        ) as remaining_amount 
-      from 
-        receivable_books
-    ), 
-    total_revenue_remaining as (
-      select 
-        sum(remaining_amount) as total_remaining 
-      from 
-        remaining_revenue
-    ) 
-    select 
-      total_accrued_interest - total_remaining as revenue_earned 
-    from 
-      total_accrued_interest, 
-      total_revenue_remaining;
+# Rows of the days before :before_day are replaced with one row per day, book and lender. Rows
+# appended meanwhile aren't seen by the delete and stay for the next run.
+compact_revenue_rollup_query = """
+with deltas as (
+  delete from revenue_rollup
+  where day < :before_day
+  returning day, book_name, lender_id, amount, entry_count
+)
+insert into revenue_rollup (day, book_name, lender_id, amount, entry_count)
+select
+  day,
+  book_name,
+  lender_id,
+  sum(amount),
+  sum(entry_count)
+from
+  deltas
+group by
+  day,
+  book_name,
+  lender_id
+"""
+
+REVENUE_BOOK_NAMES = ("interest_accrued", "late_fee", "card_processing_fee", "reload_fee")
+RECEIVABLE_BOOK_NAMES = (
+    "interest_receivable",
+    "late_fine_receivable",
+    "card_processing_fee_receivable",
+    "reload_fee_receivable",
+)
+
+
+def get_revenue_earned_in_a_period(
+    session: Session, from_date: Date, to_date: Date, lender_id: Optional[int] = None
+) -> Decimal:
+    """
+    Revenue accrued in the period less what of it is still receivable, from the rollup rows of
+    both dates inclusive. Optionally for a single lender.
+    """
+    is_revenue_book = RevenueRollup.book_name.in_(REVENUE_BOOK_NAMES)
+    query = session.query(
+        func.sum(case([(is_revenue_book, RevenueRollup.amount)], else_=-RevenueRollup.amount))
+    ).filter(
+        RevenueRollup.day >= from_date,
+        RevenueRollup.day <= to_date,
+        RevenueRollup.book_name.in_(REVENUE_BOOK_NAMES + RECEIVABLE_BOOK_NAMES),
+    )
+    if lender_id is not None:
+        query = query.filter(RevenueRollup.lender_id == lender_id)
+    revenue_earned = query.scalar()
+    return revenue_earned or Decimal(0)
+
+
+def compact_revenue_rollup(session: Session, before_day: Date) -> int:
+    """
+    Daily job. Merges the rollup rows of every day before before_day. Returns the number of rows
+    left for those days.
     """
-    revenue_earned = session.execute(q, params={"from_date": from_date, "to_date": to_date}).scalar()
-    return revenue_earned or 0
+    result = session.execute(compact_revenue_rollup_query, params={"before_day": before_day})
+    return result.rowcount
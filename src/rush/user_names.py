@@ -0,0 +1,191 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+
+from sqlalchemy import (
+    event,
+    text,
+)
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import (
+    Mapper,
+    Session,
+    object_session,
+)
+
+from rush.models import (
+    UserData,
+    UserDocuments,
+)
+
+DEFAULT_USER_NAME = "John Doe"
+
+aadhar_names_query = text(
+    """
+    SELECT DISTINCT ON (v3_user_documents.user_id)
+        v3_user_documents.user_id,
+        UPPER(
+            CASE
+                WHEN (v3_user_documents.text_details_json ->> 'address_type'::text) IS NOT NULL AND length(v3_user_documents.text_details_json ->> 'name'::text) > 3
+                THEN v3_user_documents.text_details_json ->> 'name'::text
+                ELSE NULL::text
+            END
+        ) AS aadhar_name
+    FROM v3_user_documents
+    WHERE v3_user_documents.user_id = ANY(:user_ids) AND v3_user_documents.row_status::text = 'active'::text AND v3_user_documents.document_type::text = 'Aadhar'::text
+    AND v3_user_documents.sequence = 1 AND v3_user_documents.verification_status::text = 'APPROVED'::text
+    ORDER BY v3_user_documents.user_id, v3_user_documents.id
+"""
+)
+
+
+class UserNameCache:
+    """
+    Bounded LRU of resolved names shared by all sessions. Entries expire after ttl seconds so a
+    change made outside of this process is picked up eventually.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 300) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._names: "OrderedDict[int, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> Optional[str]:
+        with self._lock:
+            cached = self._names.get(user_id)
+            if cached is None:
+                return None
+            name, expires_at = cached
+            if expires_at < time.monotonic():
+                del self._names[user_id]
+                return None
+            self._names.move_to_end(user_id)
+            return name
+
+    def update(self, names: Dict[int, str]) -> None:
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            for user_id, name in names.items():
+                self._names[user_id] = (name, expires_at)
+                self._names.move_to_end(user_id)
+            while len(self._names) > self.max_size:
+                self._names.popitem(last=False)
+
+    def discard(self, user_ids: Iterable[int]) -> None:
+        with self._lock:
+            for user_id in user_ids:
+                self._names.pop(user_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._names.clear()
+
+
+user_name_cache = UserNameCache()
+
+
+def _get_staged_names(session: Session) -> Dict[int, str]:
+    """Names read in the session's transaction. They're shared only once it commits."""
+    return session.info.setdefault("user_name_stage", {})
+
+
+def resolve_names(session: Session, user_ids: Iterable[int]) -> Dict[int, str]:
+    """
+    Name used in the journal entries of each user: the approved aadhar name, else the first name
+    from user data, else a placeholder. Only the users missing from the cache are queried.
+    """
+    staged_names = _get_staged_names(session)
+    names = {}
+    missing_user_ids: List[int] = []
+    for user_id in set(user_ids):
+        name = staged_names.get(user_id) or user_name_cache.get(user_id)
+        if name:
+            names[user_id] = name
+        else:
+            missing_user_ids.append(user_id)
+    if not missing_user_ids:
+        return names
+
+    # Raw statements don't autoflush and pending document changes have to be seen.
+    session.flush()
+    resolved_names = {
+        user_id: name
+        for user_id, name in session.execute(aadhar_names_query, {"user_ids": missing_user_ids})
+        if name
+    }
+    user_data_ids = [user_id for user_id in missing_user_ids if user_id not in resolved_names]
+    if user_data_ids:
+        first_names = (
+            session.query(UserData.user_id, UserData.first_name)
+            .filter(UserData.row_status == "active", UserData.user_id.in_(user_data_ids))
+            .order_by(UserData.id)
+            .all()
+        )
+        for user_id, first_name in first_names:
+            if first_name and user_id not in resolved_names:
+                resolved_names[user_id] = first_name.upper()
+    for user_id in missing_user_ids:
+        resolved_names.setdefault(user_id, DEFAULT_USER_NAME)
+
+    staged_names.update(resolved_names)
+    names.update(resolved_names)
+    return names
+
+
+def resolve_name(session: Session, user_id: int) -> str:
+    return resolve_names(session, [user_id])[user_id]
+
+
+def invalidate_user_name(session: Optional[Session], user_id: Optional[int]) -> None:
+    if user_id is None:
+        return
+    user_name_cache.discard([user_id])
+    if session is not None:
+        session.info.get("user_name_stage", {}).pop(user_id, None)
+        # Drop it again on commit, in case another session cached the old name in the meantime.
+        session.info.setdefault("user_name_invalidated", set()).add(user_id)
+
+
+def _invalidate_on_set(target: Any, value: Any, oldvalue: Any, initiator: Any) -> None:
+    invalidate_user_name(object_session(target), target.user_id)
+
+
+def _invalidate_on_flush(mapper: Mapper, connection: Connection, target: Any) -> None:
+    invalidate_user_name(object_session(target), target.user_id)
+
+
+for _column in (
+    UserDocuments.verification_status,
+    UserDocuments.text_details_json,
+    UserDocuments.row_status,
+    UserDocuments.document_type,
+    UserDocuments.sequence,
+    UserData.first_name,
+    UserData.row_status,
+):
+    event.listen(_column, "set", _invalidate_on_set)
+
+for _model in (UserDocuments, UserData):
+    for _mapper_event in ("after_insert", "after_update", "after_delete"):
+        event.listen(_model, _mapper_event, _invalidate_on_flush)
+
+
+@event.listens_for(Session, "after_commit")
+def _promote_user_names(session: Session) -> None:
+    user_name_cache.discard(session.info.pop("user_name_invalidated", ()))
+    user_name_cache.update(session.info.pop("user_name_stage", {}))
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _drop_user_names(session: Session, previous_transaction: Any) -> None:
+    session.info.pop("user_name_stage", None)
+    session.info.pop("user_name_invalidated", None)
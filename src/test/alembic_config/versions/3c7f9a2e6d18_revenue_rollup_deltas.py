@@ -0,0 +1,187 @@
+"""revenue_rollup_deltas
+
+Revision ID: 3c7f9a2e6d18
+Revises: a9d3c7e1f508
+Create Date: 2021-06-10 11:42:05.118734
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "3c7f9a2e6d18"
+down_revision = "a9d3c7e1f508"
+branch_labels = None
+depends_on = None
+
+# Change of the revenue and receivable books per day of the event and lender of the loan, for the
+# entries in new_entries. Books not tied to a loan go under lender 0. An entry with the same book
+# on both sides doesn't change it.
+revenue_rollup_deltas_query = """
+    select
+      lte.post_date :: date,
+      ba.book_name,
+      coalesce(bill_loan.lender_id, loan.lender_id, 0),
+      sum(
+        case when ba.account_type = 'a' then 1 else -1 end
+        * (
+          case when ba.id = le.debit_account then le.amount else 0 end
+          - case when ba.id = le.credit_account then le.amount else 0 end
+        )
+      ),
+      count(*)
+    from
+      new_entries le
+      join book_account ba on ba.id in (le.debit_account, le.credit_account)
+      join ledger_trigger_event lte on lte.id = le.event_id
+      left join loan_data ld on ba.identifier_type = 'bill' and ld.id = ba.identifier
+      left join v3_loans bill_loan on bill_loan.id = ld.loan_id
+      left join v3_loans loan on ba.identifier_type in ('loan', 'card') and loan.id = ba.identifier
+    where
+      (
+        ba.account_type = 'r'
+        and ba.book_name in ('interest_accrued', 'late_fee', 'card_processing_fee', 'reload_fee')
+      )
+      or (
+        ba.account_type = 'a'
+        and ba.book_name in (
+          'interest_receivable', 'late_fine_receivable', 'card_processing_fee_receivable',
+          'reload_fee_receivable'
+        )
+      )
+    group by
+      1, 2, 3
+"""
+
+
+def upgrade() -> None:
+    op.execute("DROP TRIGGER revenue_rollup_trigger ON ledger_entry")
+    op.execute("DROP FUNCTION update_revenue_rollup")
+
+    # Upserting one row per day, book and lender made every accrual of the day wait on the same
+    # rows. Rows are appended instead, and summed by the reader or merged by compact_revenue_rollup.
+    op.drop_constraint("revenue_rollup_pkey", "revenue_rollup")
+    op.execute("ALTER TABLE revenue_rollup ADD COLUMN id serial PRIMARY KEY")
+    op.create_index("ix_revenue_rollup_day_lender_id", "revenue_rollup", ["day", "lender_id"])
+
+    op.execute(
+        f"""
+    CREATE FUNCTION append_revenue_rollup()
+        RETURNS trigger
+        LANGUAGE plpgsql
+    AS
+    $$
+    BEGIN
+        INSERT INTO revenue_rollup (day, book_name, lender_id, amount, entry_count)
+        {revenue_rollup_deltas_query};
+        RETURN NULL;
+    END;
+    $$;
+        """
+    )
+    op.execute(
+        """
+    CREATE TRIGGER revenue_rollup_trigger
+    AFTER INSERT ON ledger_entry
+    REFERENCING NEW TABLE AS new_entries
+    FOR EACH STATEMENT EXECUTE PROCEDURE append_revenue_rollup();
+        """
+    )
+
+    # Entries with the same book on both sides were counted on one side. Rebuild from the ledger.
+    op.execute("DELETE FROM revenue_rollup")
+    op.execute(
+        f"""
+    WITH new_entries AS (SELECT * FROM ledger_entry)
+    INSERT INTO revenue_rollup (day, book_name, lender_id, amount, entry_count)
+    {revenue_rollup_deltas_query};
+        """
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER revenue_rollup_trigger ON ledger_entry")
+    op.execute("DROP FUNCTION append_revenue_rollup")
+
+    # Back to one row per day, book and lender.
+    op.execute(
+        """
+    WITH deltas AS (DELETE FROM revenue_rollup RETURNING *)
+    INSERT INTO revenue_rollup (day, book_name, lender_id, amount, entry_count)
+    select day, book_name, lender_id, sum(amount), sum(entry_count) from deltas group by 1, 2, 3;
+        """
+    )
+    op.drop_index("ix_revenue_rollup_day_lender_id", "revenue_rollup")
+    op.drop_column("revenue_rollup", "id")
+    op.create_primary_key("revenue_rollup_pkey", "revenue_rollup", ["day", "book_name", "lender_id"])
+
+    # Previous function, from a9d3c7e1f508.
+    op.execute(
+        """
+    CREATE FUNCTION update_revenue_rollup()
+        RETURNS trigger
+        LANGUAGE plpgsql
+    AS
+    $$
+    DECLARE
+    book record;
+    entry_day date;
+    book_lender_id integer;
+    BEGIN
+        FOR book IN
+            select
+              ba.identifier,
+              ba.identifier_type,
+              ba.book_name,
+              case
+                when (ba.id = NEW.debit_account) = (ba.account_type = 'a') then NEW.amount
+                else -NEW.amount
+              end as amount
+            from
+              book_account ba
+            where
+              ba.id in (NEW.debit_account, NEW.credit_account)
+              and (
+                (
+                  ba.account_type = 'r'
+                  and ba.book_name in ('interest_accrued', 'late_fee', 'card_processing_fee', 'reload_fee')
+                )
+                or (
+                  ba.account_type = 'a'
+                  and ba.book_name in (
+                    'interest_receivable', 'late_fine_receivable', 'card_processing_fee_receivable',
+                    'reload_fee_receivable'
+                  )
+                )
+              )
+        LOOP
+            if entry_day is null then
+                select post_date :: date INTO entry_day from ledger_trigger_event where id = NEW.event_id;
+            end if;
+            if book.identifier_type = 'bill' then
+                select l.lender_id INTO book_lender_id
+                from loan_data ld join v3_loans l on l.id = ld.loan_id
+                where ld.id = book.identifier;
+            elsif book.identifier_type in ('loan', 'card') then
+                select lender_id INTO book_lender_id from v3_loans where id = book.identifier;
+            else
+                book_lender_id := null;
+            end if;
+
+            INSERT INTO revenue_rollup AS r (day, book_name, lender_id, amount, entry_count)
+            VALUES (entry_day, book.book_name, coalesce(book_lender_id, 0), book.amount, 1)
+            ON CONFLICT (day, book_name, lender_id) DO UPDATE SET
+                amount = r.amount + excluded.amount,
+                entry_count = r.entry_count + 1;
+        END LOOP;
+        RETURN NULL;
+    END;
+    $$;
+        """
+    )
+    op.execute(
+        """
+    CREATE TRIGGER revenue_rollup_trigger
+    AFTER INSERT ON ledger_entry
+    FOR EACH ROW EXECUTE PROCEDURE update_revenue_rollup();
+        """
+    )
@@ -0,0 +1,24 @@
+"""journal_entries_date_ledger_index
+
+Revision ID: a4c7d2e9f013
+Revises: e81c5f0a3b72
+Create Date: 2021-05-28 15:02:47.118904
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "a4c7d2e9f013"
+down_revision = "e81c5f0a3b72"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Journal exports read a date range.
+    op.create_index("ix_journal_entries_date_ledger", "journal_entries", ["date_ledger"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_journal_entries_date_ledger", "journal_entries")
@@ -0,0 +1,145 @@
+"""revenue_rollup
+
+Revision ID: a9d3c7e1f508
+Revises: b6e0a3f7c215
+Create Date: 2021-06-07 15:03:52.771409
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "a9d3c7e1f508"
+down_revision = "b6e0a3f7c215"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "revenue_rollup",
+        sa.Column("day", sa.Date, nullable=False),
+        sa.Column("book_name", sa.String(50), nullable=False),
+        sa.Column("lender_id", sa.Integer, nullable=False),
+        sa.Column("amount", sa.Numeric, nullable=False, server_default="0"),
+        sa.Column("entry_count", sa.Integer, nullable=False, server_default="0"),
+        sa.PrimaryKeyConstraint("day", "book_name", "lender_id"),
+    )
+
+    # Change of the book's balance per day of the event and lender of the loan. Books not tied to a
+    # loan go under lender 0.
+    op.execute(
+        """
+    CREATE FUNCTION update_revenue_rollup()
+        RETURNS trigger
+        LANGUAGE plpgsql
+    AS
+    $$
+    DECLARE
+    book record;
+    entry_day date;
+    book_lender_id integer;
+    BEGIN
+        FOR book IN
+            select
+              ba.identifier,
+              ba.identifier_type,
+              ba.book_name,
+              case
+                when (ba.id = NEW.debit_account) = (ba.account_type = 'a') then NEW.amount
+                else -NEW.amount
+              end as amount
+            from
+              book_account ba
+            where
+              ba.id in (NEW.debit_account, NEW.credit_account)
+              and (
+                (
+                  ba.account_type = 'r'
+                  and ba.book_name in ('interest_accrued', 'late_fee', 'card_processing_fee', 'reload_fee')
+                )
+                or (
+                  ba.account_type = 'a'
+                  and ba.book_name in (
+                    'interest_receivable', 'late_fine_receivable', 'card_processing_fee_receivable',
+                    'reload_fee_receivable'
+                  )
+                )
+              )
+        LOOP
+            if entry_day is null then
+                select post_date :: date INTO entry_day from ledger_trigger_event where id = NEW.event_id;
+            end if;
+            if book.identifier_type = 'bill' then
+                select l.lender_id INTO book_lender_id
+                from loan_data ld join v3_loans l on l.id = ld.loan_id
+                where ld.id = book.identifier;
+            elsif book.identifier_type in ('loan', 'card') then
+                select lender_id INTO book_lender_id from v3_loans where id = book.identifier;
+            else
+                book_lender_id := null;
+            end if;
+
+            INSERT INTO revenue_rollup AS r (day, book_name, lender_id, amount, entry_count)
+            VALUES (entry_day, book.book_name, coalesce(book_lender_id, 0), book.amount, 1)
+            ON CONFLICT (day, book_name, lender_id) DO UPDATE SET
+                amount = r.amount + excluded.amount,
+                entry_count = r.entry_count + 1;
+        END LOOP;
+        RETURN NULL;
+    END;
+    $$;
+        """
+    )
+    op.execute(
+        """
+    CREATE TRIGGER revenue_rollup_trigger
+    AFTER INSERT ON ledger_entry
+    FOR EACH ROW EXECUTE PROCEDURE update_revenue_rollup();
+        """
+    )
+
+    # Backfill from the existing entries.
+    op.execute(
+        """
+    INSERT INTO revenue_rollup (day, book_name, lender_id, amount, entry_count)
+    select
+      lte.post_date :: date,
+      ba.book_name,
+      coalesce(bill_loan.lender_id, loan.lender_id, 0),
+      sum(
+        case
+          when (ba.id = le.debit_account) = (ba.account_type = 'a') then le.amount
+          else -le.amount
+        end
+      ),
+      count(*)
+    from
+      ledger_entry le
+      join book_account ba on ba.id in (le.debit_account, le.credit_account)
+      join ledger_trigger_event lte on lte.id = le.event_id
+      left join loan_data ld on ba.identifier_type = 'bill' and ld.id = ba.identifier
+      left join v3_loans bill_loan on bill_loan.id = ld.loan_id
+      left join v3_loans loan on ba.identifier_type in ('loan', 'card') and loan.id = ba.identifier
+    where
+      (
+        ba.account_type = 'r'
+        and ba.book_name in ('interest_accrued', 'late_fee', 'card_processing_fee', 'reload_fee')
+      )
+      or (
+        ba.account_type = 'a'
+        and ba.book_name in (
+          'interest_receivable', 'late_fine_receivable', 'card_processing_fee_receivable',
+          'reload_fee_receivable'
+        )
+      )
+    group by
+      1, 2, 3;
+        """
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER revenue_rollup_trigger ON ledger_entry")
+    op.execute("DROP FUNCTION update_revenue_rollup")
+    op.drop_table("revenue_rollup")
@@ -0,0 +1,160 @@
+"""book_account_daily_balance
+
+Revision ID: b3d1f6a2c9e4
+Revises: 9e3c39133b32
+Create Date: 2021-05-20 11:42:08.312547
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "b3d1f6a2c9e4"
+down_revision = "9e3c39133b32"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Balance of a book at the end of balance_date i.e. the balance of its latest entry (by id)
+    # whose event is posted on or before balance_date. Lender books aren't snapshotted.
+    op.create_table(
+        "book_account_daily_balance",
+        sa.Column("book_account_id", sa.Integer, nullable=False),
+        sa.Column("balance_date", sa.Date, nullable=False),
+        sa.Column("balance", sa.Numeric, nullable=False),
+        sa.Column("last_entry_id", sa.Integer, nullable=False),
+        sa.PrimaryKeyConstraint("book_account_id", "balance_date"),
+        sa.ForeignKeyConstraint(["book_account_id"], ["book_account.id"]),
+    )
+
+    # Start from the closest snapshot before till_date and only look at the entries after it.
+    op.execute(
+        """
+    CREATE OR REPLACE FUNCTION get_account_balance_by_book_id(
+      book_account integer, till_date timestamp, event_id integer
+    ) RETURNS numeric as $$
+    with snapshot as (
+      select
+        last_entry_id,
+        balance
+      from
+        book_account_daily_balance
+      where
+        book_account_id = $1
+        and $3 is null
+        and balance_date < $2 :: date
+      order by
+        balance_date desc limit 1
+    ),
+    latest_entry as (
+      select
+        case when le.debit_account = $1 then debit_account_balance else credit_account_balance end as account_balance
+      from
+        ledger_entry le,
+        ledger_trigger_event lte
+      where
+        (
+          le.debit_account = $1
+          or le.credit_account = $1
+        )
+        and lte.id = le.event_id
+        and le.id > coalesce((select last_entry_id from snapshot), 0)
+        and (($3 is not null and le.event_id <= $3) or ($3 is null and post_date <= $2))
+      order by
+        le.id desc limit 1
+    )
+    select account_balance from latest_entry
+    union all
+    select balance from snapshot where not exists (select 1 from latest_entry)
+    limit 1;
+    $$ language SQL;
+    """
+    )
+
+    # A new entry is the latest entry of every snapshot on or after its post date.
+    op.execute(
+        """
+    CREATE OR REPLACE FUNCTION calculate_book_account_balance()
+        RETURNS trigger
+        LANGUAGE plpgsql
+    AS
+    $$
+    DECLARE
+    debit_account book_account%ROWTYPE;
+    credit_account book_account%ROWTYPE;
+    event_post_date date;
+    BEGIN
+        select * INTO debit_account from book_account where id = NEW.debit_account;
+        select * INTO credit_account from book_account where id = NEW.credit_account;
+        select post_date::date INTO event_post_date from ledger_trigger_event where id = NEW.event_id;
+        if debit_account.identifier_type != 'lender' then 
+            NEW.debit_account_balance = (select case when debit_account.account_type in ('a', 'e') then debit_account.balance + NEW.amount else debit_account.balance - NEW.amount end);
+            UPDATE book_account set balance = NEW.debit_account_balance where id = NEW.debit_account;
+            UPDATE book_account_daily_balance set balance = NEW.debit_account_balance, last_entry_id = NEW.id
+            where book_account_id = NEW.debit_account and balance_date >= event_post_date;
+        end if;
+        if credit_account.identifier_type != 'lender' then
+            NEW.credit_account_balance = (select case when credit_account.account_type in ('a', 'e') then credit_account.balance - NEW.amount else credit_account.balance + NEW.amount end);
+            UPDATE book_account set balance = NEW.credit_account_balance where id = NEW.credit_account;
+            UPDATE book_account_daily_balance set balance = NEW.credit_account_balance, last_entry_id = NEW.id
+            where book_account_id = NEW.credit_account and balance_date >= event_post_date;
+        end if;
+        RETURN NEW;
+    END;
+    $$;
+        """
+    )
+
+
+def downgrade() -> None:
+    # Previous bodies, from 8f3690240c02 and 57e039ce4b31.
+    op.execute(
+        """
+    CREATE OR REPLACE FUNCTION get_account_balance_by_book_id(
+      book_account integer, till_date timestamp, event_id integer
+    ) RETURNS numeric as $$
+    select
+      case when le.debit_account = $1 then debit_account_balance else credit_account_balance end as account_balance
+    from
+      ledger_entry le,
+      ledger_trigger_event lte
+    where
+      (
+        le.debit_account = $1
+        or le.credit_account = $1
+      )
+      and lte.id = le.event_id
+      and (($3 is not null and event_id <= $3) or ($3 is null and post_date <= $2))
+    order by
+      le.id desc limit 1;
+    $$ language SQL;
+    """
+    )
+    op.execute(
+        """
+    CREATE OR REPLACE FUNCTION calculate_book_account_balance()
+        RETURNS trigger
+        LANGUAGE plpgsql
+    AS
+    $$
+    DECLARE
+    debit_account book_account%ROWTYPE;
+    credit_account book_account%ROWTYPE;
+    BEGIN
+        select * INTO debit_account from book_account where id = NEW.debit_account;
+        select * INTO credit_account from book_account where id = NEW.credit_account;
+        if debit_account.identifier_type != 'lender' then
+            NEW.debit_account_balance = (select case when debit_account.account_type in ('a', 'e') then debit_account.balance + NEW.amount else debit_account.balance - NEW.amount end);
+            UPDATE book_account set balance = NEW.debit_account_balance where id = NEW.debit_account;
+        end if;
+        if credit_account.identifier_type != 'lender' then
+            NEW.credit_account_balance = (select case when credit_account.account_type in ('a', 'e') then credit_account.balance - NEW.amount else credit_account.balance + NEW.amount end);
+            UPDATE book_account set balance = NEW.credit_account_balance where id = NEW.credit_account;
+        end if;
+        RETURN NEW;
+    END;
+    $$;
+        """
+    )
+    op.drop_table("book_account_daily_balance")
@@ -0,0 +1,29 @@
+"""book_account unique index
+
+Revision ID: b6e0a3f7c215
+Revises: f2b8d4c6e913
+Create Date: 2021-06-04 10:12:48.306512
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "b6e0a3f7c215"
+down_revision = "f2b8d4c6e913"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Book lookups by string go through this and bulk book creation upserts on it. Fails if the
+    # same book exists twice, those have to be merged first.
+    op.create_index(
+        "unique_index_on_book_string_book_account",
+        "book_account",
+        ["identifier", "identifier_type", "book_name", "account_type"],
+        unique=True,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("unique_index_on_book_string_book_account", "book_account")
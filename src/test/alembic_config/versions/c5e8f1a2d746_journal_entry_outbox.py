@@ -0,0 +1,44 @@
+"""journal_entry_outbox
+
+Revision ID: c5e8f1a2d746
+Revises: a4c7d2e9f013
+Create Date: 2021-05-31 11:26:09.672315
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "c5e8f1a2d746"
+down_revision = "a4c7d2e9f013"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "journal_entry_outbox",
+        sa.Column("id", sa.Integer, primary_key=True, nullable=False),
+        sa.Column("event_id", sa.Integer, nullable=False),
+        sa.Column("loan_id", sa.Integer, nullable=True),
+        sa.Column("user_id", sa.Integer, nullable=False),
+        sa.Column("processed_at", sa.TIMESTAMP(), nullable=True),
+        sa.Column("created_at", sa.TIMESTAMP(), nullable=False),
+        sa.Column("updated_at", sa.TIMESTAMP(), nullable=False),
+        sa.Column("performed_by", sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(["event_id"], ["ledger_trigger_event.id"]),
+        sa.ForeignKeyConstraint(["loan_id"], ["v3_loans.id"]),
+        sa.ForeignKeyConstraint(["user_id"], ["v3_users.id"]),
+    )
+    # The worker only ever reads what's pending.
+    op.create_index(
+        "ix_journal_entry_outbox_pending",
+        "journal_entry_outbox",
+        ["id"],
+        postgresql_where=sa.text("processed_at IS NULL"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_journal_entry_outbox_pending", "journal_entry_outbox")
+    op.drop_table("journal_entry_outbox")
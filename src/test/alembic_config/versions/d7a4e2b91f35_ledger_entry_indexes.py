@@ -0,0 +1,347 @@
+"""ledger_entry_indexes
+
+Revision ID: d7a4e2b91f35
+Revises: b3d1f6a2c9e4
+Create Date: 2021-05-24 16:05:41.902183
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "d7a4e2b91f35"
+down_revision = "b3d1f6a2c9e4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Included columns let the balance lookups run as index only scans on ledger_entry.
+    op.execute(
+        """
+        CREATE INDEX ix_ledger_entry_debit_account ON ledger_entry (debit_account, id)
+        INCLUDE (event_id, amount, debit_account_balance)
+        """
+    )
+    op.execute(
+        """
+        CREATE INDEX ix_ledger_entry_credit_account ON ledger_entry (credit_account, id)
+        INCLUDE (event_id, amount, credit_account_balance)
+        """
+    )
+    op.create_index("ix_ledger_entry_event_id", "ledger_entry", ["event_id"])
+    op.create_index(
+        "ix_ledger_trigger_event_loan_id_name_post_date",
+        "ledger_trigger_event",
+        ["loan_id", "name", "post_date"],
+    )
+
+    # Balance functions look up the debit and the credit side separately so that each side can
+    # use its own index. An OR across both columns can't.
+    op.execute(
+        """
+    CREATE OR REPLACE FUNCTION get_account_balance_by_book_id(
+      book_account integer, till_date timestamp, event_id integer
+    ) RETURNS numeric as $$
+    with snapshot as (
+      select
+        last_entry_id,
+        balance
+      from
+        book_account_daily_balance
+      where
+        book_account_id = $1
+        and $3 is null
+        and balance_date < $2 :: date
+      order by
+        balance_date desc limit 1
+    ),
+    latest_entry as (
+      select
+        account_balance
+      from
+        (
+          (
+            select
+              le.id,
+              1 as is_debit,
+              le.debit_account_balance as account_balance
+            from
+              ledger_entry le
+              join ledger_trigger_event lte on lte.id = le.event_id
+            where
+              le.debit_account = $1
+              and le.id > coalesce((select last_entry_id from snapshot), 0)
+              and (($3 is not null and le.event_id <= $3) or ($3 is null and lte.post_date <= $2))
+            order by
+              le.id desc limit 1
+          )
+          union all
+          (
+            select
+              le.id,
+              0 as is_debit,
+              le.credit_account_balance as account_balance
+            from
+              ledger_entry le
+              join ledger_trigger_event lte on lte.id = le.event_id
+            where
+              le.credit_account = $1
+              and le.id > coalesce((select last_entry_id from snapshot), 0)
+              and (($3 is not null and le.event_id <= $3) or ($3 is null and lte.post_date <= $2))
+            order by
+              le.id desc limit 1
+          )
+        ) entries
+      order by
+        id desc,
+        is_debit desc limit 1
+    )
+    select account_balance from latest_entry
+    union all
+    select balance from snapshot where not exists (select 1 from latest_entry)
+    limit 1;
+    $$ language SQL;
+    """
+    )
+
+    op.execute(
+        """
+    CREATE OR REPLACE FUNCTION get_account_balance_between_periods_by_book_id(
+      book_account integer, from_date timestamp, till_date timestamp DEFAULT now() at time zone 'Asia/Kolkata'
+    ) RETURNS numeric as $$ with entries as (
+      select
+        l.amount as debit_amount,
+        0 as credit_amount
+      from
+        ledger_entry l
+        join ledger_trigger_event lte on lte.id = l.event_id
+      where
+        l.debit_account = $1
+        and lte.post_date >= $2 and lte.post_date <= $3
+      union all
+      select
+        0,
+        l.amount
+      from
+        ledger_entry l
+        join ledger_trigger_event lte on lte.id = l.event_id
+      where
+        l.credit_account = $1
+        and lte.post_date >= $2 and lte.post_date <= $3
+    ),
+    balances as (
+      select
+        $1 as id,
+        sum(debit_amount) as debit_balance,
+        sum(credit_amount) as credit_balance
+      from
+        entries
+      group by
+        1
+    )
+    select
+      case when book.account_type in ('a', 'e') then debit_balance - credit_balance else credit_balance - debit_balance end as account_balance
+    from
+      balances
+      join book_account book on book.id = balances.id;
+    $$ language SQL;
+    """
+    )
+
+    op.execute(
+        """
+    CREATE OR REPLACE FUNCTION get_lender_account_balance(
+        book_identifier integer,
+        book_name varchar(50),
+        account_type varchar,
+        till_date timestamp DEFAULT now() at time zone 'Asia/Kolkata'
+    )
+    returns numeric
+    language plpgsql
+    as
+    $$
+    DECLARE
+    book_id integer;
+    account_balance numeric;
+    BEGIN
+        SELECT id INTO book_id
+        FROM book_account AS ba
+        WHERE ba.identifier = $1 AND identifier_type = 'lender' AND ba.book_name = $2 AND ba.account_type = $3;
+
+        with entries as (
+          select
+            l.amount as debit_amount,
+            0 as credit_amount
+          from
+            ledger_entry l
+            join ledger_trigger_event lte on lte.id = l.event_id
+          where
+            l.debit_account = book_id
+            and lte.post_date <= $4
+          union all
+          select
+            0,
+            l.amount
+          from
+            ledger_entry l
+            join ledger_trigger_event lte on lte.id = l.event_id
+          where
+            l.credit_account = book_id
+            and lte.post_date <= $4
+        ),
+        balances as (
+          select
+            book_id as id,
+            sum(debit_amount) as debit_balance,
+            sum(credit_amount) as credit_balance
+          from
+            entries
+          group by
+            1
+        )
+        select
+          case when book.account_type in ('a', 'e') then debit_balance - credit_balance else credit_balance - debit_balance end INTO account_balance
+        from
+          balances
+          join book_account book on book.id = balances.id;
+
+        RETURN account_balance;
+    END;
+    $$;
+    """
+    )
+
+
+def downgrade() -> None:
+    # Previous bodies, from b3d1f6a2c9e4, 8f3690240c02 and 57e039ce4b31.
+    op.execute(
+        """
+    CREATE OR REPLACE FUNCTION get_account_balance_by_book_id(
+      book_account integer, till_date timestamp, event_id integer
+    ) RETURNS numeric as $$
+    with snapshot as (
+      select
+        last_entry_id,
+        balance
+      from
+        book_account_daily_balance
+      where
+        book_account_id = $1
+        and $3 is null
+        and balance_date < $2 :: date
+      order by
+        balance_date desc limit 1
+    ),
+    latest_entry as (
+      select
+        case when le.debit_account = $1 then debit_account_balance else credit_account_balance end as account_balance
+      from
+        ledger_entry le,
+        ledger_trigger_event lte
+      where
+        (
+          le.debit_account = $1
+          or le.credit_account = $1
+        )
+        and lte.id = le.event_id
+        and le.id > coalesce((select last_entry_id from snapshot), 0)
+        and (($3 is not null and le.event_id <= $3) or ($3 is null and post_date <= $2))
+      order by
+        le.id desc limit 1
+    )
+    select account_balance from latest_entry
+    union all
+    select balance from snapshot where not exists (select 1 from latest_entry)
+    limit 1;
+    $$ language SQL;
+    """
+    )
+
+    op.execute(
+        """
+    CREATE OR REPLACE FUNCTION get_account_balance_between_periods_by_book_id(
+      book_account integer, from_date timestamp, till_date timestamp DEFAULT now() at time zone 'Asia/Kolkata'
+    ) RETURNS numeric as $$ with balances as (
+      select
+        $1 as id,
+        sum(
+          case when debit_account = $1 then l.amount else 0 end
+        ) as debit_balance,
+        sum(
+          case when credit_account = $1 then l.amount else 0 end
+        ) as credit_balance
+      from
+        ledger_entry l,
+        ledger_trigger_event lte
+      where
+        (debit_account = $1
+        or credit_account = $1) and lte.id = l.event_id
+        and lte.post_date >= $2 and lte.post_date <= $3
+      group by
+        1
+    )
+    select
+      case when book.account_type in ('a', 'e') then debit_balance - credit_balance else credit_balance - debit_balance end as account_balance
+    from
+      balances
+      join book_account book on book.id = balances.id;
+    $$ language SQL;
+    """
+    )
+
+    op.execute(
+        """
+    CREATE OR REPLACE FUNCTION get_lender_account_balance(
+        book_identifier integer,
+        book_name varchar(50),
+        account_type varchar,
+        till_date timestamp DEFAULT now() at time zone 'Asia/Kolkata'
+    )
+    returns numeric
+    language plpgsql
+    as
+    $$
+    DECLARE
+    book_id integer;
+    account_balance numeric;
+    BEGIN
+        SELECT id INTO book_id
+        FROM book_account AS ba
+        WHERE ba.identifier = $1 AND identifier_type = 'lender' AND ba.book_name = $2 AND ba.account_type = $3;
+
+        with balances as (
+          select
+            book_id as id,
+            sum(
+              case when debit_account = book_id then l.amount else 0 end
+            ) as debit_balance,
+            sum(
+              case when credit_account = book_id then l.amount else 0 end
+            ) as credit_balance
+          from
+            ledger_entry l,
+            ledger_trigger_event lte
+          where
+            (debit_account = book_id
+            or credit_account = book_id) and lte.id = l.event_id
+            and lte.post_date <= $4
+          group by
+            1
+        )
+        select
+          case when book.account_type in ('a', 'e') then debit_balance - credit_balance else credit_balance - debit_balance end INTO account_balance
+        from
+          balances
+          join book_account book on book.id = balances.id;
+
+        RETURN account_balance;
+    END;
+    $$;
+    """
+    )
+
+    op.drop_index("ix_ledger_trigger_event_loan_id_name_post_date", "ledger_trigger_event")
+    op.drop_index("ix_ledger_entry_event_id", "ledger_entry")
+    op.drop_index("ix_ledger_entry_credit_account", "ledger_entry")
+    op.drop_index("ix_ledger_entry_debit_account", "ledger_entry")
@@ -0,0 +1,31 @@
+"""loan_schedule loan level due_date index
+
+Revision ID: f2b8d4c6e913
+Revises: c5e8f1a2d746
+Create Date: 2021-06-02 16:41:27.193845
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "f2b8d4c6e913"
+down_revision = "c5e8f1a2d746"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # group_bills upserts the loan level emis on this. Fails if a loan already has two loan level
+    # emis on the same date, those have to be cleaned up first.
+    op.create_index(
+        "idx_uniq_on_loan_id_due_date_loan_schedule",
+        "loan_schedule",
+        ["loan_id", "due_date"],
+        unique=True,
+        postgresql_where=sa.text("bill_id IS NULL"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("idx_uniq_on_loan_id_due_date_loan_schedule", "loan_schedule")
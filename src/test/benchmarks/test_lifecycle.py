@@ -0,0 +1,226 @@
+"""
+Timing and query counts for the loan lifecycle on a synthetic portfolio. Skipped unless
+RUSH_BENCHMARK_OUTPUT is set to the json file the results should be written to, e.g.
+
+    RUSH_BENCHMARK_OUTPUT=bench.json RUSH_BENCHMARK_LOANS=20 pytest src/test/benchmarks
+
+Portfolio size is RUSH_BENCHMARK_LOANS loans with RUSH_BENCHMARK_BILLS bills each and
+RUSH_BENCHMARK_SWIPES swipes per bill.
+"""
+import json
+import os
+from collections import defaultdict
+from decimal import Decimal
+from test.utils import (
+    pay_payment_request,
+    payment_request_data,
+)
+from typing import (
+    Any,
+    Dict,
+    List,
+)
+
+import pytest
+from dateutil.relativedelta import relativedelta
+from pendulum import parse as parse_date  # type: ignore
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+
+from rush.accrue_financial_charges import accrue_interest_on_all_bills
+from rush.card import create_user_product
+from rush.card.base_card import BaseLoan
+from rush.create_bill import bill_generate
+from rush.create_card_swipe import create_card_swipe
+from rush.create_emi import daily_dpd_update
+from rush.instrumentation import (
+    OperationStats,
+    track_operation,
+)
+from rush.lender_funds import lender_interest_incur
+from rush.loan_schedule.loan_schedule import reset_loan_schedule
+from rush.models import (
+    Lenders,
+    Product,
+    User,
+)
+from rush.payments import payment_received
+from rush.utils import get_current_ist_time
+
+BENCHMARK_OUTPUT = os.environ.get("RUSH_BENCHMARK_OUTPUT")
+NUM_LOANS = int(os.environ.get("RUSH_BENCHMARK_LOANS", 5))
+NUM_BILLS = int(os.environ.get("RUSH_BENCHMARK_BILLS", 3))
+NUM_SWIPES = int(os.environ.get("RUSH_BENCHMARK_SWIPES", 3))
+
+pytestmark = pytest.mark.skipif(not BENCHMARK_OUTPUT, reason="RUSH_BENCHMARK_OUTPUT is not set")
+
+
+class BenchmarkRecorder:
+    def __init__(self) -> None:
+        self.samples: Dict[str, List[OperationStats]] = defaultdict(list)
+
+    def run(self, name: str, func: Any, *args: Any, **kwargs: Any) -> Any:
+        with track_operation(name) as operation:
+            result = func(*args, **kwargs)
+        self.samples[name].append(operation)
+        return result
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        summary = {}
+        for name, operations in self.samples.items():
+            calls = len(operations)
+            wall_times = sorted(operation.wall_time * 1000 for operation in operations)
+            query_count = sum(operation.total.query_count for operation in operations)
+            summary[name] = {
+                "calls": calls,
+                "wall_time_ms_total": round(sum(wall_times), 3),
+                "wall_time_ms_mean": round(sum(wall_times) / calls, 3),
+                "wall_time_ms_max": round(wall_times[-1], 3),
+                "query_time_ms_total": round(sum(op.total.duration for op in operations) * 1000, 3),
+                "query_count_total": query_count,
+                "query_count_mean": round(query_count / calls, 2),
+                "row_count_total": sum(operation.total.row_count for operation in operations),
+            }
+        return summary
+
+
+def enable_function_stats(session: Session) -> None:
+    """Function times need track_functions, which only superusers can turn on."""
+    savepoint = session.begin_nested()
+    try:
+        session.execute("set local track_functions = 'pl'")
+        savepoint.commit()
+    except DBAPIError:
+        savepoint.rollback()
+
+
+def get_balance_summary_stats(session: Session) -> Dict[str, Any]:
+    """
+    Cost of keeping loan_balance_summary up to date in this transaction. Every ledger entry on a
+    summary book upserts its loan's row.
+    """
+    table_writes = dict(
+        session.execute(
+            """
+            select relname, n_tup_ins + n_tup_upd from pg_stat_xact_user_tables
+            where relname in ('ledger_entry', 'loan_balance_summary')
+            """
+        ).fetchall()
+    )
+    trigger_times = dict(
+        session.execute(
+            """
+            select funcname, round(total_time::numeric, 3) from pg_stat_xact_user_functions
+            where funcname in ('update_loan_balance_summary', 'update_loan_fee_balance')
+            """
+        ).fetchall()
+    )
+    return {
+        "ledger_entry_writes": table_writes.get("ledger_entry", 0),
+        "summary_row_writes": table_writes.get("loan_balance_summary", 0),
+        "trigger_time_ms": {name: float(total_time) for name, total_time in trigger_times.items()},
+    }
+
+
+def create_portfolio_loan(session: Session, recorder: BenchmarkRecorder, user_id: int) -> BaseLoan:
+    session.add(User(id=user_id, performed_by=123))
+    session.flush()
+    user_loan = create_user_product(
+        session=session,
+        user_id=user_id,
+        card_activation_date=parse_date("2020-04-02").date(),
+        card_type="ruby",
+        rc_rate_of_interest_monthly=Decimal(3),
+        lender_id=62311,
+        tenure=12,
+    )
+    for bill_number in range(NUM_BILLS):
+        for swipe_number in range(NUM_SWIPES):
+            txn_time = parse_date("2020-04-08 10:00:00") + relativedelta(
+                months=bill_number, hours=swipe_number
+            )
+            recorder.run(
+                "create_card_swipe",
+                create_card_swipe,
+                session=session,
+                user_loan=user_loan,
+                txn_time=txn_time,
+                amount=Decimal(1000 + 100 * swipe_number),
+                description="BigB.com",
+                txn_ref_no=f"bench_{user_id}_{bill_number}_{swipe_number}",
+                trace_no="123456",
+            )
+        recorder.run("bill_generate", bill_generate, user_loan=user_loan)
+    return user_loan
+
+
+def test_loan_lifecycle(session: Session) -> None:
+    session.add(Lenders(id=62311, performed_by=123, lender_name="DMI"))
+    session.add(Product(product_name="ruby"))
+    session.flush()
+    enable_function_stats(session)
+    recorder = BenchmarkRecorder()
+
+    user_loans = [create_portfolio_loan(session, recorder, 900000 + i) for i in range(NUM_LOANS)]
+
+    for user_loan in user_loans:
+        post_date = None
+        for bill in user_loan.get_all_bills():
+            post_date = parse_date(str(bill.table.bill_due_date)) + relativedelta(days=1)
+            recorder.run(
+                "accrue_interest_on_all_bills",
+                accrue_interest_on_all_bills,
+                session,
+                post_date,
+                user_loan,
+            )
+            recorder.run("daily_dpd_update", daily_dpd_update, session, user_loan, post_date)
+
+        payment_request_id = f"bench_{user_loan.id}"
+        payment_request_data(
+            session=session,
+            type="collection",
+            payment_request_amount=Decimal(2000),
+            user_id=user_loan.user_id,
+            payment_request_id=payment_request_id,
+        )
+        payment_requests_data = pay_payment_request(
+            session=session,
+            payment_request_id=payment_request_id,
+            payment_date=post_date + relativedelta(days=1),
+        )
+        recorder.run(
+            "payment_received",
+            payment_received,
+            session=session,
+            user_loan=user_loan,
+            payment_request_data=payment_requests_data,
+        )
+        recorder.run("reset_loan_schedule", reset_loan_schedule, user_loan, session)
+
+    recorder.run(
+        "lender_interest_incur",
+        lender_interest_incur,
+        session,
+        from_date=parse_date("2020-04-01").date(),
+        to_date=parse_date("2020-04-01").date() + relativedelta(months=NUM_BILLS + 1),
+    )
+
+    results = {
+        "generated_at": get_current_ist_time().isoformat(),
+        "commit": os.environ.get("GITHUB_SHA"),
+        "parameters": {"loans": NUM_LOANS, "bills_per_loan": NUM_BILLS, "swipes_per_bill": NUM_SWIPES},
+        "operations": recorder.summary(),
+        "loan_balance_summary": get_balance_summary_stats(session),
+    }
+    with open(BENCHMARK_OUTPUT, "w") as f:  # type: ignore
+        json.dump(results, f, indent=2)
+    assert set(results["operations"]) == {
+        "create_card_swipe",
+        "bill_generate",
+        "accrue_interest_on_all_bills",
+        "daily_dpd_update",
+        "payment_received",
+        "reset_loan_schedule",
+        "lender_interest_incur",
+    }
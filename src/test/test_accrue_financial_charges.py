@@ -0,0 +1,56 @@
+from decimal import Decimal
+from test.utils import (
+    create_lenders_and_products,
+    create_loan_with_bills,
+    get_loan_state,
+)
+
+from dateutil.relativedelta import relativedelta
+from pendulum import parse as parse_date  # type: ignore
+from sqlalchemy.orm import Session
+
+from rush.accrue_financial_charges import (
+    accrue_interest_for_portfolio,
+    accrue_interest_on_all_bills,
+)
+
+
+def test_accrue_interest_for_portfolio(session: Session) -> None:
+    create_lenders_and_products(session)
+    user_loans = [create_loan_with_bills(session, user_id) for user_id in (501, 502, 503)]
+    first_due_date = user_loans[0].get_latest_generated_bill().table.bill_due_date
+    post_date = parse_date(str(first_due_date)) + relativedelta(days=1)
+
+    accrue_interest_on_all_bills(session, post_date, user_loans[0])
+    accrued_loans = accrue_interest_for_portfolio(
+        session, post_date, loan_ids=[user_loans[1].id, user_loans[2].id], chunk_size=1
+    )
+    assert accrued_loans == 2
+
+    expected_state = get_loan_state(session, user_loans[0])
+    # A month of 3% on each bill.
+    assert expected_state[0][-1] == ("accrue_interest", post_date.naive(), Decimal("75.67"))
+    assert expected_state[1] == [
+        Decimal("30.67"),
+        Decimal("30.67"),
+        Decimal("1030.67"),
+        Decimal("228.00"),
+        Decimal(1000),
+        Decimal("45.00"),
+        Decimal("45.00"),
+        Decimal("1545.00"),
+        Decimal("170.00"),
+        Decimal(1500),
+    ]
+    assert get_loan_state(session, user_loans[1]) == expected_state
+    assert get_loan_state(session, user_loans[2]) == expected_state
+
+    # Without loan ids every loan with an emi due in the month before gets picked.
+    next_post_date = post_date + relativedelta(months=1)
+    assert accrue_interest_for_portfolio(session, next_post_date) == 3
+    expected_state = get_loan_state(session, user_loans[0])
+    assert expected_state[0][-1] == ("accrue_interest", next_post_date.naive(), Decimal("75.67"))
+    assert expected_state[1][0] == Decimal("61.34")
+    assert expected_state[1][5] == Decimal("90.00")
+    assert get_loan_state(session, user_loans[1]) == expected_state
+    assert get_loan_state(session, user_loans[2]) == expected_state
@@ -0,0 +1,131 @@
+from decimal import Decimal
+from test.utils import (
+    create_lenders_and_products,
+    create_loan_with_bills,
+    pay_payment_request,
+    payment_request_data,
+)
+from typing import (
+    Any,
+    Callable,
+    Tuple,
+)
+
+from dateutil.relativedelta import relativedelta
+from pendulum import parse as parse_date  # type: ignore
+from sqlalchemy.orm import Session
+
+from rush.accrue_financial_charges import (
+    accrue_interest_on_all_bills,
+    accrue_late_charges,
+)
+from rush.instrumentation import track_operation
+from rush.ledger_utils import get_account_balances
+from rush.models import Fee
+from rush.payments import payment_received
+
+
+def test_bill_registry(session: Session) -> None:
+    create_lenders_and_products(session)
+    user_loan = create_loan_with_bills(session, 551)
+
+    def count_queries(func: Callable[[], Any]) -> Tuple[Any, int]:
+        with track_operation("bill_lookup") as operation:
+            result = func()
+        return result, operation.total.query_count
+
+    bills = user_loan.get_all_bills()
+    assert [bill.table.is_generated for bill in bills] == [True, True]
+    # Repeated lookups are served from the registry.
+    assert count_queries(user_loan.get_all_bills) == (bills, 0)
+    assert count_queries(user_loan.get_latest_generated_bill) == (bills[-1], 0)
+    assert count_queries(user_loan.get_latest_bill) == (bills[-1], 0)
+    assert count_queries(user_loan.get_latest_bill_to_generate) == (None, 0)
+
+    # Changing a bill drops it.
+    bills[-1].table.is_generated = False
+    session.flush()
+    assert count_queries(user_loan.get_latest_bill_to_generate)[1] == 1
+    assert user_loan.get_latest_bill_to_generate().table.id == bills[-1].table.id
+    assert user_loan.get_latest_generated_bill().table.id == bills[0].table.id
+    bills[-1].table.is_generated = True
+
+    # So does a new bill.
+    new_bill = user_loan.create_bill(
+        bill_start_date=parse_date("2020-06-01").date(),
+        bill_close_date=parse_date("2020-07-01").date(),
+        bill_due_date=parse_date("2020-07-15").date(),
+        lender_id=62311,
+        is_generated=False,
+    )
+    assert user_loan.get_latest_bill_to_generate().table.id == new_bill.table.id
+    assert len(user_loan.get_all_bills()) == 3
+
+
+def test_loan_balance_summary(session: Session) -> None:
+    create_lenders_and_products(session)
+    user_loan = create_loan_with_bills(session, 561)
+    first_due_date = user_loan.get_latest_generated_bill().table.bill_due_date
+    post_date = parse_date(str(first_due_date)) + relativedelta(days=1)
+    accrue_interest_on_all_bills(session, post_date, user_loan)
+    accrue_late_charges(session, user_loan, post_date, Decimal(118))
+
+    def assert_summary_matches_ledger() -> None:
+        bill_ids = [bill.table.id for bill in user_loan.get_all_bills()]
+        book_names = ("min", "max", "principal_receivable", "interest_receivable")
+        balances = get_account_balances(
+            session,
+            [f"{bill_id}/bill/{book_name}/a" for bill_id in bill_ids for book_name in book_names]
+            + [f"{user_loan.id}/loan/pre_payment/l"],
+        )
+        unpaid_fee = sum(
+            fee.remaining_fee_amount
+            for fee in session.query(Fee).filter(
+                Fee.identifier == "bill", Fee.identifier_id.in_(bill_ids), Fee.fee_status == "UNPAID"
+            )
+        )
+        summary = user_loan.get_balance_summary()
+        for book_name, balance in zip(
+            book_names,
+            (
+                summary.min_balance,
+                summary.max_balance,
+                summary.principal_balance,
+                summary.interest_balance,
+            ),
+        ):
+            assert balance == sum(balances[f"{bill_id}/bill/{book_name}/a"] for bill_id in bill_ids)
+        assert summary.prepayment_balance == balances[f"{user_loan.id}/loan/pre_payment/l"]
+        assert summary.fee_balance == unpaid_fee
+        assert user_loan.get_remaining_max() == user_loan.get_remaining_max(
+            date_to_check_against=post_date + relativedelta(years=1)
+        )
+        assert user_loan.get_remaining_min() == user_loan.get_remaining_min(
+            date_to_check_against=post_date + relativedelta(years=1)
+        )
+
+    assert_summary_matches_ledger()
+    assert user_loan.get_balance_summary().fee_balance == Decimal(118)
+
+    # Pay off the fee and interest, then pay more than what's due.
+    for payment_request_id, amount in (("summary_1", Decimal(300)), ("summary_2", Decimal(5000))):
+        payment_request_data(
+            session=session,
+            type="collection",
+            payment_request_amount=amount,
+            user_id=user_loan.user_id,
+            payment_request_id=payment_request_id,
+        )
+        payment_requests_data = pay_payment_request(
+            session=session,
+            payment_request_id=payment_request_id,
+            payment_date=post_date + relativedelta(days=1),
+        )
+        payment_received(
+            session=session, user_loan=user_loan, payment_request_data=payment_requests_data
+        )
+        assert_summary_matches_ledger()
+    summary = user_loan.get_balance_summary()
+    assert summary.fee_balance == 0
+    assert summary.max_balance == 0
+    assert summary.prepayment_balance > 0
@@ -1,6 +1,10 @@
 from decimal import Decimal
+from random import Random
+from types import SimpleNamespace
 
 from rush.loan_schedule.calculations import get_down_payment
+from rush.models import Fee
+from rush.payments import split_amount_to_slide
 
 
 def test_get_down_payment_1() -> None:
@@ -21,3 +25,57 @@ def test_get_down_payment_amount_with_first_emi() -> None:
         include_first_emi_amount=True,
     )
     assert downpayment_amount == Decimal("2910")
+
+
+def test_split_amount_to_slide_properties() -> None:
+    rng = Random(13)
+    cent = Decimal("0.01")
+    for _ in range(200):
+        bills = [
+            SimpleNamespace(table=SimpleNamespace(id=bill_id)) for bill_id in range(1, rng.randint(1, 5))
+        ]
+        fees = [
+            Fee(
+                identifier="bill",
+                identifier_id=rng.choice(bills).table.id,
+                name=rng.choice(["atm_fee", "late_fee"]),
+                gross_amount=Decimal(rng.randint(1, 50000)) * cent,
+                gross_amount_paid=Decimal(0),
+            )
+            for _ in range(rng.randint(0, 3) if bills else 0)
+        ]
+        if rng.random() < 0.3:
+            fees.append(
+                Fee(
+                    identifier="loan",
+                    identifier_id=100,
+                    name="card_activation_fees",
+                    gross_amount=Decimal(rng.randint(1, 50000)) * cent,
+                    gross_amount_paid=Decimal(0),
+                )
+            )
+        interest_due = {bill.table.id: Decimal(rng.randint(0, 50000)) * cent for bill in bills}
+        principal_due = {bill.table.id: Decimal(rng.randint(0, 500000)) * cent for bill in bills}
+        amount = Decimal(rng.randint(1, 1000000)) * cent
+
+        split_info = split_amount_to_slide(
+            amount, unpaid_bills=bills, fees=fees, interest_due=interest_due, principal_due=principal_due
+        )
+
+        # Each part takes what's left of the amount, up to its dues. Pro rata rounding can leave
+        # at most a cent per row unallocated.
+        remaining = amount
+        for split_type, dues in (
+            ("fee", sum(fee.remaining_fee_amount for fee in fees)),
+            ("interest", sum(interest_due.values())),
+            ("principal", sum(principal_due.values())),
+        ):
+            rows = [split for split in split_info if split["type"] == split_type]
+            allocated = sum(split["amount_to_adjust"] for split in rows)
+            expected = min(dues, remaining)
+            assert expected - cent * len(rows) <= allocated <= expected
+            remaining -= expected
+        for split in split_info:
+            if split["type"] in ("interest", "principal"):
+                dues = interest_due if split["type"] == "interest" else principal_due
+                assert split["amount_to_adjust"] <= dues[split["bill"].table.id]
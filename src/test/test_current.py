@@ -523,7 +523,7 @@ def test_generate_bill_1(session: Session) -> None:
     _, min_amount = get_account_balance_from_str(session, book_string=f"{bill_id}/bill/min/a")
     assert min_amount == 114
 
-    dpd_events = session.query(EventDpd).filter_by(loan_id=uc.loan_id).all()
+    dpd_events = session.query(EventDpd).filter_by(loan_id=uc.loan_id).order_by(EventDpd.id).all()
     assert dpd_events[0].balance == Decimal(1000)
 
     interest_left_to_accrue = get_interest_left_to_accrue(session, user_loan)
@@ -609,7 +609,7 @@ def test_generate_bill_reducing_interest_1(session: Session) -> None:
 
     update_event_with_dpd(user_loan=user_loan, event=event)
 
-    dpd_events = session.query(EventDpd).filter_by(loan_id=uc.loan_id).all()
+    dpd_events = session.query(EventDpd).filter_by(loan_id=uc.loan_id).order_by(EventDpd.id).all()
     assert dpd_events[0].balance == Decimal(1200)
 
     emis = uc.get_loan_schedule()
@@ -2414,7 +2414,7 @@ def test_with_live_user_loan_id_4134872(session: Session) -> None:
 
     event_date = parse_date("2020-08-21 00:05:00")
 
-    dpd_events = session.query(EventDpd).filter_by(loan_id=uc.loan_id).all()
+    dpd_events = session.query(EventDpd).filter_by(loan_id=uc.loan_id).order_by(EventDpd.id).all()
 
     last_entry_first_bill = dpd_events[-2]
     last_entry_second_bill = dpd_events[-1]
@@ -3141,7 +3141,7 @@ def test_prepayment(session: Session) -> None:
     )
     bill_id = swipe["data"].loan_id
 
-    emi_payment_mapping = session.query(PaymentMapping).all()
+    emi_payment_mapping = session.query(PaymentMapping).order_by(PaymentMapping.id).all()
     first_payment_mapping = emi_payment_mapping[0]
     assert first_payment_mapping.amount_settled == Decimal(114)
 
@@ -5434,6 +5434,7 @@ def test_updated_emi_payment_mapping_after_early_loan_close(session: Session) ->
     pm = (
         session.query(PaymentMapping)
         .filter(PaymentMapping.payment_request_id == "a12319", PaymentMapping.row_status == "active")
+        .order_by(PaymentMapping.id)
         .all()
     )
 
@@ -13,19 +13,28 @@ from rush.card import create_user_product
 from rush.card.base_card import BaseLoan
 from rush.create_bill import bill_generate
 from rush.create_card_swipe import create_card_swipe
-from rush.ledger_utils import get_account_balance_from_str
+from rush.ledger_utils import (
+    create_ledger_entry_from_str,
+    get_account_balance_from_str,
+)
 from rush.lender_funds import lender_interest_incur
+from rush.lender_interest import iter_lender_interest_on_portfolio
 from rush.models import (
     LedgerTriggerEvent,
     Lenders,
     Product,
+    RevenueRollup,
     User,
 )
 from rush.payments import (
     payment_received,
     settle_payment_in_bank,
 )
-from rush.recon.revenue_earned import get_revenue_earned_in_a_period
+from rush.recon.dmi_interest_on_portfolio import interest_on_dmi_portfolio
+from rush.recon.revenue_earned import (
+    compact_revenue_rollup,
+    get_revenue_earned_in_a_period,
+)
 
 
 def create_products(session: Session) -> None:
@@ -207,7 +216,8 @@ def test_dmi_recon_process_1(session: Session) -> None:
     _, lender_payable_ananth = get_account_balance_from_str(
         session, f"{user_loan_ananth.loan_id}/loan/lender_payable/l"
     )
-    assert lender_payable_ananth == Decimal("6558.73")  # This is incorrect. Earlier it was 6557.24.
+    # Was 6558.73 when the last interest of the previous loan got carried into this one.
+    assert lender_payable_ananth == Decimal("6558.68")
 
     # We generate the two bills.
     bill_raghav = bill_generate(user_loan=user_loan_raghav)
@@ -413,6 +423,46 @@ def test_dmi_recon_process_1(session: Session) -> None:
     # Now that we've received the payment, we check how much revenue we've made.
     revenue_earned = get_revenue_earned_in_a_period(session, from_date=from_date, to_date=to_date)
     assert revenue_earned == Decimal("83.33")
+    # Both loans are with DMI.
+    assert get_revenue_earned_in_a_period(session, from_date, to_date, lender_id=62311) == revenue_earned
+    assert get_revenue_earned_in_a_period(session, from_date, to_date, lender_id=1756833) == 0
+    # Each day of the range is rolled up on its own.
+    assert (
+        sum(
+            get_revenue_earned_in_a_period(session, day, day)
+            for day in (
+                from_date + relativedelta(days=days) for days in range((to_date - from_date).days + 1)
+            )
+        )
+        == revenue_earned
+    )
+
+    # An entry with the same book on both sides doesn't move it.
+    same_book_event = LedgerTriggerEvent.ledger_new(
+        session, name="same_book_test", loan_id=user_loan_ananth.loan_id, post_date=from_date
+    )
+    session.flush()
+    create_ledger_entry_from_str(
+        session,
+        event_id=same_book_event.id,
+        debit_book_str=f"{bill_ananth.id}/bill/interest_receivable/a",
+        credit_book_str=f"{bill_ananth.id}/bill/interest_receivable/a",
+        amount=Decimal(50),
+    )
+    assert get_revenue_earned_in_a_period(session, from_date, to_date) == revenue_earned
+
+    # Compaction leaves one row per day, book and lender with the same totals.
+    row_count = session.query(RevenueRollup).count()
+    compacted_row_count = compact_revenue_rollup(session, to_date + relativedelta(days=1))
+    assert compacted_row_count < row_count
+    assert session.query(RevenueRollup).count() == compacted_row_count
+    assert (
+        session.query(RevenueRollup.day, RevenueRollup.book_name, RevenueRollup.lender_id)
+        .distinct()
+        .count()
+        == compacted_row_count
+    )
+    assert get_revenue_earned_in_a_period(session, from_date, to_date) == revenue_earned
 
     # Incur interest for this month's period.
     lender_interest_incur(session, from_date=from_date, to_date=to_date)
@@ -421,3 +471,17 @@ def test_dmi_recon_process_1(session: Session) -> None:
         session, f"{user_loan_raghav.loan_id}/loan/lender_payable/l"
     )
     assert lender_payable_raghav == Decimal("815.90")
+
+
+def test_lender_interest_matches_portfolio_query(session: Session) -> None:
+    test_lenders(session)
+    card_db_updates(session)
+    user_loan = _create_user_ananth_and_do_swipes(session)
+    bill_generate(user_loan=user_loan)
+
+    # With a single loan there's nothing to carry across loans and the old query is exact.
+    for from_date, to_date in (("2020-01-01", "2020-01-31"), ("2020-01-13", "2020-02-10")):
+        params = {"from_date": parse_date(from_date).date(), "to_date": parse_date(to_date).date()}
+        expected = session.execute(interest_on_dmi_portfolio, params).fetchall()
+        assert expected
+        assert list(iter_lender_interest_on_portfolio(session, **params)) == expected
@@ -0,0 +1,138 @@
+from decimal import Decimal
+from test.utils import (
+    create_lenders_and_products,
+    create_loan_with_bills,
+    pay_payment_request,
+    payment_request_data,
+)
+
+from dateutil.relativedelta import relativedelta
+from pendulum import parse as parse_date  # type: ignore
+from sqlalchemy.orm import Session
+
+from rush.accrue_financial_charges import accrue_interest_on_all_bills
+from rush.card.base_card import BaseLoan
+from rush.create_emi import (
+    daily_dpd_update,
+    daily_dpd_update_bulk,
+    update_event_with_dpd,
+)
+from rush.models import (
+    EventDpd,
+    LedgerTriggerEvent,
+    LoanSchedule,
+)
+from rush.payments import payment_received
+
+
+def get_dpd_state(session: Session, user_loan: BaseLoan) -> list:
+    emi_dpds = [
+        dpd
+        for dpd, in session.query(LoanSchedule.dpd)
+        .filter(LoanSchedule.loan_id == user_loan.id)
+        .order_by(LoanSchedule.bill_id.nullsfirst(), LoanSchedule.emi_number)
+    ]
+    event_dpds = (
+        session.query(
+            LedgerTriggerEvent.post_date, EventDpd.dpd, EventDpd.balance, EventDpd.debit, EventDpd.credit
+        )
+        .join(LedgerTriggerEvent, LedgerTriggerEvent.id == EventDpd.event_id)
+        .filter(EventDpd.loan_id == user_loan.id, LedgerTriggerEvent.name == "daily_dpd_update")
+        .order_by(EventDpd.id)
+        .all()
+    )
+    session.refresh(user_loan)
+    return [emi_dpds, event_dpds, user_loan.dpd, user_loan.ever_dpd]
+
+
+def test_daily_dpd_update_bulk(session: Session) -> None:
+    create_lenders_and_products(session)
+    user_loans = [create_loan_with_bills(session, user_id) for user_id in (601, 602, 603, 604)]
+
+    # Second pair has paid part of the first bill.
+    for user_loan in user_loans[2:]:
+        payment_request_id = f"dpd_bulk_{user_loan.id}"
+        payment_request_data(
+            session=session,
+            type="collection",
+            payment_request_amount=Decimal(500),
+            user_id=user_loan.user_id,
+            payment_request_id=payment_request_id,
+        )
+        payment_requests_data = pay_payment_request(
+            session=session,
+            payment_request_id=payment_request_id,
+            payment_date=parse_date("2020-05-10 14:00:00"),
+        )
+        payment_received(
+            session=session, user_loan=user_loan, payment_request_data=payment_requests_data
+        )
+
+    # Loan dpd of the unpaid and the paid pair on each day.
+    expected_loan_dpds = {
+        "2020-05-12 00:00:00": (-3, -34),
+        "2020-06-20 00:00:00": (36, 5),
+        "2020-09-01 00:00:00": (109, 78),
+    }
+    for post_date, (unpaid_loan_dpd, paid_loan_dpd) in expected_loan_dpds.items():
+        post_date = parse_date(post_date)
+        daily_dpd_update(session, user_loans[0], post_date)
+        daily_dpd_update(session, user_loans[2], post_date)
+        daily_dpd_update_bulk(session, post_date, [user_loans[1].id, user_loans[3].id], chunk_size=1)
+
+        expected_state = get_dpd_state(session, user_loans[0])
+        assert expected_state[1]  # Has bill level dpd rows.
+        assert expected_state[2] == unpaid_loan_dpd
+        assert get_dpd_state(session, user_loans[1]) == expected_state
+        paid_state = get_dpd_state(session, user_loans[2])
+        assert paid_state[2] == paid_loan_dpd
+        assert get_dpd_state(session, user_loans[3]) == paid_state
+    # Each day adds a row per bill with its balance.
+    assert [(dpd, balance) for _, dpd, balance, _, _ in paid_state[1][-2:]] == [
+        (48, Decimal(800)),
+        (48, Decimal(1200)),
+    ]
+
+
+def test_update_event_with_dpd_incremental(session: Session) -> None:
+    create_lenders_and_products(session)
+    user_loan = create_loan_with_bills(session, 511)
+    first_due_date = user_loan.get_latest_generated_bill().table.bill_due_date
+    accrue_interest_on_all_bills(
+        session, parse_date(str(first_due_date)) + relativedelta(days=1), user_loan
+    )
+
+    events = (
+        session.query(LedgerTriggerEvent)
+        .filter(LedgerTriggerEvent.loan_id == user_loan.id)
+        .order_by(LedgerTriggerEvent.id)
+        .all()
+    )
+    for event in events:
+
+        def get_event_dpds() -> list:
+            rows = (
+                session.query(
+                    EventDpd.bill_id, EventDpd.debit, EventDpd.credit, EventDpd.balance, EventDpd.dpd
+                )
+                .filter(EventDpd.event_id == event.id)
+                .order_by(EventDpd.id)
+                .all()
+            )
+            session.query(EventDpd).filter(EventDpd.event_id == event.id).delete()
+            return rows
+
+        get_event_dpds()
+        # Passing to_date takes the per entry path.
+        update_event_with_dpd(user_loan=user_loan, to_date=event.post_date, event=event)
+        expected_dpds = get_event_dpds()
+        expected_loan_dpd = user_loan.dpd
+        update_event_with_dpd(user_loan=user_loan, event=event)
+        assert get_event_dpds() == expected_dpds
+        assert user_loan.dpd == expected_loan_dpd
+    # The accrual's rows, a month and a day after the first due date.
+    assert [row[1:] for row in expected_dpds] == [
+        (Decimal(0), Decimal("30.67"), Decimal("1030.67"), 32),
+        (Decimal(0), Decimal("45.00"), Decimal("1545.00"), 32),
+    ]
+    assert user_loan.dpd == 32
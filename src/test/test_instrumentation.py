@@ -0,0 +1,63 @@
+import json
+import logging
+from test.utils import (
+    create_lenders_and_products,
+    create_loan_with_bills,
+)
+
+from dateutil.relativedelta import relativedelta
+from pendulum import parse as parse_date  # type: ignore
+from sqlalchemy.orm import Session
+
+from rush.accrue_financial_charges import accrue_interest_on_all_bills
+from rush.create_emi import daily_dpd_update_bulk
+from rush.instrumentation import (
+    get_current_operation,
+    track_operation,
+)
+
+
+def test_track_operation(session: Session) -> None:
+    create_lenders_and_products(session)
+    with track_operation("bill_cycle") as operation:
+        user_loan = create_loan_with_bills(session, 521)
+        # Swipes and bill generation are instrumented themselves but stay part of the outer block.
+        assert get_current_operation() is operation
+    assert get_current_operation() is None
+
+    assert operation.name == "bill_cycle"
+    assert operation.total.query_count > 0
+    assert operation.total.row_count > 0
+    assert operation.wall_time >= operation.total.duration > 0
+    assert {"card_transaction", "bill_generate"} <= set(operation.by_event)
+    assert sum(stats.query_count for stats in operation.by_event.values()) == operation.total.query_count
+
+    # Nothing is collected outside of an operation.
+    query_count = operation.total.query_count
+    session.query(user_loan.__class__).count()
+    assert operation.total.query_count == query_count
+
+
+def test_operation_log_line(session: Session, caplog) -> None:  # type: ignore
+    create_lenders_and_products(session)
+    user_loan = create_loan_with_bills(session, 522)
+    post_date = parse_date(str(user_loan.get_latest_generated_bill().table.bill_due_date))
+
+    with caplog.at_level(logging.INFO, logger="rush.instrumentation"):
+        accrue_interest_on_all_bills(session, post_date + relativedelta(days=1), user_loan)
+    log_lines = [json.loads(record.getMessage()) for record in caplog.records]
+
+    assert len(log_lines) == 1
+    assert log_lines[0]["operation"] == "accrue_interest_on_all_bills"
+    assert log_lines[0]["query_count"] > 0
+    assert log_lines[0]["events"]["accrue_interest"]["query_count"] > 0
+
+
+def test_core_inserted_events(session: Session) -> None:
+    create_lenders_and_products(session)
+    user_loan = create_loan_with_bills(session, 523)
+
+    with track_operation("dpd") as operation:
+        daily_dpd_update_bulk(session, parse_date("2020-06-20 00:00:00"), [user_loan.id])
+    # The event insert and the three dpd statements.
+    assert operation.by_event["daily_dpd_update"].query_count == 4
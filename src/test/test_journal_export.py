@@ -0,0 +1,127 @@
+import csv
+import json
+from decimal import Decimal
+from io import StringIO
+from test.utils import (
+    create_lenders_and_products,
+    create_loan_with_bills,
+    pay_payment_request,
+    payment_request_data,
+)
+
+from pendulum import parse as parse_date  # type: ignore
+from sqlalchemy.orm import Session
+
+from rush.create_emi import process_journal_entry_outbox
+from rush.journal_export import (
+    JOURNAL_EXPORT_FIELDS,
+    export_journal_entries_csv,
+    export_journal_entries_jsonl,
+    iter_journal_entries,
+)
+from rush.models import (
+    JournalEntry,
+    JournalEntryOutbox,
+)
+from rush.payments import payment_received
+
+
+def _pay(session: Session, user_loan, payment_request_id: str, payment_date: str) -> None:
+    payment_request_data(
+        session=session,
+        type="collection",
+        payment_request_amount=Decimal(500),
+        user_id=user_loan.user_id,
+        payment_request_id=payment_request_id,
+    )
+    payment_requests_data = pay_payment_request(
+        session=session,
+        payment_request_id=payment_request_id,
+        payment_date=parse_date(payment_date),
+    )
+    payment_received(session=session, user_loan=user_loan, payment_request_data=payment_requests_data)
+
+
+def _get_journal_entries(session: Session, user_loan) -> list:
+    return (
+        session.query(
+            JournalEntry.voucher_type,
+            JournalEntry.date_ledger,
+            JournalEntry.ledger,
+            JournalEntry.group_name,
+            JournalEntry.debit,
+            JournalEntry.credit,
+            JournalEntry.narration,
+            JournalEntry.sort_order,
+            JournalEntry.ptype,
+        )
+        .filter(JournalEntry.loan_id == user_loan.id)
+        .order_by(JournalEntry.id)
+        .all()
+    )
+
+
+def test_deferred_journal_entries(session: Session) -> None:
+    create_lenders_and_products(session)
+    immediate_loan = create_loan_with_bills(session, 572)
+    _pay(session, immediate_loan, "immediate_1", "2020-05-20 10:00:00")
+
+    session.info["defer_journal_entries"] = True
+    try:
+        deferred_loan = create_loan_with_bills(session, 573)
+        _pay(session, deferred_loan, "deferred_1", "2020-05-20 10:00:00")
+    finally:
+        session.info.pop("defer_journal_entries")
+
+    assert _get_journal_entries(session, deferred_loan) == []
+    queued = (
+        session.query(JournalEntryOutbox).filter(JournalEntryOutbox.loan_id == deferred_loan.id).count()
+    )
+    assert queued > 0
+
+    assert process_journal_entry_outbox(session, batch_size=2) == 2
+    assert process_journal_entry_outbox(session) == queued - 2
+    assert process_journal_entry_outbox(session) == 0
+
+    immediate_entries = _get_journal_entries(session, immediate_loan)
+    assert len(immediate_entries) > 0
+    assert _get_journal_entries(session, deferred_loan) == immediate_entries
+
+
+def test_journal_export(session: Session) -> None:
+    create_lenders_and_products(session)
+    user_loan = create_loan_with_bills(session, 571)
+    _pay(session, user_loan, "journal_1", "2020-05-20 10:00:00")
+    _pay(session, user_loan, "journal_2", "2020-06-20 10:00:00")
+
+    from_date = parse_date("2020-05-01").date()
+    to_date = parse_date("2020-05-31").date()
+    expected_ids = [
+        entry_id
+        for entry_id, in session.query(JournalEntry.id)
+        .filter(
+            JournalEntry.date_ledger >= from_date, JournalEntry.date_ledger < parse_date("2020-06-01")
+        )
+        .order_by(JournalEntry.date_ledger, JournalEntry.id)
+    ]
+    assert 0 < len(expected_ids) < session.query(JournalEntry).count()
+
+    batches = list(iter_journal_entries(session, from_date, to_date, batch_size=2))
+    assert all(len(batch) <= 2 for batch in batches)
+    rows = [row for batch in batches for row in batch]
+    assert [row["id"] for row in rows] == expected_ids
+    assert all(from_date <= row["date_ledger"].date() <= to_date for row in rows)
+    assert all(row["event_name"] for row in rows)
+    assert list(rows[0]) == JOURNAL_EXPORT_FIELDS
+
+    csv_file = StringIO()
+    assert export_journal_entries_csv(session, from_date, to_date, csv_file, batch_size=2) == len(rows)
+    csv_rows = list(csv.DictReader(StringIO(csv_file.getvalue())))
+    assert [int(row["id"]) for row in csv_rows] == expected_ids
+    assert csv_rows[0]["ledger"] == rows[0]["ledger"]
+
+    jsonl_file = StringIO()
+    assert export_journal_entries_jsonl(session, from_date, to_date, jsonl_file) == len(rows)
+    json_rows = [json.loads(line) for line in jsonl_file.getvalue().splitlines()]
+    assert [row["id"] for row in json_rows] == expected_ids
+    assert Decimal(json_rows[0]["debit"] or 0) == (rows[0]["debit"] or 0)
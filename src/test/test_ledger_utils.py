@@ -0,0 +1,529 @@
+import re
+from datetime import datetime
+from decimal import Decimal
+from typing import (
+    Any,
+    Dict,
+    List,
+)
+
+from pendulum import parse as parse_date  # type: ignore
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import (
+    Query,
+    Session,
+)
+
+from rush.card import create_user_product
+from rush.card.base_card import BaseLoan
+from rush.create_card_swipe import create_card_swipe
+from rush.daily_balance import snapshot_daily_balances
+from rush.instrumentation import track_operation
+from rush.ledger_utils import (
+    LedgerBatch,
+    create_ledger_entry_from_str,
+    get_account_balance_from_str,
+    get_account_balances,
+    get_book_account_by_string,
+    get_book_account_cache,
+    get_book_account_id_by_string,
+    get_book_account_ids_by_strings,
+    prefetch_book_accounts,
+)
+from rush.models import (
+    BookAccountDailyBalance,
+    LedgerTriggerEvent,
+    Lenders,
+    NewLedgerEntry,
+    Product,
+    User,
+)
+
+
+def create_lenders(session: Session) -> None:
+    dmi = Lenders(id=62311, performed_by=123, lender_name="DMI")
+    session.add(dmi)
+    session.flush()
+
+
+def create_products(session: Session) -> None:
+    ruby_product = Product(product_name="ruby")
+    session.add(ruby_product)
+    session.flush()
+
+
+def create_user_loan(session: Session, user_id: int = 801) -> BaseLoan:
+    create_lenders(session=session)
+    create_products(session=session)
+    user = User(id=user_id, performed_by=123)
+    session.add(user)
+    session.flush()
+
+    user_loan = create_user_product(
+        session=session,
+        user_id=user.id,
+        card_activation_date=parse_date("2020-05-01").date(),
+        card_type="ruby",
+        rc_rate_of_interest_monthly=Decimal(3),
+        lender_id=62311,
+        tenure=12,
+    )
+    return user_loan
+
+
+def test_book_account_cache(session: Session) -> None:
+    user_loan = create_user_loan(session=session)
+    swipe = create_card_swipe(
+        session=session,
+        user_loan=user_loan,
+        txn_time=parse_date("2020-05-04 19:23:11"),
+        amount=Decimal(1000),
+        description="BigB.com",
+        txn_ref_no="cache_1",
+        trace_no="123456",
+    )
+    bill_id = swipe["data"].loan_id
+
+    # Books written during the swipe are already resolved.
+    cache = get_book_account_cache(session)
+    unbilled_book = get_book_account_by_string(session, f"{bill_id}/bill/unbilled/a")
+    assert cache.book_ids[(bill_id, "bill", "unbilled", "a")] == unbilled_book.id
+    assert get_book_account_id_by_string(session, f"{bill_id}/bill/unbilled/a") == unbilled_book.id
+
+    # A fresh cache gets warmed with all books of the loan in one go.
+    session.info.pop("book_account_cache")
+    prefetch_book_accounts(session, user_loan)
+    cache = get_book_account_cache(session)
+    assert user_loan.id in cache.prefetched_loan_ids
+    assert (bill_id, "bill", "unbilled", "a") in cache.book_ids
+    assert (user_loan.id, "loan", "lender_payable", "l") in cache.book_ids
+    assert (62311, "lender", "pool_balance", "a") in cache.book_ids
+
+    # Rolled back books shouldn't be handed out.
+    savepoint = session.begin_nested()
+    get_book_account_id_by_string(session, f"{user_loan.id}/loan/some_new_book/a")
+    assert (user_loan.id, "loan", "some_new_book", "a") in cache.book_ids
+    savepoint.rollback()
+    assert "book_account_cache" not in session.info
+    assert (user_loan.id, "loan", "some_new_book", "a") not in get_book_account_cache(session).book_ids
+
+
+def test_ledger_batch(session: Session) -> None:
+    user_loan = create_user_loan(session=session)
+    event = LedgerTriggerEvent.ledger_new(
+        session, name="batch_test", loan_id=user_loan.id, post_date=parse_date("2020-05-04 00:00:00")
+    )
+    session.flush()
+
+    with LedgerBatch(session) as batch:
+        for amount in (Decimal(100), Decimal(50), Decimal("20.5")):
+            create_ledger_entry_from_str(
+                session,
+                event_id=event.id,
+                debit_book_str=f"{user_loan.id}/loan/batch_asset/a",
+                credit_book_str=f"{user_loan.id}/loan/batch_liability/l",
+                amount=amount,
+            )
+        # Nested blocks add to the same batch.
+        with LedgerBatch(session) as inner_batch:
+            assert inner_batch is batch
+            create_ledger_entry_from_str(
+                session,
+                event_id=event.id,
+                debit_book_str=f"{user_loan.id}/loan/batch_liability/l",
+                credit_book_str=f"{user_loan.id}/loan/batch_asset/a",
+                amount=Decimal(10),
+            )
+        assert len(batch.entries) == 4
+
+        # Balance reads see everything written so far.
+        _, asset_balance = get_account_balance_from_str(session, f"{user_loan.id}/loan/batch_asset/a")
+        assert batch.entries == []
+        assert asset_balance == Decimal("160.5")
+
+        create_ledger_entry_from_str(
+            session,
+            event_id=event.id,
+            debit_book_str=f"{user_loan.id}/loan/batch_asset/a",
+            credit_book_str=f"{user_loan.id}/loan/batch_liability/l",
+            amount=Decimal(1),
+        )
+        # Other queries leave the batch alone.
+        session.query(Lenders).all()
+        assert len(batch.entries) == 1
+        assert get_account_balances(
+            session, [f"{user_loan.id}/loan/batch_asset/a"], to_date=parse_date("2020-05-05")
+        ) == {f"{user_loan.id}/loan/batch_asset/a": Decimal("161.5")}
+        assert batch.entries == []
+    assert "ledger_batch" not in session.info
+
+    entries = (
+        session.query(NewLedgerEntry.debit_account_balance, NewLedgerEntry.credit_account_balance)
+        .filter(NewLedgerEntry.event_id == event.id)
+        .order_by(NewLedgerEntry.id)
+        .all()
+    )
+    # Running balances are the same as with one insert per entry.
+    assert entries == [
+        (Decimal(100), Decimal(100)),
+        (Decimal(150), Decimal(150)),
+        (Decimal("170.5"), Decimal("170.5")),
+        (Decimal("160.5"), Decimal("160.5")),
+        (Decimal("161.5"), Decimal("161.5")),
+    ]
+    _, liability_balance = get_account_balance_from_str(
+        session, f"{user_loan.id}/loan/batch_liability/l"
+    )
+    assert liability_balance == Decimal("161.5")
+
+    # Entries of a failed block are discarded.
+    try:
+        with LedgerBatch(session):
+            create_ledger_entry_from_str(
+                session,
+                event_id=event.id,
+                debit_book_str=f"{user_loan.id}/loan/batch_asset/a",
+                credit_book_str=f"{user_loan.id}/loan/batch_liability/l",
+                amount=Decimal(1000),
+            )
+            raise ValueError
+    except ValueError:
+        pass
+    assert session.query(NewLedgerEntry).filter(NewLedgerEntry.event_id == event.id).count() == 5
+
+    # Rolling back a savepoint only discards the entries queued inside it.
+    def add_entry(amount: Decimal) -> None:
+        create_ledger_entry_from_str(
+            session,
+            event_id=event.id,
+            debit_book_str=f"{user_loan.id}/loan/batch_asset/a",
+            credit_book_str=f"{user_loan.id}/loan/batch_liability/l",
+            amount=amount,
+        )
+
+    with LedgerBatch(session) as batch:
+        add_entry(Decimal(2))
+        savepoint = session.begin_nested()
+        add_entry(Decimal(3))
+        assert len(batch.entries) == 1
+        savepoint.rollback()
+        assert batch.entries == []
+    _, asset_balance = get_account_balance_from_str(session, f"{user_loan.id}/loan/batch_asset/a")
+    assert asset_balance == Decimal("163.5")
+
+
+def test_get_account_balances(session: Session) -> None:
+    user_loan = create_user_loan(session=session)
+    swipe = create_card_swipe(
+        session=session,
+        user_loan=user_loan,
+        txn_time=parse_date("2020-05-04 19:23:11"),
+        amount=Decimal(1000),
+        description="BigB.com",
+        txn_ref_no="balances_1",
+        trace_no="123456",
+    )
+    first_swipe_event_id = (
+        session.query(LedgerTriggerEvent.id)
+        .filter(
+            LedgerTriggerEvent.name == "card_transaction", LedgerTriggerEvent.loan_id == user_loan.id
+        )
+        .scalar()
+    )
+    create_card_swipe(
+        session=session,
+        user_loan=user_loan,
+        txn_time=parse_date("2020-05-10 11:00:00"),
+        amount=Decimal(500),
+        description="Flipkart.com",
+        txn_ref_no="balances_2",
+        trace_no="123457",
+    )
+    bill_id = swipe["data"].loan_id
+    book_strings = [
+        f"{bill_id}/bill/unbilled/a",
+        f"{user_loan.id}/card/available_limit/l",
+        f"{user_loan.id}/loan/lender_payable/l",
+        "62311/lender/pool_balance/a",
+        f"{bill_id}/bill/book_that_does_not_exist/a",
+    ]
+
+    for kwargs in (
+        {},
+        {"to_date": parse_date("2020-05-05 00:00:00")},
+        {"event_id": first_swipe_event_id},
+    ):
+        balances = get_account_balances(session, book_strings, **kwargs)
+        assert balances == {
+            book_string: get_account_balance_from_str(session, book_string, **kwargs)[1]
+            for book_string in book_strings
+        }
+
+    assert get_account_balances(session, book_strings)[f"{bill_id}/bill/unbilled/a"] == Decimal(1500)
+    assert get_account_balances(session, book_strings, event_id=first_swipe_event_id)[
+        f"{bill_id}/bill/unbilled/a"
+    ] == Decimal(1000)
+    assert get_account_balances(session, []) == {}
+
+
+def _scan_account_balance(session: Session, book_id: int, till_date: datetime) -> Decimal:
+    # Historical balance straight from the ledger, without snapshots.
+    balance = session.execute(
+        """
+        select case when le.debit_account = :book_id then debit_account_balance
+          else credit_account_balance end
+        from ledger_entry le, ledger_trigger_event lte
+        where (le.debit_account = :book_id or le.credit_account = :book_id)
+          and lte.id = le.event_id and lte.post_date <= :till_date
+        order by le.id desc limit 1
+        """,
+        params={"book_id": book_id, "till_date": till_date},
+    ).scalar()
+    return Decimal(balance or 0)
+
+
+def test_daily_balance_snapshots(session: Session) -> None:
+    user_loan = create_user_loan(session=session)
+    for day, amount in (("2020-05-04", 1000), ("2020-05-10", 500), ("2020-05-15", 200)):
+        swipe = create_card_swipe(
+            session=session,
+            user_loan=user_loan,
+            txn_time=parse_date(f"{day} 11:00:00"),
+            amount=Decimal(amount),
+            description="BigB.com",
+            txn_ref_no=f"snapshot_{day}",
+            trace_no="123456",
+        )
+    bill_id = swipe["data"].loan_id
+    book_strings = [f"{bill_id}/bill/unbilled/a", f"{user_loan.id}/card/available_limit/l"]
+    book_ids = [get_book_account_id_by_string(session, book_string) for book_string in book_strings]
+    dates_to_check = [
+        parse_date(date_to_check)
+        for date_to_check in (
+            "2020-05-03 00:00:00",
+            "2020-05-04 12:00:00",
+            "2020-05-05 00:00:00",
+            "2020-05-11 00:00:00",
+            "2020-05-12 00:00:00",
+            "2020-05-16 00:00:00",
+        )
+    ]
+
+    assert snapshot_daily_balances(session, parse_date("2020-05-04").date()) >= 2
+    assert snapshot_daily_balances(session, parse_date("2020-05-10").date()) >= 2
+    snapshot = (
+        session.query(BookAccountDailyBalance)
+        .filter_by(book_account_id=book_ids[0], balance_date=parse_date("2020-05-10").date())
+        .one()
+    )
+    assert snapshot.balance == Decimal(1500)
+
+    def assert_balances_match_ledger() -> None:
+        for date_to_check in dates_to_check:
+            for book_string, book_id in zip(book_strings, book_ids):
+                _, balance = get_account_balance_from_str(session, book_string, to_date=date_to_check)
+                assert balance == _scan_account_balance(session, book_id, date_to_check)
+
+    assert_balances_match_ledger()
+
+    # Backdated entry lands before the snapshots. The trigger moves them along.
+    event = LedgerTriggerEvent.ledger_new(
+        session, name="backdated", loan_id=user_loan.id, post_date=parse_date("2020-05-04 15:00:00")
+    )
+    session.flush()
+    create_ledger_entry_from_str(
+        session,
+        event_id=event.id,
+        debit_book_str=book_strings[0],
+        credit_book_str=book_strings[1],
+        amount=Decimal(50),
+    )
+    session.refresh(snapshot)
+    assert snapshot.balance == _scan_account_balance(
+        session, book_ids[0], parse_date("2020-05-10 23:59:59")
+    )
+    assert_balances_match_ledger()
+
+
+def _explain_sql(session: Session, sql: str, params: Dict[str, Any]) -> str:
+    connection = session.connection()
+    # Test tables are tiny. Make the planner prefer indexes like it would on a big table.
+    connection.execute("analyze ledger_entry, ledger_trigger_event")
+    connection.execute("set local enable_seqscan = off")
+    plan = connection.execute(f"explain {sql}", params).fetchall()
+    connection.execute("set local enable_seqscan = on")
+    return "\n".join(row[0] for row in plan)
+
+
+def _explain(session: Session, query: Query) -> str:
+    statement = query.statement.compile(dialect=postgresql.dialect())
+    return _explain_sql(session, str(statement), statement.params)
+
+
+def _explain_function(
+    session: Session, function_name: str, arg_types: List[str], args: List[Any], body: str = None
+) -> str:
+    """
+    Plan of a balance function's body. EXPLAIN doesn't look inside function calls, so the body
+    is prepared as a statement with the function's parameters and explained with the args.
+    """
+    if body is None:
+        body = session.execute(
+            "select prosrc from pg_proc where proname = :name", {"name": function_name}
+        ).scalar()
+    connection = session.connection()
+    connection.execute(f"prepare balance_lookup ({', '.join(arg_types)}) as {body.strip().rstrip(';')}")
+    try:
+        placeholders = ", ".join(f"%(arg_{i})s" for i in range(len(args)))
+        return _explain_sql(
+            session,
+            f"execute balance_lookup ({placeholders})",
+            {f"arg_{i}": arg for i, arg in enumerate(args)},
+        )
+    finally:
+        connection.execute("deallocate balance_lookup")
+
+
+def test_ledger_lookups_use_indexes(session: Session) -> None:
+    user_loan = create_user_loan(session=session)
+    create_card_swipe(
+        session=session,
+        user_loan=user_loan,
+        txn_time=parse_date("2020-05-04 19:23:11"),
+        amount=Decimal(1000),
+        description="BigB.com",
+        txn_ref_no="explain_1",
+        trace_no="123456",
+    )
+    book_id = get_book_account_id_by_string(session, f"{user_loan.id}/card/available_limit/l")
+
+    # reverse_event, get_payment_split_from_event
+    plan = _explain(session, session.query(NewLedgerEntry).filter(NewLedgerEntry.event_id == 1))
+    assert "ix_ledger_entry_event_id" in plan
+    assert "Seq Scan" not in plan
+
+    # get_affected_events, update_event_with_dpd
+    plan = _explain(
+        session,
+        session.query(LedgerTriggerEvent.id).filter(
+            LedgerTriggerEvent.loan_id == user_loan.id,
+            LedgerTriggerEvent.name == "card_transaction",
+            LedgerTriggerEvent.post_date > parse_date("2020-05-01 00:00:00"),
+        ),
+    )
+    assert "ix_ledger_trigger_event_loan_id_name_post_date" in plan
+
+    # Each side of the balance lookups has its own index.
+    for account_column, balance_column, index_name in (
+        (
+            NewLedgerEntry.debit_account,
+            NewLedgerEntry.debit_account_balance,
+            "ix_ledger_entry_debit_account",
+        ),
+        (
+            NewLedgerEntry.credit_account,
+            NewLedgerEntry.credit_account_balance,
+            "ix_ledger_entry_credit_account",
+        ),
+    ):
+        plan = _explain(
+            session,
+            session.query(balance_column)
+            # The bound has to be above every event id so far, rolled back tests use up ids too.
+            .filter(account_column == book_id, NewLedgerEntry.event_id <= 2 ** 31 - 1)
+            .order_by(NewLedgerEntry.id.desc())
+            .limit(1),
+        )
+        assert index_name in plan
+        assert "Seq Scan" not in plan
+
+
+def test_get_book_account_ids_by_strings(session: Session) -> None:
+    existing_book = get_book_account_by_string(session, "9101/loan/lender_payable/l")
+    session.info.pop("book_account_cache")
+    book_strings = [
+        "9101/loan/lender_payable/l",
+        "9101/loan/lender_interest/e",
+        "9102/loan/lender_payable/l",
+    ]
+
+    with track_operation("book_lookup") as operation:
+        book_ids = get_book_account_ids_by_strings(session, book_strings)
+    # Existing books are read in one query, the missing ones created in another.
+    assert operation.total.query_count == 2
+    assert book_ids["9101/loan/lender_payable/l"] == existing_book.id
+    assert len(set(book_ids.values())) == 3
+    for book_string, book_id in book_ids.items():
+        assert get_book_account_by_string(session, book_string).id == book_id
+
+    with track_operation("book_lookup") as operation:
+        assert get_book_account_ids_by_strings(session, book_strings) == book_ids
+    assert operation.total.query_count == 0
+
+
+def test_balance_functions_use_indexes(session: Session) -> None:
+    user_loan = create_user_loan(session=session)
+    create_card_swipe(
+        session=session,
+        user_loan=user_loan,
+        txn_time=parse_date("2020-05-04 19:23:11"),
+        amount=Decimal(1000),
+        description="BigB.com",
+        txn_ref_no="explain_functions_1",
+        trace_no="123456",
+    )
+    book_id = get_book_account_id_by_string(session, f"{user_loan.id}/card/available_limit/l")
+    lender_book_id = get_book_account_id_by_string(session, "62311/lender/pool_balance/a")
+    till_date = parse_date("2020-05-31 00:00:00").naive()
+
+    # Entries of other books, so that walking the primary key backwards costs more than the
+    # per-book index, as on a real ledger.
+    filler_debit_id = get_book_account_id_by_string(session, "1/lender/explain_filler/a")
+    filler_credit_id = get_book_account_id_by_string(session, "1/lender/explain_filler/l")
+    session.execute(
+        """
+        insert into ledger_entry (event_id, debit_account, credit_account, amount, created_at)
+        select (select max(event_id) from ledger_entry), :debit, :credit, 1, now()
+        from generate_series(1, 2000)
+        """,
+        {"debit": filler_debit_id, "credit": filler_credit_id},
+    )
+
+    def assert_both_sides_use_index(plan: str) -> None:
+        assert "ix_ledger_entry_debit_account" in plan
+        assert "ix_ledger_entry_credit_account" in plan
+        assert "Seq Scan on ledger_entry" not in plan
+
+    # Balance as of a date and as of an event.
+    for args in ([book_id, till_date, None], [book_id, None, 2 ** 31 - 1]):
+        assert_both_sides_use_index(
+            _explain_function(
+                session, "get_account_balance_by_book_id", ["integer", "timestamp", "integer"], args
+            )
+        )
+
+    assert_both_sides_use_index(
+        _explain_function(
+            session,
+            "get_account_balance_between_periods_by_book_id",
+            ["integer", "timestamp", "timestamp"],
+            [book_id, parse_date("2020-05-01 00:00:00").naive(), till_date],
+        )
+    )
+
+    # get_lender_account_balance is plpgsql. Its query reads the book id from a variable, which is
+    # a parameter like any other once it's replaced.
+    function_body = session.execute(
+        "select prosrc from pg_proc where proname = 'get_lender_account_balance'"
+    ).scalar()
+    lender_query = function_body[function_body.index("with entries") : function_body.index("RETURN")]
+    lender_query = re.sub(r"\bbook_id\b", "$1", lender_query.replace("INTO account_balance", ""))
+    assert_both_sides_use_index(
+        _explain_function(
+            session,
+            "get_lender_account_balance",
+            ["integer", "varchar", "varchar", "timestamp"],
+            [lender_book_id, "pool_balance", "a", till_date],
+            body=lender_query,
+        )
+    )
@@ -0,0 +1,188 @@
+from decimal import Decimal
+from pathlib import Path
+from test.utils import (
+    create_lenders_and_products,
+    create_loan_with_bills,
+    pay_payment_request,
+    payment_request_data,
+)
+
+from pendulum import parse as parse_date  # type: ignore
+from sqlalchemy.orm import Session
+
+from rush.card.base_card import BaseLoan
+from rush.instrumentation import track_operation
+from rush.loan_schedule.loan_schedule import (
+    group_bills,
+    rebuild_schedules,
+    reset_loan_schedule,
+    slide_payment_to_emis,
+)
+from rush.models import (
+    LedgerTriggerEvent,
+    LoanSchedule,
+    PaymentMapping,
+)
+from rush.payments import payment_received
+
+
+def test_group_bills_upsert(session: Session) -> None:
+    create_lenders_and_products(session)
+    user_loan = create_loan_with_bills(session, 561)
+
+    def get_loan_emis() -> list:
+        return (
+            session.query(LoanSchedule)
+            .filter(LoanSchedule.loan_id == user_loan.loan_id, LoanSchedule.bill_id.is_(None))
+            .order_by(LoanSchedule.due_date)
+            .all()
+        )
+
+    loan_emis = get_loan_emis()
+    # The second bill's last emi is the only one on its date.
+    assert [emi.emi_number for emi in loan_emis] == list(range(1, 14))
+    first_emi_values = (loan_emis[0].id, loan_emis[0].principal_due, loan_emis[0].interest_due)
+
+    bill_emi = (
+        session.query(LoanSchedule)
+        .filter(LoanSchedule.loan_id == user_loan.loan_id, LoanSchedule.bill_id.isnot(None))
+        .order_by(LoanSchedule.due_date, LoanSchedule.id)
+        .first()
+    )
+    bill_emi.principal_due += 10
+    with track_operation("group_bills") as operation:
+        group_bills(user_loan)
+    assert operation.total.query_count == 2  # The flush of the bill emi and the upsert.
+
+    loan_emis = get_loan_emis()
+    assert len(loan_emis) == 13
+    assert loan_emis[0].id == first_emi_values[0]
+    assert loan_emis[0].principal_due == first_emi_values[1] + 10
+    assert loan_emis[0].interest_due == first_emi_values[2]
+
+
+def test_rebuild_schedules(session: Session, tmp_path: Path) -> None:
+    create_lenders_and_products(session)
+    user_loans = [create_loan_with_bills(session, user_id) for user_id in (591, 592)]
+    for user_loan in user_loans:
+        for payment_date, amount in (("2020-05-20 10:00:00", 400), ("2020-06-02 10:00:00", 900)):
+            payment_request_id = f"rebuild_{user_loan.id}_{payment_date}"
+            payment_request_data(
+                session=session,
+                type="collection",
+                payment_request_amount=Decimal(amount),
+                user_id=user_loan.user_id,
+                payment_request_id=payment_request_id,
+            )
+            payment_received(
+                session=session,
+                user_loan=user_loan,
+                payment_request_data=pay_payment_request(
+                    session=session,
+                    payment_request_id=payment_request_id,
+                    payment_date=parse_date(payment_date),
+                ),
+            )
+
+    def get_schedule_state(user_loan: BaseLoan) -> list:
+        emis = [
+            (emi.emi_number, emi.due_date, emi.payment_received, emi.payment_status, emi.dpd)
+            for emi in user_loan.get_loan_schedule()
+        ]
+        mappings = (
+            session.query(LoanSchedule.emi_number, PaymentMapping.amount_settled)
+            .join(PaymentMapping, PaymentMapping.emi_id == LoanSchedule.id)
+            .filter(LoanSchedule.loan_id == user_loan.loan_id, PaymentMapping.row_status == "active")
+            .order_by(LoanSchedule.emi_number, PaymentMapping.id)
+            .all()
+        )
+        return [emis, mappings]
+
+    expected_state = get_schedule_state(user_loans[0])
+    assert get_schedule_state(user_loans[1]) == expected_state
+    # The 1300 paid covers the first five emis and part of the sixth.
+    assert [emi[2] for emi in expected_state[0][:7]] == [
+        Decimal("114.00"),
+        Decimal("284.00"),
+        Decimal("284.00"),
+        Decimal("284.00"),
+        Decimal("284.00"),
+        Decimal("50.00"),
+        Decimal(0),
+    ]
+
+    reset_loan_schedule(user_loans[0], session)
+    results = rebuild_schedules(session, [user_loans[1].id, 0], chunk_size=1)
+
+    assert results == [
+        {"loan_id": user_loans[1].id, "result": "success"},
+        {"loan_id": 0, "result": "error", "message": "Loan not found."},
+    ]
+    assert get_schedule_state(user_loans[1]) == get_schedule_state(user_loans[0])
+
+    # Loans in the checkpoint file are done already.
+    checkpoint_path = tmp_path / "rebuild_checkpoint"
+    checkpoint_path.write_text(f"{user_loans[0].id}\n{user_loans[1].id}\n")
+    assert (
+        rebuild_schedules(
+            session, [loan.id for loan in user_loans], checkpoint_path=str(checkpoint_path)
+        )
+        == []
+    )
+
+
+def test_slide_payment_to_emis_upsert(session: Session) -> None:
+    create_lenders_and_products(session)
+    user_loan = create_loan_with_bills(session, 601)
+    payment_request_data(
+        session=session,
+        type="collection",
+        payment_request_amount=Decimal(1000),
+        user_id=user_loan.user_id,
+        payment_request_id="slide_601",
+    )
+    payment_received(
+        session=session,
+        user_loan=user_loan,
+        payment_request_data=pay_payment_request(
+            session=session,
+            payment_request_id="slide_601",
+            payment_date=parse_date("2020-05-20 10:00:00"),
+        ),
+    )
+    payment_event = (
+        session.query(LedgerTriggerEvent)
+        .filter(
+            LedgerTriggerEvent.loan_id == user_loan.loan_id,
+            LedgerTriggerEvent.name == "payment_received",
+        )
+        .one()
+    )
+
+    def get_mappings() -> list:
+        return (
+            session.query(PaymentMapping.emi_id, PaymentMapping.amount_settled)
+            .filter(
+                PaymentMapping.payment_request_id == "slide_601", PaymentMapping.row_status == "active"
+            )
+            .order_by(PaymentMapping.emi_id)
+            .all()
+        )
+
+    mappings = get_mappings()
+    assert [amount for _, amount in mappings] == [
+        Decimal("114.00"),
+        Decimal("284.00"),
+        Decimal("284.00"),
+        Decimal("284.00"),
+        Decimal("34.00"),
+    ]
+
+    # Sliding more of the same payment adds to its mappings. The unpaid emis are read, their
+    # changes flushed and the mappings upserted, however many emis it spans.
+    session.flush()
+    with track_operation("slide_payment_to_emis") as operation:
+        slide_payment_to_emis(user_loan, payment_event, Decimal(100))
+    assert operation.total.query_count == 3
+    new_mappings = get_mappings()
+    assert new_mappings == mappings[:-1] + [(mappings[-1][0], Decimal("134.00"))]
@@ -0,0 +1,86 @@
+from decimal import Decimal
+from test.utils import (
+    create_lenders_and_products,
+    create_loan_with_bills,
+    get_loan_state,
+    pay_payment_request,
+    payment_request_data,
+)
+
+from pendulum import parse as parse_date  # type: ignore
+from sqlalchemy.orm import Session
+
+from rush.payments import (
+    ingest_payments,
+    payment_received,
+)
+
+
+def test_ingest_payments(session: Session) -> None:
+    create_lenders_and_products(session)
+    user_loans = [create_loan_with_bills(session, user_id) for user_id in (531, 532)]
+
+    payment_dates = ("2020-05-20 10:00:00", "2020-06-02 10:00:00")
+    payment_requests = {}
+    for user_loan in user_loans:
+        for payment_date in payment_dates:
+            payment_request_id = f"ingest_{user_loan.id}_{payment_date}"
+            payment_request_data(
+                session=session,
+                type="collection",
+                payment_request_amount=Decimal(400),
+                user_id=user_loan.user_id,
+                payment_request_id=payment_request_id,
+            )
+            payment_requests[user_loan.id, payment_date] = pay_payment_request(
+                session=session,
+                payment_request_id=payment_request_id,
+                payment_date=parse_date(payment_date),
+            )
+
+    # Not paid yet, so it has no payment date.
+    payment_request_data(
+        session=session,
+        type="collection",
+        payment_request_amount=Decimal(400),
+        user_id=user_loans[1].user_id,
+        payment_request_id="ingest_unpaid",
+    )
+
+    for payment_date in payment_dates:
+        payment_received(
+            session=session,
+            user_loan=user_loans[0],
+            payment_request_data=payment_requests[user_loans[0].id, payment_date],
+        )
+
+    # Rows are out of order and mixed with bad ones.
+    rows = [
+        (user_loans[1].id, payment_requests[user_loans[1].id, payment_dates[1]].payment_request_id),
+        (user_loans[1].id, "unknown_payment_request"),
+        (user_loans[1].id, payment_requests[user_loans[0].id, payment_dates[0]].payment_request_id),
+        (user_loans[1].id, "ingest_unpaid"),
+        (user_loans[1].id, payment_requests[user_loans[1].id, payment_dates[0]].payment_request_id),
+    ]
+    results = ingest_payments(session, rows)
+
+    assert [result["result"] for result in results] == ["success", "error", "error", "error", "success"]
+    assert results[1]["message"] == "Payment request not found."
+    assert results[2]["message"] == "Payment request belongs to another user."
+    assert results[3]["message"] == "Payment request isn't paid."
+    assert [result["payment_request_id"] for result in results] == [row[1] for row in rows]
+    expected_state = get_loan_state(session, user_loans[0])
+    assert get_loan_state(session, user_loans[1]) == expected_state
+    # 800 paid off the interest and 800 of the principal.
+    assert expected_state[1] == [
+        Decimal(0),
+        Decimal(0),
+        Decimal("680.00"),
+        Decimal(0),
+        Decimal("680.00"),
+        Decimal(0),
+        Decimal(0),
+        Decimal("1020.00"),
+        Decimal(0),
+        Decimal("1020.00"),
+    ]
@@ -0,0 +1,86 @@
+import json
+
+from sqlalchemy.orm import (
+    Session,
+    make_transient_to_detached,
+)
+
+from rush.instrumentation import track_operation
+from rush.models import (
+    User,
+    UserDocuments,
+)
+from rush.user_names import (
+    DEFAULT_USER_NAME,
+    resolve_name,
+    resolve_names,
+    user_name_cache,
+)
+
+
+def _add_aadhar(session: Session, document_id: int, user_id: int, name: str) -> UserDocuments:
+    session.execute(
+        """
+        INSERT INTO v3_user_documents (
+            id, user_id, document_type, image_url, text_details_json, verification_status,
+            created_at, updated_at
+        )
+        VALUES (:id, :user_id, 'Aadhar', '', :details, 'APPROVED', now(), now())
+        """,
+        {
+            "id": document_id,
+            "user_id": user_id,
+            "details": json.dumps({"name": name, "address_type": "x"}),
+        },
+    )
+    # Changes are made through the model in the app. Only the changed columns are written on flush.
+    document = UserDocuments(id=document_id, user_id=user_id)
+    make_transient_to_detached(document)
+    session.add(document)
+    return document
+
+
+def test_resolve_names(session: Session) -> None:
+    user_name_cache.clear()
+    session.add_all([User(id=581, performed_by=123), User(id=582, performed_by=123)])
+    session.flush()
+    document = _add_aadhar(session, 5811, 581, "Ramesh Kumar")
+
+    with track_operation("resolve_names") as operation:
+        assert resolve_names(session, [581, 582, 581]) == {581: "RAMESH KUMAR", 582: DEFAULT_USER_NAME}
+    # The aadhar names of both users in one query, the user data of the one without in another.
+    assert operation.total.query_count == 2
+
+    with track_operation("resolve_name") as operation:
+        assert resolve_name(session, 581) == "RAMESH KUMAR"
+    assert operation.total.query_count == 0
+
+    document.verification_status = "REJECTED"
+    assert resolve_name(session, 581) == DEFAULT_USER_NAME
+
+    # Names read in a transaction that's rolled back aren't kept.
+    session.rollback()
+    assert "user_name_stage" not in session.info
+    assert user_name_cache.get(582) is None
+
+
+def test_user_names_shared_on_commit(session: Session) -> None:
+    user_name_cache.clear()
+    session.add(User(id=583, performed_by=123))
+    session.flush()
+    assert resolve_name(session, 583) == DEFAULT_USER_NAME
+    assert user_name_cache.get(583) is None
+
+    session.commit()
+    assert user_name_cache.get(583) == DEFAULT_USER_NAME
+
+    document = _add_aadhar(session, 5831, 583, "Suresh Kumar")
+    assert resolve_name(session, 583) == DEFAULT_USER_NAME
+    document.verification_status = "APPROVED"
+    assert user_name_cache.get(583) is None
+    assert resolve_name(session, 583) == "SURESH KUMAR"
+    session.rollback()
+
+    session.query(User).filter(User.id == 583).delete()
+    session.commit()
+    user_name_cache.clear()
@@ -8,11 +8,22 @@ from typing import (
 
 from dateutil.relativedelta import relativedelta
 from pendulum import now as current_time
+from pendulum import parse as parse_date  # type: ignore
 from sqlalchemy.orm import Session
 
+from rush.card import create_user_product
+from rush.card.base_card import BaseLoan
+from rush.create_bill import bill_generate
+from rush.create_card_swipe import create_card_swipe
+from rush.ledger_utils import get_account_balances
 from rush.models import (
     CollectionOrders,
+    LedgerLoanData,
+    LedgerTriggerEvent,
+    Lenders,
     PaymentRequestsData,
+    Product,
+    User,
 )
 
 
@@ -111,3 +122,62 @@ def pay_payment_request(
     )
 
     return payment_data
+
+
+def create_lenders_and_products(session: Session) -> None:
+    session.add(Lenders(id=62311, performed_by=123, lender_name="DMI"))
+    session.add(Product(product_name="ruby"))
+    session.flush()
+
+
+def create_loan_with_bills(session: Session, user_id: int) -> BaseLoan:
+    """Ruby card with two generated bills. Every call creates an identical loan."""
+    session.add(User(id=user_id, performed_by=123))
+    session.flush()
+    user_loan = create_user_product(
+        session=session,
+        user_id=user_id,
+        card_activation_date=parse_date("2020-04-02").date(),
+        card_type="ruby",
+        rc_rate_of_interest_monthly=Decimal(3),
+        lender_id=62311,
+        tenure=12,
+    )
+    for txn_time, amount in (("2020-04-08 19:23:11", 1000), ("2020-05-08 19:23:11", 1500)):
+        create_card_swipe(
+            session=session,
+            user_loan=user_loan,
+            txn_time=parse_date(txn_time),
+            amount=Decimal(amount),
+            description="BigB.com",
+            txn_ref_no=f"{user_id}_{txn_time}",
+            trace_no="123456",
+        )
+        bill_generate(user_loan=user_loan)
+    return user_loan
+
+
+def get_loan_state(session: Session, user_loan: BaseLoan) -> list:
+    """Everything the ledger knows about a loan, without ids, for comparing twin loans."""
+    events = (
+        session.query(LedgerTriggerEvent.name, LedgerTriggerEvent.post_date, LedgerTriggerEvent.amount)
+        .filter(LedgerTriggerEvent.loan_id == user_loan.id)
+        .order_by(LedgerTriggerEvent.id)
+        .all()
+    )
+    bill_ids = [
+        bill_id
+        for bill_id, in session.query(LedgerLoanData.id)
+        .filter(LedgerLoanData.loan_id == user_loan.id)
+        .order_by(LedgerLoanData.id)
+    ]
+    book_names = ("interest_receivable", "interest_accrued", "max", "min", "principal_receivable")
+    balances = get_account_balances(
+        session,
+        [
+            f"{bill_id}/bill/{book_name}/{'r' if book_name == 'interest_accrued' else 'a'}"
+            for bill_id in bill_ids
+            for book_name in book_names
+        ],
+    )
+    return [events, list(balances.values())]